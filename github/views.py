@@ -3,6 +3,7 @@ from django.views.decorators.csrf import csrf_exempt
 from io import StringIO
 import json
 from mutopia.models import AssetMap
+from mutopia.changelog import forget_log
 
 
 def _get_asset_info(infile):
@@ -86,6 +87,7 @@ def push_hook(request):
                 # reread the RDF file.
                 asset.published = False
                 asset.save()
+                forget_log(asset)
                 jbuffer.write('[update] - ')
             except AssetMap.DoesNotExist:
                 # Create the new asset.
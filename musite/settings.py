@@ -89,6 +89,94 @@ class Common(Configuration):
         }
     }
 
+    # The cache is shared by the web processes and management commands
+    # so it must not be local to a process. Create the tables with,
+    #   python manage.py createcachetable
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+            'LOCATION': 'mutopia_cache',
+        },
+        # The catalogue generation stamp (see mutopia.cache), started
+        # by dbupdate. It has a table of its own so that it is never
+        # culled to make room for other entries.
+        'catalogue': {
+            'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+            'LOCATION': 'mutopia_catalogue_cache',
+        },
+        # Rendered catalogue pages (see mutopia.cache.cached_page) are
+        # kept by each process so that a hit costs no queries.
+        'pages': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'mutopia-pages',
+            'OPTIONS': {'MAX_ENTRIES': 5000},
+        },
+        # Change logs of pieces (see mutopia.changelog), sized for one
+        # entry for every asset of the archive.
+        'logs': {
+            'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+            'LOCATION': 'mutopia_log_cache',
+            'OPTIONS': {'MAX_ENTRIES': 10000},
+        },
+        # Per-client request counts (see mutopia.throttle), shared by
+        # every process and host so that the rates are site wide. A
+        # table of its own keeps other entries from culling them.
+        'throttle': {
+            'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+            'LOCATION': 'mutopia_throttle_cache',
+            'OPTIONS': {'MAX_ENTRIES': 10000},
+        },
+    }
+
+    # Seconds a rendered page is cached (0 to disable), and how often
+    # each process checks for a new catalogue generation, which
+    # invalidates all cached pages.
+    PAGE_CACHE_TIMEOUT = values.IntegerValue(60 * 60)
+    PAGE_CACHE_GENERATION_CHECK = values.IntegerValue(10)
+
+    # The full text search implementation (see mutopia.search_backends)
+    # and, for the SQLite backend, its index file.
+    SEARCH_BACKEND = values.Value(
+        'mutopia.search_backends.postgres.PostgresBackend')
+    SEARCH_SQLITE_PATH = values.Value(os.path.join(BASE_DIR, 'search.sqlite3'))
+
+    # Number of ranked search results kept by each process.
+    SEARCH_CACHE_SIZE = values.IntegerValue(256)
+
+    # Searches slower than this many seconds are logged with the time
+    # spent in each phase. An EXPLAIN (ANALYZE, BUFFERS) of the query
+    # is logged with them, at most once per interval (in seconds).
+    SLOW_SEARCH_SECONDS = values.FloatValue(1.0)
+    SLOW_SEARCH_EXPLAIN_INTERVAL = values.IntegerValue(300)
+
+    # Statement timeouts (in milliseconds) for each class of search
+    # query. Searches that time out get a degraded response.
+    SEARCH_TIMEOUTS = values.DictValue({
+        'search': 3000,
+        'similar': 1000,
+        'facets': 1000,
+        'headlines': 500,
+    })
+
+    # Per-client rate limits for expensive views (see
+    # mutopia.throttle), by view: the burst of requests allowed and
+    # the sustained rate in requests per minute, across all hosts.
+    THROTTLE_RATES = values.DictValue({
+        'key_results': (20, 30),
+        'adv_results': (20, 30),
+        'log_info': (10, 10),
+    })
+    # The request header identifying throttled clients, if not the
+    # connecting address.
+    THROTTLE_CLIENT_HEADER = values.Value('')
+
+    # Change logs of pieces (see mutopia.changelog) are refreshed in
+    # the background when older than LOG_CACHE_TTL seconds. Fetches
+    # from the archive wait at most LOG_FETCH_TIMEOUT seconds and
+    # failures are retried after LOG_RETRY seconds.
+    LOG_CACHE_TTL = values.IntegerValue(60 * 60 * 24)
+    LOG_FETCH_TIMEOUT = values.FloatValue(3.0)
+    LOG_RETRY = values.IntegerValue(60)
 
     # Use "DEBUG" level to get DB query times (as well as expected
     # exceptions that are caught and ignored in the template system.)
@@ -174,6 +262,8 @@ class Development(Common):
     """
     DEBUG = values.BooleanValue(True)
     ALLOWED_HOSTS = ['127.0.0.1']
+    # Pages change as templates are edited.
+    PAGE_CACHE_TIMEOUT = values.IntegerValue(0)
 
 
 class Staging(Common):
@@ -212,3 +302,5 @@ class Production(Staging):
     SECURE_PROXY_SSL_HEADER = values.TupleValue(
         ('HTTP_X_FORWARDED_PROTO', 'https')
     )
+    # Requests arrive through the load balancer.
+    THROTTLE_CLIENT_HEADER = values.Value('HTTP_X_FORWARDED_FOR')
@@ -10,8 +10,13 @@ from django.contrib import admin
 from django.conf.urls import handler404
 from mutopia import views, piece_views, hooks
 from mutopia.rss import LatestEntriesFeed, AtomLatestFeed
+from mutopia.cache import conditional_page
+from mutopia.models import Piece
 from mutopia import hooks
 
+# Feeds change whenever a piece is published.
+latest_condition = conditional_page(lambda: Piece.objects.all())
+
 urlpatterns = [
     url(r'^$',
         views.homepage,
@@ -35,15 +40,18 @@ urlpatterns = [
     url(r'key-results/',
         views.key_results,
         name='key-results'),
+    url(r'^suggest/$',
+        views.suggestions,
+        name='suggest'),
     url(r'adv-results/',
         views.adv_results,
         name='adv-results'),
     url(r'^admin/', admin.site.urls),
     url(r'latest/rss/$',
-        LatestEntriesFeed(),
+        latest_condition(LatestEntriesFeed()),
         name='latest-rss'),
     url(r'latest/atom/$',
-        AtomLatestFeed(),
+        latest_condition(AtomLatestFeed()),
         name='latest-atom'),
     url(r'github/', include('github.urls')),
     url(r'update/', include('update.urls')),
@@ -3,3 +3,5 @@
 .. moduleauthor:: Glen Larsen, glenl.glx at gmail.com
 
 """
+
+default_app_config = 'mutopia.apps.MutopiaConfig'
@@ -9,3 +9,7 @@ from django.apps import AppConfig
 
 class MutopiaConfig(AppConfig):
     name = 'mutopia'
+
+    def ready(self):
+        # Connects the signal handlers that maintain the search table.
+        import mutopia.search
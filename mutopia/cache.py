@@ -0,0 +1,267 @@
+"""
+.. module:: cache
+   :platform: Linux
+   :synopsis: Caching support for catalogue data
+
+.. moduleauthor:: Glen Larsen <glenl.glx@gmail.com>
+
+The catalogue only changes when ``dbupdate`` runs so cached data is
+associated with a *catalogue generation*, a stamp kept in the shared
+``catalogue`` cache, where nothing else is stored so that it is never
+culled. The ``dbupdate`` command starts a new generation when it
+finishes, invalidating everything cached against the old one.
+
+Whole pages of catalogue views are cached by :func:`cached_page` in
+the ``pages`` cache, compressed and keyed on the generation and the
+URL, so a crawler walking the catalogue costs no database queries.
+Views decorated with :func:`conditional_page` also answer conditional
+requests with 304 Not Modified, using validators computed from the
+generation and the number of pieces a page shows.
+
+"""
+
+import gzip
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
+
+GENERATION_KEY = 'mutopia:generation'
+PAGE_KEY = 'mutopia:page:{0}:{1}'
+VALIDATORS_KEY = 'mutopia:validators:{0}:{1}'
+
+# The generation as last read by this process, see recent_generation().
+_recent = {'generation': None, 'checked': 0.0}
+
+
+def catalogue_generation():
+    """Return the current catalogue generation stamp.
+
+    :return: A stamp that changes whenever the catalogue is updated.
+    :rtype: int
+
+    """
+    generation = caches['catalogue'].get(GENERATION_KEY)
+    if generation is None:
+        generation = new_generation()
+    return generation
+
+
+def new_generation():
+    """Start a new catalogue generation.
+
+    :return: The new generation stamp.
+    :rtype: int
+
+    """
+    # Never re-use a stamp, even if called twice in one millisecond.
+    stamps = caches['catalogue']
+    generation = max(int(time.time() * 1000),
+                     (stamps.get(GENERATION_KEY) or 0) + 1)
+    stamps.set(GENERATION_KEY, generation, None)
+    _recent['generation'] = generation
+    _recent['checked'] = time.time()
+    return generation
+
+
+def recent_generation():
+    """Return the catalogue generation stamp, reading it from the
+    shared cache at most once every ``PAGE_CACHE_GENERATION_CHECK``
+    seconds. A new generation may not be seen for that long.
+
+    :rtype: int
+
+    """
+    now = time.time()
+    if (_recent['generation'] is None or
+            now - _recent['checked'] >= settings.PAGE_CACHE_GENERATION_CHECK):
+        _recent['generation'] = catalogue_generation()
+        _recent['checked'] = now
+    return _recent['generation']
+
+
+def _personal(request):
+    """True if a view used the CSRF token or session of a request."""
+    session = getattr(request, 'session', None)
+    return bool(request.META.get('CSRF_COOKIE_USED') or
+                (session is not None and session.accessed))
+
+
+def cached_page(view):
+    """Decorate a view of the catalogue so that its successful GET
+    responses are cached, gzipped, for the current catalogue
+    generation. Pages are keyed on the full path, including the query
+    string, and served compressed to clients that accept gzip.
+
+    Pages are not cached if ``PAGE_CACHE_TIMEOUT`` is 0, or if they
+    depend on the visitor: the view set cookies or Vary headers, used
+    a CSRF token, or read the session. The middlewares only add their
+    cookies and headers after the decorator returns, so the request is
+    checked for the last two.
+
+    """
+    @wraps(view)
+    def cached_view(request, *args, **kwargs):
+        timeout = settings.PAGE_CACHE_TIMEOUT
+        if not timeout or request.method not in ('GET', 'HEAD'):
+            return view(request, *args, **kwargs)
+
+        path = hashlib.md5(request.get_full_path().encode('utf-8'))
+        key = PAGE_KEY.format(recent_generation(), path.hexdigest())
+        pages = caches['pages']
+        page = pages.get(key)
+        if page is None:
+            response = view(request, *args, **kwargs)
+            if (response.status_code != 200 or response.streaming
+                    or response.cookies or response.has_header('Vary')
+                    or _personal(request)):
+                return response
+            page = (response['Content-Type'], gzip.compress(response.content))
+            pages.set(key, page, timeout)
+
+        content_type, body = page
+        accepts = request.META.get('HTTP_ACCEPT_ENCODING', '')
+        if 'gzip' in accepts:
+            response = HttpResponse(body, content_type=content_type)
+            response['Content-Encoding'] = 'gzip'
+        else:
+            response = HttpResponse(gzip.decompress(body),
+                                    content_type=content_type)
+        patch_vary_headers(response, ('Accept-Encoding',))
+        return response
+    return cached_view
+
+
+def page_validators(request, pieces):
+    """Return the ETag and Last-Modified time of a page showing a set
+    of pieces, or ``(None, None)`` if the set is empty. Validators
+    are kept in the ``pages`` cache for the current generation so
+    only the first request for a path queries the database.
+
+    :param Request request: The HTTP request object.
+    :param pieces: A Piece query set of the pieces shown.
+    :return: The ETag and the Last-Modified time, in seconds since
+        the epoch.
+    :rtype: tuple
+
+    """
+    generation = recent_generation()
+    path = hashlib.md5(request.path.encode('utf-8'))
+    key = VALIDATORS_KEY.format(generation, path.hexdigest())
+    pages = caches['pages']
+    validators = pages.get(key)
+    if validators is None:
+        count = pieces.count()
+        validators = (None, None)
+        if count:
+            # Pieces only carry a publication date, and any edit may
+            # change a page, so it was last modified when the current
+            # generation started.
+            modified = generation // 1000
+            # Weak, as gzipped and plain pages share the tag.
+            etag = 'W/"{0}-{1}"'.format(generation, count)
+            validators = (etag, modified)
+        pages.set(key, validators, settings.PAGE_CACHE_TIMEOUT)
+    return validators
+
+
+def conditional_page(pieces):
+    """Decorate a view of the catalogue so that it sends ETag and
+    Last-Modified headers and answers ``If-None-Match`` and
+    ``If-Modified-Since`` requests with 304 Not Modified, without
+    running the view. Apply it outside :func:`cached_page`.
+
+    :param pieces: A function of the view's arguments returning a
+        Piece query set of the pieces the view shows.
+
+    """
+    def decorator(view):
+        @wraps(view)
+        def conditional_view(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return view(request, *args, **kwargs)
+            etag, modified = page_validators(request, pieces(*args, **kwargs))
+            if etag is None:
+                return view(request, *args, **kwargs)
+            response = get_conditional_response(request, etag=etag,
+                                                last_modified=modified)
+            if response is None:
+                response = view(request, *args, **kwargs)
+                if response.status_code == 200:
+                    response['ETag'] = etag
+                    response['Last-Modified'] = http_date(modified)
+            return response
+        return conditional_view
+    return decorator
+
+
+class LRUCache:
+    """A bounded, thread-safe mapping that evicts its least recently
+    used entry when full. Hits and misses are counted so the cache
+    can be sized.
+
+    The cache is local to a process.
+
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Return the value for `key`, marking it as recently used.
+
+        :param key: A hashable key.
+        :param default: Returned (and counted as a miss) when the key
+            is not in the cache.
+
+        """
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """Store a value, evicting the least recently used entry if
+        the cache is full.
+
+        """
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        """Remove all entries and reset the counters."""
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Return a dictionary of cache statistics."""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+            }
+
+    def __len__(self):
+        return len(self._data)
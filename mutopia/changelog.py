@@ -0,0 +1,109 @@
+"""
+.. module:: changelog
+   :platform: Linux
+   :synopsis: Cached change logs from the archive
+
+.. moduleauthor:: Glen Larsen <glenl.glx@gmail.com>
+
+The change history of a piece is a ``.log`` file kept with its assets
+on the archive server. Logs are kept in the shared ``logs`` cache for
+each asset so a log page does not wait on the archive:
+
+  - A log fetched within ``LOG_CACHE_TTL`` seconds is served as is.
+  - An older log is still served, and refreshed by a background thread.
+  - A missing log is fetched, waiting at most ``LOG_FETCH_TIMEOUT``
+    seconds. If that fails, no fetch for the asset is tried again for
+    ``LOG_RETRY`` seconds and the page says the log is unavailable.
+
+The ``push_hook`` view forgets the log of every asset a push changes.
+
+"""
+
+import hashlib
+import logging
+import threading
+import time
+import requests
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection
+from mutopia.utils import FTP_URL
+
+logger = logging.getLogger(__name__)
+
+LOG_KEY = 'mutopia:log:{0}'
+FETCH_KEY = 'mutopia:log-fetch:{0}'
+
+
+def log_url(asset):
+    """Return the URL of the change log of an asset."""
+    return '/'.join([FTP_URL, asset.folder, asset.name+'.log',])
+
+
+def _key(template, asset):
+    # Folders are free-form, and keys must be safe for any cache.
+    path = '/'.join([asset.folder, asset.name,])
+    return template.format(hashlib.md5(path.encode('utf-8')).hexdigest())
+
+
+def _claim(asset):
+    """Claim the fetch of an asset's change log. Only one fetch of a
+    log is tried at a time, or in the ``LOG_RETRY`` seconds after a
+    failure, across all processes.
+
+    :return: True if the caller should fetch the log.
+
+    """
+    return caches['logs'].add(_key(FETCH_KEY, asset), True,
+                              settings.LOG_RETRY)
+
+
+def _fetch(asset):
+    """Fetch the change log of an asset from the archive and cache it.
+
+    :return: The text of the log, or None if it could not be fetched.
+
+    """
+    url = log_url(asset)
+    try:
+        response = requests.get(url, timeout=settings.LOG_FETCH_TIMEOUT)
+        response.raise_for_status()
+    except requests.RequestException as exc:
+        logger.warning('Unable to fetch %s: %s', url, exc)
+        return None
+    logs = caches['logs']
+    logs.set(_key(LOG_KEY, asset), (time.time(), response.text), None)
+    logs.delete(_key(FETCH_KEY, asset))
+    return response.text
+
+
+def _refresh(asset):
+    """Refresh the change log of an asset, for a background thread."""
+    try:
+        _fetch(asset)
+    finally:
+        connection.close()
+
+
+def change_log(asset):
+    """Return the change log of an asset, from the cache if possible.
+
+    :param AssetMap asset: The asset of a piece.
+    :return: The text of the log, or None if it is unavailable.
+    :rtype: str
+
+    """
+    entry = caches['logs'].get(_key(LOG_KEY, asset))
+    if entry is None:
+        return _fetch(asset) if _claim(asset) else None
+    fetched, text = entry
+    if time.time() - fetched > settings.LOG_CACHE_TTL and _claim(asset):
+        # Stale, serve it while fetching a fresh copy.
+        threading.Thread(target=_refresh, args=(asset,), daemon=True).start()
+    return text
+
+
+def forget_log(asset):
+    """Forget the cached change log of an asset that has changed."""
+    caches['logs'].delete_many([_key(LOG_KEY, asset),
+                                _key(FETCH_KEY, asset)])
@@ -4,18 +4,36 @@ from mutopia.models import Composer, Instrument, Style
 
 class KeySearchForm(forms.Form):
     """ A form for the one-line search box on the jumbotron"""
-    keywords = forms.CharField(max_length=100,
+    # Allow for the qualifiers added when narrowing a search by facet.
+    keywords = forms.CharField(max_length=250,
                                required=False,
                                label=False,
                                widget=forms.TextInput(
                                    attrs={'autofocus':'autofocus',
+                                          'autocomplete': 'off',
                                           'class': 'form-control',
+                                          'list': 'key-suggestions',
                                           'placeholder': 'Search for ...',
                                           'name': 'keywords'
                                    })
     )
 
 
+
+class ListSearchForm(forms.Form):
+    """A form for searching within a composer, style, or instrument
+    listing."""
+    q = forms.CharField(max_length=250,
+                        required=False,
+                        label=False,
+                        widget=forms.TextInput(
+                            attrs={'autocomplete': 'off',
+                                   'class': 'form-control',
+                                   'placeholder': 'Search these pieces ...',
+                            })
+    )
+
+
 def composer_choices():
     """ A tuple list of the choices for composers """
     comps = []
@@ -51,6 +69,15 @@ class SearchInterval:
         (DAY,  'day(s)'),
     )
 
+class InstrumentMode:
+    ALL = 'ALL'
+    ANY = 'ANY'
+    MODE_CHOICES = (
+        (ALL, 'all of'),
+        (ANY, 'any of'),
+    )
+
+
 class AdvSearchForm(forms.Form):
     """This is the full-page search form returned as a main menu item. The
     form displays the keyword text entry box with optional filters.
@@ -60,9 +87,13 @@ class AdvSearchForm(forms.Form):
 
     # narrow search by these composer, instrument, or style
     composer = forms.ChoiceField(composer_choices, required=False)
-    instrument = forms.ChoiceField(instrument_choices, required=False)
+    instrument = forms.MultipleChoiceField(instrument_choices, required=False)
     style = forms.ChoiceField(style_choices, required=False)
 
+    # with several instruments, match pieces for all or any of them
+    instrument_mode = forms.ChoiceField(choices=InstrumentMode.MODE_CHOICES,
+                                        required=False)
+
     # is this piece for solo instrument?
     solo = forms.BooleanField(required=False)
 
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# The materialized view is replaced by a table that is maintained a
+# piece at a time (see mutopia.search).
+MV_DROP = "DROP MATERIALIZED VIEW IF EXISTS mutopia_search_view"
+
+ST_CREATE = """
+CREATE TABLE mutopia_search_view (
+    id integer PRIMARY KEY,
+    piece_id integer NOT NULL,
+    document tsvector NOT NULL
+)
+"""
+
+ST_POPULATE = """
+INSERT INTO mutopia_search_view (id, piece_id, document)
+SELECT
+    p.piece_id,
+    p.piece_id,
+    (to_tsvector('pg_catalog.simple',
+        concat_ws(' ', unaccent(p.title),
+            unaccent(c.description),
+            unaccent(p.opus),
+            p.style_id,
+            unaccent(p.raw_instrument),
+            unaccent(p.lyricist),
+            unaccent(p.source),
+            unaccent(m.name),
+            p.date_composed,
+            unaccent(p.moreinfo),
+            v.version)
+        )) AS document
+    FROM "mutopia_piece" as p
+    JOIN "mutopia_lpversion" AS v ON v.id = p.version_id
+    JOIN "mutopia_composer" AS c ON c.composer = p.composer_id
+    JOIN "mutopia_contributor" AS m ON m.id = p.maintainer_id
+"""
+
+ST_INDEX = """
+CREATE INDEX mutopia_search_index
+   ON mutopia_search_view
+   USING GIN(document)
+"""
+
+ST_DROP = "DROP TABLE IF EXISTS mutopia_search_view"
+
+MV_CREATE = """
+CREATE MATERIALIZED VIEW mutopia_search_view
+(id, piece_id, document)
+AS SELECT
+    p.piece_id,
+    p.piece_id,
+    (to_tsvector('pg_catalog.simple',
+        concat_ws(' ', unaccent(p.title),
+            unaccent(c.description),
+            unaccent(p.opus),
+            p.style_id,
+            unaccent(p.raw_instrument),
+            unaccent(p.lyricist),
+            unaccent(p.source),
+            unaccent(m.name),
+            p.date_composed,
+            unaccent(p.moreinfo),
+            v.version)
+        )) AS document
+    FROM "mutopia_piece" as p
+    JOIN "mutopia_lpversion" AS v ON v.id = p.version_id
+    JOIN "mutopia_composer" AS c ON c.composer = p.composer_id
+    JOIN "mutopia_contributor" AS m ON m.id = p.maintainer_id ;
+"""
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mutopia', '0005_assetmap_uses_svg'),
+    ]
+
+    operations = [
+        migrations.RunSQL([MV_DROP, ST_CREATE, ST_POPULATE, ST_INDEX],
+                          [ST_DROP, MV_CREATE, ST_INDEX]),
+        migrations.AddField(
+            model_name='searchterm',
+            name='piece',
+            field=models.OneToOneField(db_column='piece_id', default=0, on_delete=django.db.models.deletion.CASCADE, to='mutopia.Piece'),
+            preserve_default=False,
+        ),
+    ]
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+ST_PIECE_INDEX = """
+CREATE UNIQUE INDEX mutopia_search_piece_index
+   ON mutopia_search_view (piece_id)
+"""
+
+ST_PIECE_INDEX_DROP = "DROP INDEX IF EXISTS mutopia_search_piece_index"
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mutopia', '0006_search_table'),
+    ]
+
+    operations = [
+        migrations.RunSQL(ST_PIECE_INDEX, ST_PIECE_INDEX_DROP),
+    ]
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# Re-index with a weighted document so that results can be ranked.
+ST_CLEAR = "DELETE FROM mutopia_search_view"
+
+ST_POPULATE = """
+INSERT INTO mutopia_search_view (id, piece_id, document)
+SELECT
+    p.piece_id,
+    p.piece_id,
+    (setweight(to_tsvector('pg_catalog.simple',
+        concat_ws(' ', unaccent(p.title),
+            unaccent(c.description))), 'A') ||
+     setweight(to_tsvector('pg_catalog.simple',
+        concat_ws(' ', unaccent(p.opus),
+            p.style_id,
+            unaccent(p.raw_instrument),
+            unaccent(p.lyricist))), 'B') ||
+     setweight(to_tsvector('pg_catalog.simple',
+        concat_ws(' ', unaccent(m.name),
+            p.date_composed,
+            v.version)), 'C') ||
+     setweight(to_tsvector('pg_catalog.simple',
+        concat_ws(' ', unaccent(p.source),
+            unaccent(p.moreinfo))), 'D')
+        ) AS document
+    FROM "mutopia_piece" as p
+    JOIN "mutopia_lpversion" AS v ON v.id = p.version_id
+    JOIN "mutopia_composer" AS c ON c.composer = p.composer_id
+    JOIN "mutopia_contributor" AS m ON m.id = p.maintainer_id
+"""
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mutopia', '0007_search_piece_index'),
+    ]
+
+    operations = [
+        migrations.RunSQL([ST_CLEAR, ST_POPULATE], migrations.RunSQL.noop),
+    ]
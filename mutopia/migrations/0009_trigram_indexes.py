@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# Trigram indexes for similarity searches on titles and composers
+# (see SearchTerm.similar_ids). word_similarity requires pg_trgm 1.2
+# (PostgreSQL 9.6).
+CREATE_TRGM = "CREATE EXTENSION IF NOT EXISTS pg_trgm"
+
+TITLE_INDEX = """
+CREATE INDEX mutopia_piece_title_trgm
+   ON mutopia_piece
+   USING GIN(title gin_trgm_ops)
+"""
+
+COMPOSER_INDEX = """
+CREATE INDEX mutopia_composer_description_trgm
+   ON mutopia_composer
+   USING GIN(description gin_trgm_ops)
+"""
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mutopia', '0008_search_weights'),
+    ]
+
+    operations = [
+        # The extension may have been installed before, so is kept.
+        migrations.RunSQL(CREATE_TRGM, migrations.RunSQL.noop),
+        migrations.RunSQL(TITLE_INDEX,
+                          'DROP INDEX mutopia_piece_title_trgm'),
+        migrations.RunSQL(COMPOSER_INDEX,
+                          'DROP INDEX mutopia_composer_description_trgm'),
+    ]
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# The lower-cased instruments of each piece as an array in the search
+# table, with a GIN index for all-of (@>) and any-of (&&) searches.
+ADD_INSTRUMENTS = """
+ALTER TABLE mutopia_search_view
+   ADD COLUMN instruments text[] NOT NULL DEFAULT '{}';
+UPDATE mutopia_search_view AS s
+   SET instruments = ARRAY(SELECT lower(pi.instrument_id)
+                              FROM mutopia_piece_instruments AS pi
+                              WHERE pi.piece_id = s.piece_id
+                              ORDER BY 1);
+ALTER TABLE mutopia_search_view ALTER COLUMN instruments DROP DEFAULT;
+"""
+
+DROP_INSTRUMENTS = """
+ALTER TABLE mutopia_search_view DROP COLUMN instruments
+"""
+
+INSTRUMENTS_INDEX = """
+CREATE INDEX mutopia_search_instruments_index
+   ON mutopia_search_view
+   USING GIN(instruments)
+"""
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mutopia', '0009_trigram_indexes'),
+    ]
+
+    operations = [
+        migrations.RunSQL(ADD_INSTRUMENTS, DROP_INSTRUMENTS),
+        migrations.RunSQL(INSTRUMENTS_INDEX,
+                          'DROP INDEX mutopia_search_instruments_index'),
+    ]
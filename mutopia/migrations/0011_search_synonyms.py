@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# Re-index with composer keys and instrument synonyms from
+# update.InstrumentMap added to the documents.
+ST_CLEAR = "DELETE FROM mutopia_search_view"
+
+ST_POPULATE = r"""
+INSERT INTO mutopia_search_view (id, piece_id, document, instruments)
+SELECT
+    p.piece_id,
+    p.piece_id,
+    (setweight(to_tsvector('pg_catalog.simple',
+        concat_ws(' ', unaccent(p.title),
+            unaccent(c.description),
+            c.composer,
+            regexp_replace(c.composer, '([a-z])([A-Z]+)$', '\1 \2'))),
+            'A') ||
+     setweight(to_tsvector('pg_catalog.simple',
+        concat_ws(' ', unaccent(p.opus),
+            p.style_id,
+            unaccent(p.raw_instrument),
+            unaccent(p.lyricist),
+            (SELECT unaccent(string_agg(concat_ws(' ', pi.instrument_id,
+                                                  im.raw_instrument), ' '))
+                 FROM "mutopia_piece_instruments" AS pi
+                 LEFT JOIN "update_instrumentmap" AS im
+                     ON im.instrument_id = pi.instrument_id
+                 WHERE pi.piece_id = p.piece_id))), 'B') ||
+     setweight(to_tsvector('pg_catalog.simple',
+        concat_ws(' ', unaccent(m.name),
+            p.date_composed,
+            v.version)), 'C') ||
+     setweight(to_tsvector('pg_catalog.simple',
+        concat_ws(' ', unaccent(p.source),
+            unaccent(p.moreinfo))), 'D')
+        ) AS document,
+    ARRAY(SELECT lower(pi.instrument_id)
+              FROM "mutopia_piece_instruments" AS pi
+              WHERE pi.piece_id = p.piece_id
+              ORDER BY 1) AS instruments
+    FROM "mutopia_piece" as p
+    JOIN "mutopia_lpversion" AS v ON v.id = p.version_id
+    JOIN "mutopia_composer" AS c ON c.composer = p.composer_id
+    JOIN "mutopia_contributor" AS m ON m.id = p.maintainer_id
+"""
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mutopia', '0010_search_instruments'),
+        ('update', '0003_delete_marker'),
+    ]
+
+    operations = [
+        migrations.RunSQL([ST_CLEAR, ST_POPULATE], migrations.RunSQL.noop),
+    ]
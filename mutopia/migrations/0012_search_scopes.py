@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# Add the composer, style, and instrument scope lexemes to the search
+# documents so searches within a listing are a single index search.
+ADD_SCOPES = """
+UPDATE mutopia_search_view AS s
+   SET document = s.document || array_to_tsvector(ARRAY(
+           SELECT 'composer=' || lower(p.composer_id)
+           UNION SELECT 'style=' || lower(p.style_id)
+               WHERE p.style_id IS NOT NULL
+           UNION SELECT 'style=' || st.slug
+               FROM mutopia_style AS st WHERE st.style = p.style_id
+           UNION SELECT 'instrument=' || lower(pi.instrument_id)
+               FROM mutopia_piece_instruments AS pi
+               WHERE pi.piece_id = p.piece_id))
+   FROM mutopia_piece AS p
+   WHERE p.piece_id = s.piece_id
+"""
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mutopia', '0011_search_synonyms'),
+    ]
+
+    operations = [
+        migrations.RunSQL(ADD_SCOPES, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-18 13:22
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+# Count the pieces of every composer, style, version, and instrument.
+POPULATE = [
+    """UPDATE mutopia_composer AS t SET piece_count =
+           (SELECT count(*) FROM mutopia_piece AS p
+               WHERE p.composer_id = t.composer)""",
+    """UPDATE mutopia_style AS t SET piece_count =
+           (SELECT count(*) FROM mutopia_piece AS p
+               WHERE p.style_id = t.style)""",
+    """UPDATE mutopia_lpversion AS t SET piece_count =
+           (SELECT count(*) FROM mutopia_piece AS p
+               WHERE p.version_id = t.id)""",
+    """UPDATE mutopia_instrument AS t SET piece_count =
+           (SELECT count(*) FROM mutopia_piece_instruments AS pi
+               WHERE pi.instrument_id = t.instrument)""",
+]
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mutopia', '0012_search_scopes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='composer',
+            name='piece_count',
+            field=models.IntegerField(db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='instrument',
+            name='piece_count',
+            field=models.IntegerField(db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='lpversion',
+            name='piece_count',
+            field=models.IntegerField(db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='style',
+            name='piece_count',
+            field=models.IntegerField(db_index=True, default=0),
+        ),
+        migrations.RunSQL(POPULATE, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-18 13:31
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mutopia', '0013_piece_counts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PieceDetail',
+            fields=[
+                ('piece', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='mutopia.Piece')),
+                ('document', models.TextField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# Details stored the key of the LilyPond version rather than the
+# version itself. They are dropped to be rebuilt when next shown.
+DROP_DETAILS = "DELETE FROM mutopia_piecedetail"
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mutopia', '0014_piece_details'),
+    ]
+
+    operations = [
+        migrations.RunSQL(DROP_DETAILS, migrations.RunSQL.noop),
+    ]
@@ -7,18 +7,73 @@
    class may be used in templates when rendering web pages.
 
 """
+import json
+from django.db import connection
 from django.db import models
+from django.db.models.signals import m2m_changed, post_save, pre_delete
+from django.dispatch import receiver
 from django.utils.text import slugify
 from mutopia.utils import FTP_URL
 
+# Recount the pieces of some (or all) rows of a PieceCounted model.
+_RECOUNT = """
+UPDATE {table} AS t SET piece_count =
+    (SELECT count(*) FROM {source} AS s WHERE s.{column} = t.{pk})
+"""
+
+
+class PieceCounted(models.Model):
+    """
+    An abstract model for catalogue entities with a denormalized count
+    of their pieces, so listings can be sorted by popularity without
+    aggregating the piece table. Counts are kept by ``dbupdate`` for
+    the rows it touches and can be rebuilt with the ``recount``
+    command.
+
+    Subclasses name the table and column referencing them in
+    ``piece_source``.
 
-class Composer(models.Model):
+    """
+
+    #:The number of pieces referencing this entity.
+    piece_count = models.IntegerField(default=0, db_index=True)
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def update_piece_counts(cls, keys=None):
+        """Recount the pieces of some rows.
+
+        :param keys: Primary keys of the rows to recount, or None
+            for all rows.
+
+        """
+        source, column = cls.piece_source
+        sql = _RECOUNT.format(table=cls._meta.db_table,
+                              source=source,
+                              column=column,
+                              pk=cls._meta.pk.column)
+        params = []
+        if keys is not None:
+            keys = list(keys)
+            if not keys:
+                return
+            sql += ' WHERE t.{0} = ANY(%s)'.format(cls._meta.pk.column)
+            params.append(keys)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+
+
+class Composer(PieceCounted):
     """
     A Composer, an author of a piece of music. The methods defined
     here are for use in templates for the web-pages.
 
     """
 
+    piece_source = ('mutopia_piece', 'composer_id')
+
     #:The name of the composer. This is specially formatted unique
     #:text that is used as a primary key. The field is built by a
     #:concatenation of the capitalized last name and initials of the
@@ -110,13 +165,15 @@ class Contributor(models.Model):
         ordering = ['name']
 
 
-class Style(models.Model):
+class Style(PieceCounted):
     """
     A ``Style`` is a genre of music that can be associated with a
     piece.
 
     """
 
+    piece_source = ('mutopia_piece', 'style_id')
+
     #:The name of the style.
     style = models.CharField(max_length=32, primary_key=True)
 
@@ -154,7 +211,7 @@ class Style(models.Model):
         ordering = ['style']
 
 
-class LPVersion(models.Model):
+class LPVersion(PieceCounted):
     """
     Defines the LilyPond version for a piece of music. These
     versions are defined as a typical ``major.minor.edit``
@@ -163,6 +220,8 @@ class LPVersion(models.Model):
 
     """
 
+    piece_source = ('mutopia_piece', 'version_id')
+
     #:The full string-ified version specification.
     version = models.CharField(max_length=24, unique=True)
 
@@ -202,7 +261,7 @@ class LPVersion(models.Model):
         return self.version
 
 
-class Instrument(models.Model):
+class Instrument(PieceCounted):
     """
     An ``Instrument`` defines a single instrument. A boolean flag
     is available to declare whether this instrument was in the
@@ -210,6 +269,8 @@ class Instrument(models.Model):
 
     """
 
+    piece_source = ('mutopia_piece_instruments', 'instrument_id')
+
     #:The formal unique name of the instrument
     instrument = models.CharField(max_length=32, primary_key=True)
 
@@ -256,6 +317,25 @@ class License(models.Model):
         ordering = ['name']
 
 
+class PieceQuerySet(models.QuerySet):
+    """Query sets of pieces, adding projections for the views."""
+
+    #:The columns shown when pieces are listed, including those of the
+    #:composer and style.
+    LISTING_FIELDS = ('title', 'composer__description', 'style__style',
+                      'raw_instrument', 'opus', 'date_composed',
+                      'date_published')
+
+    def listing(self):
+        """Return the pieces with only the columns needed to list
+        them, joined with their composer and style so a page of pieces
+        is a single query. The large text columns are not loaded.
+
+        """
+        return self.select_related('composer', 'style').only(
+            *self.LISTING_FIELDS)
+
+
 class Piece(models.Model):
     """
     A ``Piece`` defines a complete MutopiaProject archive entity. Most
@@ -332,6 +412,8 @@ class Piece(models.Model):
     #:allows a more controlled and accurate search.
     instruments = models.ManyToManyField(Instrument)
 
+    objects = PieceQuerySet.as_manager()
+
     def __str__(self):
         return '{0} - {1}'.format(self.piece_id, self.title)
 
@@ -481,3 +563,173 @@ class Collection(models.Model):
 
     def __str__(self):
         return self.tag
+
+
+class PieceDetail(models.Model):
+    """
+    A ``PieceDetail`` holds everything the piece information page
+    shows about a :class:`Piece`, including its asset URLs, so the page
+    is served from a single row instead of a query for each related
+    model. Details are rebuilt by ``dbupdate`` for the pieces it
+    touches, dropped when a piece or anything it shows is edited
+    elsewhere, and built on demand when missing.
+
+    """
+
+    #:The piece described.
+    piece = models.OneToOneField(Piece, models.CASCADE, primary_key=True)
+
+    #:The details as a JSON document, see :meth:`describe`.
+    document = models.TextField()
+
+    @staticmethod
+    def describe(piece):
+        """Return the details of a piece as a dictionary of plain
+        values. Related rows are best fetched with the piece (see
+        :meth:`update_details`).
+
+        """
+        detail = {
+            'piece_id': piece.piece_id,
+            'title': piece.title,
+            'composer': piece.composer_id,
+            'byline': piece.composer.byline(),
+            'style': None,
+            'instruments': [i.pk for i in piece.instruments.all()],
+            'opus': piece.opus,
+            'date_composed': piece.date_composed,
+            'source': piece.source,
+            'moreinfo': piece.moreinfo,
+            'published': piece.date_published.strftime('%Y/%m/%d'),
+            'version': None,
+            'license': None,
+            'maintainer': None,
+            'collection': None,
+            'asset': None,
+        }
+        if piece.style:
+            detail['style'] = {'name': piece.style.style,
+                               'slug': piece.style.slug}
+        if piece.version:
+            detail['version'] = piece.version.version
+        if piece.license:
+            detail['license'] = {'name': piece.license.name,
+                                 'url': piece.license.url,
+                                 'badge': piece.license.badge}
+        if piece.maintainer:
+            detail['maintainer'] = {
+                'name': piece.maintainer.name,
+                'email': piece.maintainer.reformat_email()}
+        for collection in piece.collection_set.all()[:1]:
+            detail['collection'] = {'tag': collection.tag,
+                                    'title': collection.title}
+        for asset in piece.assetmap_set.all()[:1]:
+            preview = asset.name + '-preview'
+            preview += '.svg' if asset.uses_svg else '.png'
+            detail['asset'] = {
+                'uses_svg': asset.uses_svg,
+                'has_lys': asset.has_lys,
+                'preview': '/'.join([FTP_URL, asset.folder, preview,]),
+                'ly': asset.get_ly(),
+                'pdf_a4': asset.get_pdf_a4(),
+                'pdf_let': asset.get_pdf_let(),
+                'ps_a4': asset.get_ps_a4(),
+                'ps_let': asset.get_ps_let(),
+                'midi': asset.get_midi(),
+            }
+        return detail
+
+    @classmethod
+    def update_details(cls, keys=None):
+        """Rebuild the details of some pieces.
+
+        :param keys: Primary keys of the pieces to rebuild, or None
+            for all pieces.
+
+        """
+        pieces = Piece.objects.select_related(
+            'composer', 'style', 'license', 'maintainer', 'version')
+        if keys is not None:
+            pieces = pieces.filter(pk__in=list(keys))
+        pieces = pieces.prefetch_related('instruments', 'collection_set',
+                                         'assetmap_set')
+        for piece in pieces:
+            document = json.dumps(cls.describe(piece))
+            cls.objects.update_or_create(piece=piece,
+                                         defaults={'document': document})
+
+    @classmethod
+    def lookup(cls, piece_id):
+        """Return the details of a piece, building them if necessary.
+
+        :param int piece_id: The piece identifier.
+        :return: The details from :meth:`describe`, or None if there
+            is no such piece.
+        :rtype: dict
+
+        """
+        query = cls.objects.filter(pk=piece_id).values_list('document',
+                                                            flat=True)
+        document = query.first()
+        if document is None:
+            cls.update_details([piece_id])
+            document = query.first()
+            if document is None:
+                return None
+        return json.loads(document)
+
+
+# Details are dropped, to be rebuilt when next shown, if a piece or
+# anything shown with it is edited outside dbupdate.
+
+@receiver(post_save, sender=Piece)
+def _drop_piece_detail(sender, instance, **kwargs):
+    PieceDetail.objects.filter(piece=instance.pk).delete()
+
+
+@receiver(m2m_changed, sender=Collection.pieces.through)
+def _drop_collection_details(sender, instance, action, reverse, pk_set,
+                             **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if reverse:
+        PieceDetail.objects.filter(piece=instance.pk).delete()
+    elif pk_set:
+        PieceDetail.objects.filter(piece__in=pk_set).delete()
+    else:
+        PieceDetail.objects.all().delete()
+
+
+# How pieces refer to each model shown in details. Deletions are caught
+# before the references are removed.
+_DETAIL_RELATIONS = {
+    Composer: 'piece__composer',
+    Style: 'piece__style',
+    License: 'piece__license',
+    Contributor: 'piece__maintainer',
+    LPVersion: 'piece__version',
+    AssetMap: 'piece__assetmap',
+    Collection: 'piece__collection',
+}
+
+
+@receiver(post_save)
+@receiver(pre_delete)
+def _drop_related_details(sender, instance, **kwargs):
+    relation = _DETAIL_RELATIONS.get(sender)
+    if relation is not None:
+        PieceDetail.objects.filter(**{relation: instance}).delete()
+
+
+@receiver(m2m_changed, sender=Piece.instruments.through)
+def _drop_instrument_details(sender, instance, action, reverse, pk_set,
+                             **kwargs):
+    if reverse and action == 'pre_clear':
+        # The pieces of an instrument are unknown after the clear.
+        PieceDetail.objects.filter(piece__instruments=instance).delete()
+    elif action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    elif not reverse:
+        PieceDetail.objects.filter(piece=instance.pk).delete()
+    elif pk_set:
+        PieceDetail.objects.filter(piece__in=pk_set).delete()
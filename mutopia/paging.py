@@ -0,0 +1,135 @@
+"""
+.. module:: paging
+   :platform: Linux
+   :synopsis: Keyset pagination of piece listings
+
+.. moduleauthor:: Glen Larsen <glenl.glx@gmail.com>
+
+Django's :class:`~django.core.paginator.Paginator` counts the whole
+listing and skips to a page with ``OFFSET``, so deep pages of a large
+listing cost more than the first. A :class:`KeysetPaginator` lists
+pieces newest first and finds a page from a *cursor*, the identifier
+of the last piece of the previous page (``after``) or the first piece
+of the next (``before``), so every page is a single indexed query.
+
+The total used for "Page X of Y" is passed in by the view, typically
+a denormalized ``piece_count``, and the page number is carried in the
+URL for display only. It is kept within the pages of the listing,
+and a page with nothing after it is always the last.
+
+"""
+
+import math
+from django.core.paginator import Page
+from django.utils.functional import cached_property
+
+
+def _cursor(value):
+    """Return a cursor or page number from a request parameter, or
+    None if it is missing or invalid.
+
+    """
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return None
+    return value if value > 0 else None
+
+
+class KeysetPaginator:
+    """Paginate a Piece query set by descending ``piece_id``.
+
+    :param pieces: A Piece query set of the whole listing.
+    :param int per_page: Number of pieces on a page.
+    :param int count: The number of pieces in the listing, which may
+        be approximate.
+
+    """
+
+    def __init__(self, pieces, per_page, count):
+        self.pieces = pieces
+        self.per_page = per_page
+        self.count = count
+
+    @cached_property
+    def num_pages(self):
+        return max(1, math.ceil(self.count / self.per_page))
+
+    def _number(self, number, has_next):
+        """Return the number to show for a page after the first."""
+        if not has_next:
+            return max(2, self.num_pages)
+        return max(2, min(number, self.num_pages - 1))
+
+    def page(self, params):
+        """Return the page of pieces named by request parameters.
+
+        :param params: The request's GET parameters, with an optional
+            ``after`` or ``before`` cursor and the ``page`` number.
+        :return: A page of pieces, newest first.
+        :rtype: KeysetPage
+
+        """
+        after = _cursor(params.get('after'))
+        before = _cursor(params.get('before'))
+        number = _cursor(params.get('page')) or 1
+        limit = self.per_page + 1
+
+        if after:
+            rows = list(self.pieces.filter(piece_id__lt=after)
+                        .order_by('-piece_id')[:limit])
+            more = len(rows) > self.per_page
+            return KeysetPage(rows[:self.per_page],
+                              self._number(number, more), self,
+                              has_previous=True, has_next=more)
+        if before:
+            rows = list(self.pieces.filter(piece_id__gt=before)
+                        .order_by('piece_id')[:limit])
+            more = len(rows) > self.per_page
+            rows = rows[:self.per_page]
+            rows.reverse()
+            number = self._number(number, True) if more else 1
+            return KeysetPage(rows, number, self,
+                              has_previous=more, has_next=True)
+        rows = list(self.pieces.order_by('-piece_id')[:limit])
+        return KeysetPage(rows[:self.per_page], 1, self,
+                          has_previous=False,
+                          has_next=len(rows) > self.per_page)
+
+
+class KeysetPage(Page):
+    """A page of a :class:`KeysetPaginator`. Besides the usual page
+    methods, it has the cursors for the neighbouring pages.
+
+    """
+
+    def __init__(self, object_list, number, paginator,
+                 has_previous, has_next):
+        super().__init__(object_list, number, paginator)
+        self._has_previous = has_previous
+        self._has_next = has_next
+        if has_next and number >= paginator.num_pages:
+            # The total is approximate, never claim the last page.
+            paginator.num_pages = number + 1
+
+    def has_next(self):
+        return self._has_next and bool(self.object_list)
+
+    def has_previous(self):
+        return self._has_previous
+
+    def next_page_number(self):
+        return self.number + 1
+
+    def previous_page_number(self):
+        return max(1, self.number - 1)
+
+    @property
+    def next_cursor(self):
+        """The ``after`` cursor of the next page."""
+        return self.object_list[-1].piece_id if self.object_list else None
+
+    @property
+    def previous_cursor(self):
+        """The ``before`` cursor of the previous page."""
+        return self.object_list[0].piece_id if self.object_list else None
@@ -2,19 +2,73 @@
 """Views are functions that respond to HTTP requests, typically via a URL.
 """
 
+from django.db.models import Sum
+from django.http import Http404
 from django.shortcuts import get_object_or_404, render
+from django.utils.http import urlencode
 from mutopia.models import Piece, Composer, License, Style, Instrument
-from mutopia.models import Collection, AssetMap, LPVersion
-from mutopia.forms import KeySearchForm
-from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
-from mutopia.utils import FTP_URL
+from mutopia.models import Collection, AssetMap, LPVersion, PieceDetail
+from mutopia.forms import KeySearchForm, ListSearchForm
+from mutopia.query import SearchSyntaxError, qualifier, conjoin
+from mutopia.search import SearchTerm
+from mutopia.search_backends.base import QueryTimeout
+from mutopia.paging import KeysetPaginator
+from mutopia.changelog import change_log, log_url
+from mutopia.throttle import throttle
+from mutopia.cache import cached_page, conditional_page
+from mutopia.results import paginate_ids, search_error
 import os.path
-import requests
+import re
 
 
+def _listing(request, pieces, count, scope, value):
+    """Return the context for a page of a composer, style, or
+    instrument listing. If the request has keywords (``q``) the page
+    is of a search within the listing, which is a single index search
+    of the scoped documents (see :mod:`mutopia.query`). Otherwise the
+    listing is paged newest first by :mod:`mutopia.paging`.
+
+    :param Request request: The HTTP request object.
+    :param pieces: A Piece query set of the whole listing.
+    :param int count: The number of pieces in the listing.
+    :param str scope: The qualifier scoping a search, ``composer``,
+        ``style``, or ``instrument``.
+    :param str value: The value of the qualifier.
+    :return: A context with the ``pager`` and the search form.
+    :rtype: dict
+
+    """
+    form = ListSearchForm(request.GET)
+    query = form.cleaned_data['q'] if form.is_valid() else ''
+    page = request.GET.get('page')
+    context = {
+        'keyform': KeySearchForm(auto_id=False),
+        'listform': ListSearchForm(initial={'q': query}, auto_id=False),
+        'query': query,
+        'params': urlencode({'q': query}) if query else '',
+    }
+
+    if re.search(r'\w', query):
+        try:
+            keywords = conjoin(query, qualifier(scope, value))
+            context['pager'] = paginate_ids(SearchTerm.ranked_ids(keywords),
+                                            page)
+            return context
+        except SearchSyntaxError as err:
+            context['message'] = search_error(err)
+        except QueryTimeout:
+            context['message'] = 'This search took too long, try more words.'
+
+    paginator = KeysetPaginator(pieces.listing(), 25, count)
+    context['pager'] = paginator.page(request.GET)
+    return context
+
+
+@conditional_page(lambda piece_id: Piece.objects.filter(pk=piece_id))
+@cached_page
 def piece_info(request, piece_id):
     """Given a piece identifier, render a page with extended Piece
-    information.
+    information from its :class:`mutopia.models.PieceDetail`.
 
     :param Request request: The HTTP request object
     :param int piece_id: the identifier (primary key) for a specific Piece
@@ -23,48 +77,43 @@ def piece_info(request, piece_id):
 
     """
 
-    piece = get_object_or_404(Piece, pk=piece_id)
-
-    asset = AssetMap.objects.get(piece=piece_id)
-    preview_name = asset.name+'-preview'
-    if asset.uses_svg:
-        preview_name += '.svg'
-    else:
-        preview_name += '.png'
-    
+    piece = PieceDetail.lookup(piece_id)
+    if piece is None:
+        raise Http404('No such piece.')
     context = {
         'keyform': KeySearchForm(auto_id=False),
         'piece': piece,
-        'asset': asset,
-        'preview_image': '/'.join([FTP_URL,
-                                   asset.folder,
-                                   preview_name,]),
-        'instruments': piece.instruments.all(),
     }
-    collection = piece.collection_set.all()
-    if collection.count() > 0:
-        context['collection'] = collection[0]
     return render(request, 'mutopia/piece_info.html', context)
 
 
+@throttle('log_info')
 def log_info(request, piece_id):
-    """Display the GIT change log for a particular piece.
+    """Display the GIT change log for a particular piece. Logs are
+    cached (see :mod:`mutopia.changelog`) so the archive is rarely
+    asked for them.
 
     :param Request request: The HTTP request object
     :return: An HTML page containing the log information.
 
     """
 
-    asset = AssetMap.objects.get(piece=piece_id)
-    url = '/'.join([FTP_URL, asset.folder, asset.name+'.log',])
+    asset = get_object_or_404(AssetMap, piece=piece_id)
+    piece = PieceDetail.lookup(piece_id)
+    if piece is None:
+        raise Http404('No such piece.')
     context = {
         'keyform': KeySearchForm(auto_id=False),
-        'piece' : Piece.objects.get(pk=piece_id),
-        'logfile': requests.get(url),
+        'piece': piece,
+        'log': change_log(asset),
+        'log_url': log_url(asset),
     }
     return render(request, 'mutopia/piece_log.html', context)
 
 
+@conditional_page(lambda instrument:
+                  Piece.objects.filter(instruments__pk=instrument))
+@cached_page
 def piece_by_instrument(request, instrument):
     """Render one or more pages of pieces composed for the given instrument.
 
@@ -74,43 +123,29 @@ def piece_by_instrument(request, instrument):
 
     """
     pieces = Piece.objects.filter(instruments__pk=instrument)
-    paginator = Paginator(pieces, 25)
-    p = request.GET.get('page')
-    try:
-        page = paginator.page(p)
-    except PageNotAnInteger:
-        page = paginator.page(1)
-    except EmptyPage:
-        page = paginator.page(paginator.num_pages)
-
-    context = {
-        'keyform': KeySearchForm(auto_id=False),
-        'pager': page,
-        'instrument': instrument
-    }
+    count = (Instrument.objects.filter(pk=instrument)
+             .values_list('piece_count', flat=True).first())
+    context = _listing(request, pieces, count or 0, 'instrument', instrument)
+    context['instrument'] = instrument
     return render(request, 'mutopia/piece_instrument.html', context)
 
 
 
+@conditional_page(lambda: Piece.objects.all())
+@cached_page
 def latest_additions(request):
-    pieces = Piece.objects.order_by('-piece_id')
-    paginator = Paginator(pieces, 25)
-    p = request.GET.get('page')
-    try:
-        page = paginator.page(p)
-    except PageNotAnInteger:
-        page = paginator.page(1)
-    except EmptyPage:
-        page = paginator.page(paginator.num_pages)
-
+    count = Composer.objects.aggregate(Sum('piece_count'))['piece_count__sum']
+    paginator = KeysetPaginator(Piece.objects.listing(), 25, count or 0)
     context = {
         'keyform': KeySearchForm(auto_id=False),
-        'pager': page,
+        'pager': paginator.page(request.GET),
     }
 
     return render(request, 'mutopia/latest.html', context)
 
 
+@conditional_page(lambda slug: Piece.objects.filter(style__slug=slug))
+@cached_page
 def piece_by_style(request, slug):
     """Render one or more pages of pieces composed for the given
     style. Note that the `slug` of the piece is passed so that the
@@ -126,24 +161,16 @@ def piece_by_style(request, slug):
     # Uses a slug so that "Popular / Dance" looks like a sane URL
     style = Style.objects.get(slug=slug)
 
-    paginator = Paginator(Piece.objects.filter(style=style), 25)
-
-    p = request.GET.get('page')
-    try:
-        page = paginator.page(p)
-    except PageNotAnInteger:
-        page = paginator.page(1)
-    except EmptyPage:
-        page = paginator.page(paginator.num_pages)
-
-    context = {
-        'keyform': KeySearchForm(auto_id=False),
-        'pager': page,
-        'style': style
-    }
+    pieces = Piece.objects.filter(style=style)
+    context = _listing(request, pieces, style.piece_count,
+                       'style', style.style)
+    context['style'] = style
     return render(request, 'mutopia/piece_style.html', context)
 
 
+@conditional_page(lambda composer:
+                  Piece.objects.filter(composer=composer))
+@cached_page
 def piece_by_composer(request, composer):
     """Render one or more pages of pieces written by the given composer.
 
@@ -155,23 +182,16 @@ def piece_by_composer(request, composer):
     """
 
     comp = Composer.objects.get(pk=composer)
-    paginator = Paginator(Piece.objects.filter(composer=comp), 25)
-    p = request.GET.get('page')
-    try:
-        page = paginator.page(p)
-    except PageNotAnInteger:
-        page = paginator.page(1)
-    except EmptyPage:
-        page = paginator.page(paginator.num_pages)
-
-    context = {
-        'keyform': KeySearchForm(auto_id=False),
-        'pager': page,
-        'composer': comp.rawstr()
-    }
+    pieces = Piece.objects.filter(composer=comp)
+    context = _listing(request, pieces, comp.piece_count,
+                       'composer', comp.composer)
+    context['composer'] = comp.rawstr()
     return render(request, 'mutopia/piece_composer.html', context)
 
 
+@conditional_page(lambda version:
+                  Piece.objects.filter(version__version=version))
+@cached_page
 def piece_by_version(request, version):
     """Render one or more pages of pieces transcribed by the given
     LilyPond style.
@@ -183,23 +203,19 @@ def piece_by_version(request, version):
     """
 
     v = LPVersion.objects.get(version=version)
-    paginator = Paginator(Piece.objects.filter(version=v), 25)
-    p = request.GET.get('page')
-    try:
-        page = paginator.page(p)
-    except PageNotAnInteger:
-        page = paginator.page(1)
-    except EmptyPage:
-        page = paginator.page(paginator.num_pages)
-
+    paginator = KeysetPaginator(Piece.objects.listing().filter(version=v),
+                                25, v.piece_count)
     context = {
         'keyform': KeySearchForm(auto_id=False),
-        'pager': page,
+        'pager': paginator.page(request.GET),
         'version': version
     }
     return render(request, 'mutopia/piece_version.html', context)
 
 
+@conditional_page(lambda col_tag:
+                  Piece.objects.filter(collection__tag=col_tag))
+@cached_page
 def collection_list(request, col_tag):
     """Display the collection associated with the given tag.
 
@@ -212,6 +228,6 @@ def collection_list(request, col_tag):
     context = {
         'keyform': KeySearchForm(auto_id=False),
         'title': col.title,
-        'col_pieces': col.pieces.all()
+        'col_pieces': col.pieces.listing()
     }
     return render(request, 'mutopia/collection.html', context)
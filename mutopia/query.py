@@ -0,0 +1,514 @@
+"""
+.. module:: query
+   :platform: Linux
+   :synopsis: Parser and compiler for the search box query language
+
+.. moduleauthor:: Glen Larsen <glenl.glx@gmail.com>
+
+Searches typed by users are parsed into a small syntax tree before
+any database work is done so that malformed input is reported
+without a round trip. The language is,
+
+  - words, matched with FTS and implicitly AND'ed together::
+
+      bach violin
+
+  - ``&`` (and), ``|`` (or), ``!`` (not), and parentheses::
+
+      (sonata | partita) & !cello
+
+  - quoted phrases, matched as adjacent words::
+
+      "well tempered"
+
+  - qualifiers, matched against the catalogue relationships::
+
+      composer:BachJS instrument:violin style:baroque version:2.18
+      since:2017-01-31
+
+  - several instruments, all of which must be played::
+
+      instrument:violin,cello
+
+    or any of which may be::
+
+      instrument:violin | instrument:viola
+
+The tree compiles to a single SQL condition on ``mutopia_piece``
+(and the search table, if there are words or instruments to match) so
+that text and relational filters are applied in one statement.
+
+"""
+
+import datetime
+import re
+
+PIECE_TABLE = 'mutopia_piece'
+
+_TSQUERY = "to_tsquery('pg_catalog.simple', unaccent(%s))"
+
+# Search documents also hold a *scope* lexeme, such as
+# ``composer=bachjs``, for the composer, style and instruments of the
+# piece. Qualifiers on these in a conjunction with words are matched
+# as scope lexemes so that the words and the scope are a single GIN
+# index search of the document rather than a search and a filter.
+SCOPES = ('composer', 'style', 'instrument')
+_SCOPED_TSQUERY = '(' + _TSQUERY + ' && %s::tsquery)'
+
+# Each qualifier is compiled to a condition on mutopia_piece (or the
+# search table), the parameters are supplied by Qualifier.params().
+_QUALIFIERS = {
+    'composer': PIECE_TABLE + '.composer_id IN'
+                ' (SELECT composer FROM mutopia_composer'
+                ' WHERE lower(composer) = lower(%s))',
+    'instrument': '{table}.instruments @> %s::text[]',
+    'style': PIECE_TABLE + '.style_id IN'
+             ' (SELECT style FROM mutopia_style'
+             ' WHERE lower(style) = lower(%s) OR slug = lower(%s))',
+    'version': PIECE_TABLE + '.version_id IN'
+               ' (SELECT id FROM mutopia_lpversion'
+               ' WHERE version = %s OR version LIKE %s)',
+    'since': PIECE_TABLE + '.date_published >= %s',
+}
+
+# Only double quotes delimit phrases; an apostrophe (o'carolan,
+# don't) separates words like other punctuation.
+_TOKENS = re.compile(r'''
+    \s*(?:
+      (?P<qualifier>[A-Za-z]+):(?=["'\w])
+    | (?P<phrase>"[^"]*")
+    | (?P<quote>")
+    | (?P<op>[&|!()])
+    | (?P<word>\w+)
+    | (?P<other>\S)
+    )''', re.VERBOSE | re.UNICODE)
+
+_VALUE = re.compile(r'''"([^"]*)"|'([^']*)'|([\w.,\-/]+)''', re.UNICODE)
+
+
+class SearchSyntaxError(ValueError):
+    """Raised when a search cannot be parsed."""
+    pass
+
+
+class Term:
+    """A single word to be matched with FTS."""
+
+    def __init__(self, word):
+        self.word = word.lower()
+
+    def tsquery(self):
+        return self.word
+
+    def __str__(self):
+        return self.word
+
+
+class Phrase:
+    """Adjacent words to be matched with FTS."""
+
+    def __init__(self, words):
+        self.words = [w.lower() for w in words]
+
+    def tsquery(self):
+        return '(' + ' <-> '.join(self.words) + ')'
+
+    def __str__(self):
+        return '"' + ' '.join(self.words) + '"'
+
+
+class Qualifier:
+    """A condition on one of the catalogue relationships of a piece."""
+
+    def __init__(self, name, value):
+        if name not in _QUALIFIERS:
+            raise SearchSyntaxError('Unknown qualifier "{0}:"'.format(name))
+        if name == 'since':
+            try:
+                datetime.datetime.strptime(value, '%Y-%m-%d')
+            except ValueError:
+                raise SearchSyntaxError('Expected a date (YYYY-MM-DD)'
+                                        ' after "since:"')
+        self.name = name
+        self.value = value
+        if name == 'instrument':
+            self.instruments = [i.strip().lower() for i in value.split(',')
+                                if i.strip()]
+            if not self.instruments:
+                raise SearchSyntaxError('Expected an instrument after'
+                                        ' "instrument:"')
+
+    def params(self):
+        """Return the parameters for the compiled condition."""
+        if self.name == 'instrument':
+            return [self.instruments]
+        if self.name == 'style':
+            return [self.value, self.value]
+        if self.name == 'version':
+            return [self.value, _like_prefix(self.value + '.')]
+        return [self.value]
+
+    def scope_tsquery(self):
+        """Return a tsquery of the scope lexemes for the qualifier."""
+        if self.name == 'instrument':
+            values = self.instruments
+        else:
+            values = [self.value]
+        lexemes = [scope_lexeme(self.name, v) for v in values]
+        return ' & '.join(_quote_lexeme(lexeme) for lexeme in lexemes)
+
+    def __str__(self):
+        return '{0}:"{1}"'.format(self.name, self.value)
+
+
+class Not:
+    """Negation of a node."""
+
+    def __init__(self, node):
+        self.node = node
+
+    def tsquery(self):
+        return '!' + self.node.tsquery()
+
+    def __str__(self):
+        return '!' + str(self.node)
+
+
+class And:
+    """Conjunction of nodes."""
+
+    op = '&'
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+
+    def tsquery(self):
+        return '(' + ' & '.join(n.tsquery() for n in self.nodes) + ')'
+
+    def __str__(self):
+        return '(' + ' & '.join(str(n) for n in self.nodes) + ')'
+
+
+class Or(And):
+    """Disjunction of nodes."""
+
+    op = '|'
+
+    def tsquery(self):
+        return '(' + ' | '.join(n.tsquery() for n in self.nodes) + ')'
+
+    def __str__(self):
+        return '(' + ' | '.join(str(n) for n in self.nodes) + ')'
+
+
+def scope_lexeme(name, value):
+    """Return the lexeme that scopes search documents to a composer,
+    style, or instrument.
+
+    """
+    return '{0}={1}'.format(name, value.lower())
+
+
+def _quote_lexeme(lexeme):
+    """Quote a lexeme for tsquery input so it is used as-is."""
+    return "'" + lexeme.replace('\\', '\\\\').replace("'", "''") + "'"
+
+
+def _like_prefix(value):
+    """Escape a value for use as a LIKE prefix."""
+    return re.sub(r'([\\%_])', r'\\\1', value) + '%'
+
+
+def _tokenize(text):
+    tokens = []
+    pos = 0
+    while True:
+        match = _TOKENS.match(text, pos)
+        if match is None:
+            break
+        pos = match.end()
+        kind = match.lastgroup
+        if kind == 'other':
+            # Other punctuation separates words, as it always has.
+            continue
+        if kind == 'quote':
+            raise SearchSyntaxError('Unterminated quotation')
+        if kind == 'qualifier':
+            value = _VALUE.match(text, pos)
+            if value is None:
+                raise SearchSyntaxError('Unterminated quotation')
+            pos = value.end()
+            tokens.append(('qualifier',
+                           (match.group(kind).lower(),
+                            next(g for g in value.groups() if g is not None))))
+            continue
+        tokens.append((kind, match.group(kind)))
+    return tokens
+
+
+class _Parser:
+    """A recursive descent parser over the tokens of a query,
+
+      query   := or_expr
+      or_expr := and_expr ('|' and_expr)*
+      and_expr:= unary (['&'] unary)*
+      unary   := '!' unary | primary
+      primary := '(' or_expr ')' | phrase | qualifier | word
+
+    """
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, None)
+
+    def take(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def parse(self):
+        node = self.or_expr()
+        kind, value = self.peek()
+        if kind is not None:
+            raise SearchSyntaxError('Unexpected "{0}"'.format(value))
+        return node
+
+    def or_expr(self):
+        nodes = [self.and_expr()]
+        while self.peek() == ('op', '|'):
+            self.take()
+            nodes.append(self.and_expr())
+        return nodes[0] if len(nodes) == 1 else Or(nodes)
+
+    def and_expr(self):
+        nodes = [self.unary()]
+        while True:
+            kind, value = self.peek()
+            if (kind, value) == ('op', '&'):
+                self.take()
+            elif kind is None or value in ('|', ')'):
+                break
+            nodes.append(self.unary())
+        return nodes[0] if len(nodes) == 1 else And(nodes)
+
+    def unary(self):
+        if self.peek() == ('op', '!'):
+            self.take()
+            return Not(self.unary())
+        return self.primary()
+
+    def primary(self):
+        kind, value = self.take()
+        if (kind, value) == ('op', '('):
+            node = self.or_expr()
+            if self.take() != ('op', ')'):
+                raise SearchSyntaxError('Missing ")"')
+            return node
+        if kind == 'word':
+            return Term(value)
+        if kind == 'phrase':
+            words = re.findall(r'\w+', value, re.UNICODE)
+            if not words:
+                raise SearchSyntaxError('Empty quotation')
+            return Term(words[0]) if len(words) == 1 else Phrase(words)
+        if kind == 'qualifier':
+            return Qualifier(*value)
+        if kind is None:
+            raise SearchSyntaxError('Incomplete search')
+        raise SearchSyntaxError('Unexpected "{0}"'.format(value))
+
+
+def parse(text):
+    """Parse a search into a syntax tree.
+
+    :param str text: Input from the user.
+    :return: The root node, or None for an empty search.
+    :raises SearchSyntaxError: If the search is malformed.
+
+    """
+    tokens = _tokenize(text)
+    if not tokens:
+        return None
+    return _Parser(tokens).parse()
+
+
+def qualifier(name, value):
+    """Format a qualifier for inclusion in a search string, removing
+    any quotes from the value.
+
+    """
+    return '{0}:"{1}"'.format(name, re.sub('["\']', '', value))
+
+
+def conjoin(*searches):
+    """Combine searches that must all match. Each is parsed on its own
+    so none can change the meaning of the others, as ``rag) | (waltz``
+    would if searches were simply joined in parentheses.
+
+    :param searches: Input from the user or :func:`qualifier` strings.
+        Empty searches are ignored.
+    :return: The combined search, or an empty string.
+    :rtype: str
+    :raises SearchSyntaxError: If a search is malformed.
+
+    """
+    nodes = [node for node in map(parse, searches) if node is not None]
+    if not nodes:
+        return ''
+    return str(nodes[0] if len(nodes) == 1 else And(nodes))
+
+
+def is_text(node):
+    """True if the node contains only FTS terms."""
+    if isinstance(node, (Term, Phrase)):
+        return True
+    if isinstance(node, Not):
+        return is_text(node.node)
+    if isinstance(node, And):
+        return all(is_text(n) for n in node.nodes)
+    return False
+
+
+def uses_search_table(node):
+    """True if any part of the node is matched against the search
+    table, either with FTS or by instrument.
+
+    """
+    if isinstance(node, (Term, Phrase)):
+        return True
+    if isinstance(node, Qualifier):
+        return node.name == 'instrument'
+    if isinstance(node, Not):
+        return uses_search_table(node.node)
+    return any(uses_search_table(n) for n in node.nodes)
+
+
+def _is_instrument(node):
+    return isinstance(node, Qualifier) and node.name == 'instrument'
+
+
+def _is_scope(node):
+    return isinstance(node, Qualifier) and node.name in SCOPES
+
+
+def split_words(node):
+    """Split a search that is a conjunction of words, phrases, and
+    qualifiers into its words and qualifiers.
+
+    :return: A tuple of the list of words and the list of
+        :class:`Qualifier` nodes, or None if the search uses any
+        other operators.
+
+    """
+    nodes = node.nodes if type(node) is And else [node]
+    words = []
+    qualifiers = []
+    for n in nodes:
+        if isinstance(n, Term):
+            words.append(n.word)
+        elif isinstance(n, Phrase):
+            words.extend(n.words)
+        elif isinstance(n, Qualifier):
+            qualifiers.append(n)
+        else:
+            return None
+    return (words, qualifiers)
+
+
+def map_words(node, fn):
+    """Return a copy of a syntax tree with each word of its terms and
+    phrases replaced by ``fn(word)``.
+
+    """
+    if isinstance(node, Term):
+        return Term(fn(node.word))
+    if isinstance(node, Phrase):
+        return Phrase([fn(w) for w in node.words])
+    if isinstance(node, Not):
+        return Not(map_words(node.node, fn))
+    if isinstance(node, And):
+        return type(node)([map_words(n, fn) for n in node.nodes])
+    return node
+
+
+def compile_where(node, table):
+    """Compile a syntax tree into a SQL condition.
+
+    Sub-trees containing only words are compiled to a single FTS
+    match on the search document so that they are served by its GIN
+    index. The composer, style and instrument qualifiers of a
+    conjunction with words join that match as scope lexemes. Other
+    instruments of a conjunction are compiled to a single array
+    containment (``@>``), and single instruments of a disjunction to a
+    single array overlap (``&&``), both served by the GIN index on the instruments
+    of the search table.
+
+    :param node: The root of a syntax tree.
+    :param str table: The name of the search table.
+    :return: A tuple of the SQL condition and its parameters.
+
+    """
+    if is_text(node):
+        return (table + '.document @@ ' + _TSQUERY, [node.tsquery()])
+    if isinstance(node, Qualifier):
+        return (_QUALIFIERS[node.name].format(table=table), node.params())
+    if isinstance(node, Not):
+        sql, params = compile_where(node.node, table)
+        return ('NOT (' + sql + ')', params)
+
+    parts = []
+    nodes = node.nodes
+    text = [n for n in nodes if is_text(n)]
+    if text and not isinstance(node, Or) and any(map(_is_scope, nodes)):
+        # Search for the words within the scope.
+        scopes = [n for n in nodes if _is_scope(n)]
+        nodes = [n for n in nodes if not is_text(n) and not _is_scope(n)]
+        words = text[0] if len(text) == 1 else And(text)
+        parts.append((table + '.document @@ ' + _SCOPED_TSQUERY,
+                      [words.tsquery(),
+                       ' & '.join(n.scope_tsquery() for n in scopes)]))
+    grouped = []
+    instruments = [n for n in nodes if _is_instrument(n)]
+    if isinstance(node, Or):
+        # A qualifier naming several instruments means all of them,
+        # so only single instruments can join an overlap.
+        instruments = [n for n in instruments if len(n.instruments) == 1]
+    if len(instruments) > 1:
+        nodes = [n for n in nodes if n not in instruments]
+        op = '&&' if isinstance(node, Or) else '@>'
+        values = sorted(set(i for n in instruments for i in n.instruments))
+        grouped.append(('{0}.instruments {1} %s::text[]'.format(table, op),
+                        [values]))
+    if not isinstance(node, Or):
+        # AND the words of a conjunction into one tsquery.
+        text = [n for n in nodes if is_text(n)]
+        if len(text) > 1:
+            nodes = [And(text)] + [n for n in nodes if not is_text(n)]
+    parts += [compile_where(n, table) for n in nodes] + grouped
+    if len(parts) == 1:
+        return parts[0]
+    joiner = ' OR ' if isinstance(node, Or) else ' AND '
+    sql = '(' + joiner.join(p[0] for p in parts) + ')'
+    params = [param for p in parts for param in p[1]]
+    return (sql, params)
+
+
+def rank_tsquery(node):
+    """Return a tsquery of the positive text of a search, used for
+    ranking the results, or None if there is nothing to rank.
+
+    """
+    if isinstance(node, (Term, Phrase)):
+        return node.tsquery()
+    if isinstance(node, And):
+        terms = [rank_tsquery(n) for n in node.nodes]
+        terms = [t for t in terms if t is not None]
+        if not terms:
+            return None
+        return '(' + (' ' + node.op + ' ').join(terms) + ')'
+    return None
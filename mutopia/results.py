@@ -0,0 +1,48 @@
+"""
+.. module:: results
+   :platform: Linux
+   :synopsis: Presentation of search results shared by the views
+
+.. moduleauthor:: Glen Larsen <glenl.glx@gmail.com>
+
+"""
+
+from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
+from mutopia.models import Piece
+from mutopia.query import SearchSyntaxError
+
+
+def paginate_ids(ids, page, per_page=25):
+    """Paginate a list of piece identifiers, fetching only the pieces
+    on the requested page.
+
+    :param list ids: Piece identifiers in presentation order.
+    :param page: The requested page number, possibly None or invalid.
+    :param int per_page: Number of pieces on a page.
+    :return: A page whose object list holds the pieces.
+    :rtype: Page
+
+    """
+    paginator = Paginator(ids, per_page)
+    try:
+        pager = paginator.page(page)
+    except PageNotAnInteger:
+        # typically the first page of results
+        pager = paginator.page(1)
+    except EmptyPage:
+        pager = paginator.page(paginator.num_pages)
+
+    pieces = Piece.objects.listing().in_bulk(pager.object_list)
+    pager.object_list = [pieces[pk] for pk in pager.object_list
+                         if pk in pieces]
+    return pager
+
+
+def search_error(err):
+    """Return a message for a search that failed with the given
+    exception.
+
+    """
+    if isinstance(err, SearchSyntaxError):
+        return 'Unable to parse search: {0}'.format(err)
+    return 'Unable to parse keywords search terms'
@@ -9,7 +9,7 @@ class LatestEntriesFeed(Feed):
     description = 'Updated and new pieces in the archive'
 
     def items(self):
-        return Piece.objects.order_by('-date_published')[:10]
+        return Piece.objects.listing().order_by('-date_published')[:10]
 
     def item_title(self, piece):
         return '{0}, {1}'.format(piece.title, piece.composer.byline())
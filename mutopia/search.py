@@ -6,146 +6,610 @@ models. The functionality was moved here to make it easier to support
 test routines for our FTS implementation.
 
 There is no FTS support in django but it can be made to work with a
-model that shadows a postgres materialized view built to contain
-search terms in a specially constructed document.
+model that shadows a postgres table built to contain search terms in
+a specially constructed document. The search itself is done by the
+backend selected in the settings (see :mod:`mutopia.search_backends`)
+so that FTS does not require Postgres.
+
+The search index is maintained incrementally: signal handlers at the
+bottom of this module re-index only the pieces affected by a change
+to a :class:`mutopia.models.Piece` (or its instruments),
+:class:`mutopia.models.Composer`, :class:`mutopia.models.Contributor`,
+:class:`mutopia.models.LPVersion`, or an instrument synonym in
+:class:`update.models.InstrumentMap`.
 
 .. moduleauthor:: Glen Larsen, glenl.glx at gmail.com
 
 """
+import logging
 import re
-import string
-from django.db import connection
+import time
+import unicodedata
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DatabaseError
 from django.db import models
-from mutopia.models import Piece
-
-MV_NAME = 'mutopia_search_view'
-MV_INDEX_NAME = 'mutopia_search_index'
-MV_DROP = 'DROP MATERIALIZED VIEW IF EXISTS {0}'
-MV_CREATE = """
-CREATE MATERIALIZED VIEW {0}
-(id, piece_id, document)
-AS SELECT
-    p.piece_id,
-    p.piece_id,
-    (to_tsvector('pg_catalog.simple',
-        concat_ws(' ', unaccent(p.title),
-            unaccent(c.description),
-            unaccent(p.opus),
-            p.style_id,
-            unaccent(p.raw_instrument),
-            unaccent(p.lyricist),
-            unaccent(p.source),
-            unaccent(m.name),
-            p.date_composed,
-            unaccent(p.moreinfo),
-            v.version)
-        )) AS document
-    FROM "mutopia_piece" as p
-    JOIN "mutopia_lpversion" AS v ON v.id = p.version_id
-    JOIN "mutopia_composer" AS c ON c.composer = p.composer_id
-    JOIN "mutopia_contributor" AS m ON m.id = p.maintainer_id
-"""
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.db.models.signals import m2m_changed
+from django.dispatch import receiver
+from mutopia.models import Piece, Composer, Contributor, LPVersion
+from mutopia.models import Instrument
+from mutopia.cache import LRUCache, catalogue_generation
+from mutopia.query import parse, split_words, map_words, And
+from mutopia.search_backends import get_backend
+from mutopia.search_backends.base import FACETS, QueryTimeout, highlight
+from mutopia.search_backends.postgres import ST_NAME
+from mutopia.spelling import Vocabulary
+
+logger = logging.getLogger(__name__)
+
+# Rate limits the EXPLAIN of slow searches across processes.
+SLOW_EXPLAIN_KEY = 'mutopia:slow-search-explain'
+
+# Suggestions are also invalidated by the catalogue generation so this
+# only limits how long unused entries linger.
+SUGGEST_TIMEOUT = 60 * 60
+
+# Similar pieces beyond this many are not worth showing.
+SIMILAR_LIMIT = 200
+
+# Searches list at most this many pieces (40 pages of results). Only
+# their identifiers are fetched, but every page of a search that is
+# not cached fetches them all so that later pages come from the cache.
+RESULT_LIMIT = 1000
+
+# Counts of searches cancelled by their statement timeout, by class.
+TIMEOUT_KEY = 'mutopia:search-timeouts:{0}'
+
+# Ranked results of recent searches, keyed on the catalogue generation,
+# the parsed query and any filters. The last results of each search
+# are also kept, whatever the generation, for searches that time out.
+_search_cache = LRUCache(settings.SEARCH_CACHE_SIZE)
+
+# The words of the search index for spelling corrections, with the
+# catalogue generation they were loaded for.
+_vocabulary = {}
+
+
+def search_cache_stats():
+    """Return the hit and miss counts of this process's search cache."""
+    return _search_cache.stats()
+
+
+def timeout_count(query_class):
+    """Return the number of searches of a query class (see the
+    ``SEARCH_TIMEOUTS`` setting) that were cancelled.
+
+    """
+    return cache.get(TIMEOUT_KEY.format(query_class), 0)
 
-MV_INDEX_DROP = 'DROP INDEX IF EXISTS {0}'
-MV_INDEX_CREATE = 'CREATE INDEX {0} ON {1} USING GIN(document)'
-MV_REFRESH = 'REFRESH MATERIALIZED VIEW {0}'
 
-# FTS is not supported directly in Django so we are going to execute a
-# manual query. This is a format string that is designed to be filled
-# in by a keyword sanitized to form the query.
-_PG_FTSQ = ' '.join([ "SELECT piece_id FROM",
-                      MV_NAME,
-                      "WHERE document @@ to_tsquery('pg_catalog.simple', unaccent(%s))"])
+@contextmanager
+def _timeout(query_class, keywords):
+    """Run backend queries with the statement timeout of their class,
+    counting and logging those that are cancelled.
+
+    """
+    try:
+        with get_backend().statement_timeout(
+                settings.SEARCH_TIMEOUTS.get(query_class)):
+            yield
+    except QueryTimeout:
+        key = TIMEOUT_KEY.format(query_class)
+        cache.add(key, 0, None)
+        cache.incr(key)
+        logger.warning('Search timed out (%s): "%s"', query_class, keywords)
+        raise
+
 
 class SearchTerm(models.Model):
-    """A model to shadow a Postgres materialized view containing a
-    document containing search terms associated with the given
-    :class:`mutopia.models.Piece`.
+    """A model to shadow a Postgres table containing a document
+    containing search terms associated with the given
+    :class:`mutopia.models.Piece`. The class methods search with the
+    configured backend, which need not use this table.
 
-    The shadowed table should be refreshed after any updates.
+    Rows are kept current by the signal handlers in this module so
+    an update costs time in proportion to what changed.
 
     """
 
     #:The target piece for this search document.
-    piece_id = models.ForeignKey(Piece)
+    piece = models.OneToOneField(Piece, models.CASCADE, db_column='piece_id')
 
     #:The search document for FTS
     document = models.TextField()
 
     class Meta:
-        db_table = MV_NAME
+        db_table = ST_NAME
         managed = False
 
     @classmethod
     def rebuild_view(cls):
-        """Drop and re-create the materialized view and its index."""
+        """Re-create the search index for the entire catalogue. This is
+        the full-reindex fallback. Searches continue against the
+        previous index until the new one is complete. Pieces saved
+        while the build is running may be missed; :meth:`refresh_view`
+        will pick them up.
+
+        """
 
-        cursor = connection.cursor()
-        cursor.execute(MV_DROP.format(MV_NAME))
-        cursor.execute(MV_CREATE.format(MV_NAME))
-        cursor.execute(MV_INDEX_DROP.format(MV_INDEX_NAME))
-        cursor.execute(MV_INDEX_CREATE.format(MV_INDEX_NAME, MV_NAME))
+        get_backend().rebuild()
+        _vocabulary.clear()
 
     @classmethod
     def refresh_view(cls):
-        """Refresh the associated view.
+        """Re-index every piece in place.
 
-        After updates and inserts, the materialized view needs to be
-        refreshed. We could do this with a trigger but for now it is
-        simple enough to do it from this class method after processing
-        submissions.
+        The search index is normally maintained a piece at a time as
+        models are saved so this should only be necessary after bulk
+        changes that bypass the ORM.
 
         """
 
-        cursor = connection.cursor()
-        cursor.execute(MV_REFRESH.format(MV_NAME))
+        get_backend().reindex()
+        _vocabulary.clear()
 
     @classmethod
-    def _sanitize(cls, term):
-        """Sanitize input to the search routine.
+    def reindex(cls, pieces):
+        """Re-build the search documents for a subset of pieces.
 
-        :param str term: Input string to clean.
-        :return: A sanitized string, ready for FTS.
+        :param pieces: A Piece query set of the pieces to re-index.
 
         """
-        # Replace all puncuation with spaces.
-        allowed_punctuation = set(['&', '|', '"', "'", '!'])
-        all_punctuation = set(string.punctuation)
-        punctuation = ''.join(all_punctuation - allowed_punctuation)
-        term = re.sub(r'[{}]+'.format(re.escape(punctuation)), ' ', term)
-
-        # Substitute all double quotes to single quotes.
-        term = term.replace('"', "'")
-        term = re.sub(r"'+", "'", term)
-
-        # if no special characters, and search terms together.
-        if not re.search('[&|!]', term):
-            term = re.sub(r'\s+', ' & ', term)
-
-        return term
 
+        get_backend().reindex(pieces)
 
     @classmethod
     def search(cls, keywords):
-        """Given keyword string, search using FTS. Because FTS is not a
-        supported feature of django, it is faked here by using a
-        manual query that returns :class:`mutopia.models.Piece` keys.
+        """Given keyword string, search using FTS with the configured
+        backend (see :mod:`mutopia.search_backends`). The results are
+        ordered by rank, title and composer matches ranking above
+        those in the source or other information.
+
+        The keywords are parsed with :func:`mutopia.query.parse` so
+        they may include operators, phrases, and qualifiers such as
+        ``composer:BachJS``. The query set is not limited; the views
+        use :meth:`ranked_ids`, which is.
 
         :param str keywords: Input from the user
-        :return: Zero or more Pieces.
+        :return: Zero or more Pieces, with only the columns needed to
+            list them.
         :rtype: A Piece query set.
+        :raises mutopia.query.SearchSyntaxError: If the keywords
+            cannot be parsed.
+
+        """
+
+        node = parse(keywords)
+        if node is None:
+            return Piece.objects.none()
+        return get_backend().search(node).listing()
+
+    @classmethod
+    def ranked_ids(cls, keywords, **filters):
+        """Return the identifiers of matching pieces in rank order, at
+        most ``RESULT_LIMIT`` of them.
+
+        Results are cached until the catalogue changes so repeated
+        searches, and the other pages of a search, do not return to
+        the database. Without keywords, all pieces are matched, newest
+        first.
+
+        :param str keywords: Input from the user, may be empty.
+        :param filters: Keyword arguments for filtering the Piece
+            query set, for example ``composer='BachJS'``.
+        :return: Piece identifiers.
+        :rtype: list
+        :raises mutopia.query.SearchSyntaxError: If the keywords
+            cannot be parsed.
+        :raises mutopia.search_backends.base.QueryTimeout: If the
+            search runs longer than ``SEARCH_TIMEOUTS['search']``.
 
         """
 
-        terms = cls._sanitize(keywords)
-        cursor = connection.cursor()
-        results = []
+        node = parse(keywords)
+        filter_key = tuple(sorted(filters.items()))
+        key = (catalogue_generation(), str(node), filter_key)
+        ids = _search_cache.get(key)
+        if ids is None:
+            with _timeout('search', keywords):
+                if node is not None:
+                    ids = get_backend().ids(node, limit=RESULT_LIMIT,
+                                            **filters)
+                else:
+                    query = Piece.objects.order_by('-piece_id')
+                    query = query.filter(**filters)
+                    ids = list(query.values_list('piece_id',
+                                                 flat=True)[:RESULT_LIMIT])
+            _search_cache.set(key, ids)
+            _search_cache.set(('stale', str(node), filter_key), ids)
+        return ids
+
+    @classmethod
+    def stale_ids(cls, keywords, **filters):
+        """Return the results of the last successful :meth:`ranked_ids`
+        for a search in this process, whatever the catalogue generation.
+        This is a fallback for searches that time out.
+
+        :param str keywords: Input from the user, may be empty.
+        :param filters: As for :meth:`ranked_ids`.
+        :return: Piece identifiers, or None if the search has not
+            succeeded in this process.
+
+        """
+
+        node = parse(keywords)
+        return _search_cache.get(('stale', str(node),
+                                  tuple(sorted(filters.items()))))
+
+    @classmethod
+    def similar_ids(cls, keywords, **filters):
+        """Return the identifiers of pieces whose title or composer is
+        similar to the keywords, most similar first. This is intended
+        as a fallback for keyword searches that find nothing, most
+        often because of a misspelling ("Beethovan", "Shubert").
+
+        Matching is done by the search backend, the Postgres backend
+        uses trigram word similarity. Only words and phrases are matched
+        for similarity, qualifiers restrict the results as they do in
+        :meth:`search` and searches using other operators are not
+        matched. Results are cached like those of :meth:`ranked_ids`.
+
+        :param str keywords: Input from the user.
+        :param filters: Keyword arguments for filtering the Piece
+            query set.
+        :return: Piece identifiers.
+        :rtype: list
+
+        """
+
+        node = parse(keywords)
+        parts = split_words(node) if node is not None else None
+        if not parts or not parts[0]:
+            return []
+        words = ' '.join(parts[0])
+        qualifiers = And(parts[1]) if parts[1] else None
+
+        key = (catalogue_generation(), 'similar', str(node),
+               tuple(sorted(filters.items())))
+        ids = _search_cache.get(key)
+        if ids is None:
+            backend = get_backend()
+            with _timeout('similar', keywords):
+                ids = backend.similar(words, SIMILAR_LIMIT)
+                if (filters or qualifiers) and ids:
+                    if qualifiers:
+                        keep = backend.ids(qualifiers, pk__in=ids, **filters)
+                    else:
+                        query = Piece.objects.filter(pk__in=ids, **filters)
+                        keep = query.values_list('piece_id', flat=True)
+                    keep = set(keep)
+                    ids = [pk for pk in ids if pk in keep]
+            _search_cache.set(key, ids)
+        return ids
+
+    @classmethod
+    def explain(cls, keywords):
+        """Return the plan of the query for a search, as reported by
+        the search backend. The Postgres backend reports ``EXPLAIN
+        (ANALYZE, BUFFERS)``, running the query to get the actual
+        timings and buffer usage.
+
+        :param str keywords: Input from the user.
+        :return: The plan, one line per node.
+        :rtype: str
+
+        """
+
+        node = parse(keywords)
+        if node is None:
+            return ''
+        return get_backend().explain(node)
+
+    @classmethod
+    def headlines(cls, keywords, ids):
+        """Return snippets of the title, source and other information
+        of some pieces with the words matched by the search marked.
+        This is intended for one page of results so the cost does not
+        grow with the number of matches; snippets are cached by page.
+
+        :param str keywords: Input from the user.
+        :param list ids: Identifiers of the pieces on the page.
+        :return: Safe HTML snippets keyed by piece identifier. Pieces
+            without a match in their text have no snippet.
+        :rtype: dict
+
+        """
+
+        node = parse(keywords)
+        if node is None or not ids:
+            return {}
+        key = (catalogue_generation(), 'headlines', str(node), tuple(ids))
+        headlines = _search_cache.get(key)
+        if headlines is None:
+            with _timeout('headlines', keywords):
+                headlines = get_backend().headlines(node, ids)
+            headlines = {pk: highlight(text)
+                         for pk, text in headlines.items()}
+            _search_cache.set(key, headlines)
+        return headlines
+
+    @classmethod
+    def facets(cls, keywords, similar=False):
+        """Return counts of the matching pieces by composer, style,
+        instrument, and LilyPond version so a search can be narrowed
+        without starting over.
+
+        The counts are made by the search backend, with a single
+        ``GROUPING SETS`` query for Postgres, and are cached alongside
+        the results.
+
+        :param str keywords: Input from the user, may be empty.
+        :param bool similar: Count the pieces of :meth:`similar_ids`
+            rather than :meth:`ranked_ids`.
+        :return: A dictionary keyed by the names in :data:`FACETS`,
+            each a list of ``value``, ``label`` and ``count``
+            dictionaries, largest count first.
+        :rtype: dict
+
+        """
+
+        key = (catalogue_generation(), 'facets', similar,
+               str(parse(keywords)))
+        facets = _search_cache.get(key)
+        if facets is None:
+            if similar:
+                ids = cls.similar_ids(keywords)
+            else:
+                ids = cls.ranked_ids(keywords)
+            with _timeout('facets', keywords):
+                facets = get_backend().facets(ids)
+            _search_cache.set(key, facets)
+        return facets
+
+
+class SearchTimer:
+    """Record the time spent in each phase of handling a search, for
+    example::
+
+        timer = SearchTimer()
+        with timer.phase('search'):
+            ids = SearchTerm.ranked_ids(keywords)
+
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        """Time the enclosed block as the named phase."""
+        start = time.time()
         try:
-            cursor.execute(_PG_FTSQ, [terms,])
-            results = [row[0] for row in cursor.fetchall()]
+            yield
         finally:
-            cursor.close()
+            self.phases.append((name, time.time() - start))
+
+    def elapsed(self):
+        """Return the seconds since the timer was created."""
+        return time.time() - self.start
+
+    def __str__(self):
+        return ', '.join('{0} {1:.3f}s'.format(name, seconds)
+                         for name, seconds in self.phases)
+
+
+def log_slow_search(keywords, timer, explain=True):
+    """Log a search that took longer than ``SLOW_SEARCH_SECONDS``
+    with its phase timings. The plan of the search query is logged
+    too, but only once in ``SLOW_SEARCH_EXPLAIN_INTERVAL`` seconds
+    (across all processes) since it runs the query again, under the
+    ``search`` statement timeout.
+
+    :param str keywords: The (valid) search.
+    :param SearchTimer timer: Timings of the search.
+    :param bool explain: False to skip the plan, for a search that
+        already timed out.
+    :return: True if the search was slow.
+
+    """
+    elapsed = timer.elapsed()
+    if elapsed < settings.SLOW_SEARCH_SECONDS:
+        return False
+
+    query = str(parse(keywords))
+    logger.warning('Slow search (%.3fs) for %s: %s', elapsed, query, timer)
+    if explain and cache.add(SLOW_EXPLAIN_KEY, True,
+                             settings.SLOW_SEARCH_EXPLAIN_INTERVAL):
+        try:
+            with get_backend().statement_timeout(
+                    settings.SEARCH_TIMEOUTS.get('search')):
+                plan = SearchTerm.explain(keywords)
+            logger.warning('Plan for %s:\n%s', query, plan)
+        except (DatabaseError, QueryTimeout):
+            logger.exception('Unable to explain search for %s', query)
+    return True
+
+
+def vocabulary():
+    """Return the :class:`mutopia.spelling.Vocabulary` of the search
+    index, loaded from the backend once per catalogue generation and
+    kept by the process.
+
+    """
+    generation = catalogue_generation()
+    if _vocabulary.get('generation') != generation:
+        _vocabulary['words'] = Vocabulary(get_backend().vocabulary())
+        _vocabulary['generation'] = generation
+    return _vocabulary['words']
+
+
+def did_you_mean(keywords):
+    """Suggest a correction of a search, replacing words that are not
+    in the search index with the nearest indexed words. Qualifiers and
+    operators are kept. This is intended for searches that find
+    nothing and does not return to the database once the vocabulary
+    is loaded.
+
+    :param str keywords: Input from the user.
+    :return: The corrected search, or None if no word was corrected.
+    :rtype: str
+
+    """
+    node = parse(keywords)
+    if node is None:
+        return None
+    words = vocabulary()
+    corrected = map_words(node, lambda w: words.correct(_fold(w)) or w)
+    if str(corrected) == str(node):
+        return None
+    return str(corrected)
+
+
+def _fold(text):
+    """Lower-case text and strip its accents for prefix matching."""
+    decomposed = unicodedata.normalize('NFKD', text)
+    return ''.join(c for c in decomposed
+                   if not unicodedata.combining(c)).lower()
+
+
+def _prefix_match(prefixes, text):
+    """True if every prefix starts some word of the (folded) text."""
+    words = re.findall(r'\w+', text)
+    return all(any(w.startswith(p) for w in words) for p in prefixes)
+
+
+def _suggest_names():
+    """Return the composer and instrument names used for suggestions,
+    cached for the current catalogue generation.
+
+    """
+    key = 'mutopia:suggest-names:{0}'.format(catalogue_generation())
+    names = cache.get(key)
+    if names is None:
+        names = {
+            'composers': [(c.composer, c.rawstr(), _fold(c.description))
+                          for c in Composer.objects.all()],
+            'instruments': [(i.instrument, _fold(i.instrument))
+                            for i in Instrument.objects.filter(in_mutopia=True)],
+        }
+        cache.set(key, names, SUGGEST_TIMEOUT)
+    return names
+
+
+def suggest(prefix, limit=8):
+    """Suggest titles, composers, and instruments for a partially
+    typed search. Every word in the prefix must begin a word in the
+    suggestion. Titles are found by the search backend in the title
+    and composer text of its documents.
+
+    Suggestions are cached per catalogue generation.
+
+    :param str prefix: The text typed so far.
+    :param int limit: Maximum suggestions of each kind.
+    :return: A dictionary of ``titles``, ``composers`` and
+        ``instruments`` suggestions, suitable for JSON.
+    :rtype: dict
+
+    """
+    prefixes = [_fold(w) for w in re.findall(r'\w+', prefix)]
+    result = {'titles': [], 'composers': [], 'instruments': []}
+    if not prefixes:
+        return result
+
+    key = 'mutopia:suggest:{0}:{1}:{2}'.format(catalogue_generation(),
+                                               limit,
+                                               ' '.join(prefixes))
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+
+    pieces = get_backend().titles(prefixes, limit)
+    result['titles'] = [{'id': pk, 'title': title} for pk, title in pieces]
+
+    names = _suggest_names()
+    for composer, name, folded in names['composers']:
+        if len(result['composers']) >= limit:
+            break
+        if _prefix_match(prefixes, folded):
+            result['composers'].append({'composer': composer, 'name': name})
+    for instrument, folded in names['instruments']:
+        if len(result['instruments']) >= limit:
+            break
+        if _prefix_match(prefixes, folded):
+            result['instruments'].append(instrument)
+
+    cache.set(key, result, SUGGEST_TIMEOUT)
+    return result
+
+
+# Signal handlers to keep the search table current. Each re-indexes
+# only the pieces that reference the changed row.
+
+@receiver(post_save, sender=Piece)
+def _index_piece(sender, instance, **kwargs):
+    SearchTerm.reindex(Piece.objects.filter(pk=instance.pk))
+
+
+@receiver(post_delete, sender=Piece)
+def _unindex_piece(sender, instance, **kwargs):
+    get_backend().remove([instance.pk])
+
+
+@receiver(post_save, sender=Composer)
+def _index_composer(sender, instance, **kwargs):
+    SearchTerm.reindex(Piece.objects.filter(composer=instance))
+
+
+@receiver(post_save, sender=Contributor)
+def _index_contributor(sender, instance, **kwargs):
+    SearchTerm.reindex(Piece.objects.filter(maintainer=instance))
+
+
+@receiver(post_save, sender=LPVersion)
+def _index_version(sender, instance, **kwargs):
+    SearchTerm.reindex(Piece.objects.filter(version=instance))
+
+
+@receiver(m2m_changed, sender=Piece.instruments.through)
+def _index_instruments(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse and action == 'pre_clear':
+        # An instrument removed from all its pieces, which are only
+        # known before they are cleared.
+        instance._cleared_pieces = list(
+            instance.piece_set.values_list('pk', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        SearchTerm.reindex(Piece.objects.filter(pk=instance.pk))
+    elif action == 'post_clear':
+        pk_set = getattr(instance, '_cleared_pieces', None)
+        if pk_set:
+            SearchTerm.reindex(Piece.objects.filter(pk__in=pk_set))
+    elif pk_set:
+        # Instruments added to or removed from pieces
+        SearchTerm.reindex(Piece.objects.filter(pk__in=pk_set))
+
+
+# Instrument names mapped by update.InstrumentMap are indexed as
+# synonyms of the instrument.
+
+@receiver(pre_save, sender='update.InstrumentMap')
+def _note_instrument_map(sender, instance, **kwargs):
+    # A name mapped to another instrument is removed from the pieces of
+    # the one it was mapped to, which is only known before the save.
+    instance._previous_instrument = sender.objects.filter(
+        pk=instance.pk).values_list('instrument', flat=True).first()
+
 
-        # The results from manual queries do not return true QuerySets
-        # so these are translated for the caller with a filter.
-        return Piece.objects.filter(pk__in=results).order_by('-piece_id')
+@receiver(post_save, sender='update.InstrumentMap')
+@receiver(post_delete, sender='update.InstrumentMap')
+def _index_instrument_map(sender, instance, **kwargs):
+    instruments = {instance.instrument_id,
+                   getattr(instance, '_previous_instrument', None)}
+    instruments.discard(None)
+    SearchTerm.reindex(
+        Piece.objects.filter(instruments__in=instruments).distinct())
@@ -0,0 +1,32 @@
+"""
+.. module:: search_backends
+   :platform: Linux
+   :synopsis: Full text search implementations
+
+The search implementation used by :class:`mutopia.search.SearchTerm`
+is selected by the ``SEARCH_BACKEND`` setting, the dotted path of a
+:class:`mutopia.search_backends.base.SearchBackend` subclass,
+
+  - ``mutopia.search_backends.postgres.PostgresBackend`` (the default)
+    keeps a search table in the site database.
+
+  - ``mutopia.search_backends.sqlite.SQLiteBackend`` keeps an FTS5
+    index in a local file (``SEARCH_SQLITE_PATH``), for development
+    and read-only mirrors.
+
+"""
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+_backends = {}
+
+
+def get_backend():
+    """Return the search backend named in the settings."""
+    path = settings.SEARCH_BACKEND
+    backend = _backends.get(path)
+    if backend is None:
+        backend = import_string(path)()
+        _backends[path] = backend
+    return backend
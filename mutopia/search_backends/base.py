@@ -0,0 +1,192 @@
+"""
+.. module:: search_backends.base
+   :platform: Linux
+   :synopsis: The interface to a full text search implementation
+
+"""
+
+from contextlib import contextmanager
+from django.db.models import Count
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+from mutopia.models import Piece
+
+#:The facets returned by :meth:`SearchBackend.facets`, named by the
+#:qualifier used to narrow a search.
+FACETS = ('composer', 'style', 'instrument', 'version')
+
+# Backends delimit the matches in headlines with these characters,
+# which are replaced by markup after the text is escaped.
+START_SEL = '\x02'
+STOP_SEL = '\x03'
+
+
+class QueryTimeout(Exception):
+    """Raised when a search query runs longer than its statement
+    timeout and is cancelled.
+
+    """
+    pass
+
+
+class SearchBackend:
+    """A full text search implementation. Searches are given as the
+    syntax tree returned by :func:`mutopia.query.parse`; pieces are
+    given as Piece query sets.
+
+    """
+
+    @contextmanager
+    def statement_timeout(self, milliseconds):
+        """Limit the run time of each query made inside the context,
+        raising :class:`QueryTimeout` if one is cancelled. Backends
+        that cannot cancel queries do not limit them.
+
+        :param int milliseconds: The limit, or None for no limit.
+
+        """
+        yield
+
+    def rebuild(self):
+        """Re-create the search index for the entire catalogue."""
+        raise NotImplementedError
+
+    def reindex(self, pieces=None):
+        """Re-build the search documents for some pieces.
+
+        :param pieces: A Piece query set, or None for all pieces.
+
+        """
+        raise NotImplementedError
+
+    def remove(self, ids):
+        """Remove the search documents of deleted pieces. Backends
+        indexing in the database need not, as the deletion cascades.
+
+        :param ids: Identifiers of the deleted pieces.
+
+        """
+        pass
+
+    def search(self, node):
+        """Return a Piece query set of the pieces matching a search,
+        best matches first.
+
+        """
+        raise NotImplementedError
+
+    def ids(self, node, limit=None, **filters):
+        """Return the identifiers of the pieces matching a search,
+        best matches first.
+
+        :param node: A parsed search.
+        :param int limit: The most identifiers to return, or None for
+            all of them.
+        :param filters: Keyword arguments for filtering the Piece
+            query set.
+        :rtype: list
+
+        """
+        query = self.search(node).filter(**filters)
+        return list(query.values_list('piece_id', flat=True)[:limit])
+
+    def titles(self, prefixes, limit):
+        """Return the identifiers and titles of pieces with words in
+        their title or composer beginning with all of the prefixes.
+
+        :param list prefixes: Lower-case prefixes without accents.
+        :param int limit: The most titles to return.
+        :return: A list of ``(piece_id, title)`` tuples.
+
+        """
+        raise NotImplementedError
+
+    def headlines(self, node, ids):
+        """Return snippets of the title, source and other information
+        of some pieces, highlighting the words matched by a search.
+        Backends that cannot make snippets return none.
+
+        :param node: A parsed search.
+        :param list ids: Identifiers of the pieces, normally those on
+            one page of results.
+        :return: A dictionary of snippets keyed by piece identifier,
+            with matches delimited by :data:`START_SEL` and
+            :data:`STOP_SEL`.
+
+        """
+        return {}
+
+    def vocabulary(self):
+        """Return the words of the search index with the number of
+        pieces using each, for spelling corrections. Backends without
+        access to their words return none.
+
+        :return: A list of ``(word, count)`` tuples.
+
+        """
+        return []
+
+    def similar(self, words, limit):
+        """Return the identifiers of pieces whose title or composer is
+        similar to the words, most similar first. Backends without
+        similarity matching find nothing.
+
+        """
+        return []
+
+    def facets(self, ids):
+        """Count the pieces with the given identifiers by composer,
+        style, instrument, and LilyPond major.minor version.
+
+        :return: A dictionary keyed by the names in :data:`FACETS`,
+            each a list of ``value``, ``label`` and ``count``
+            dictionaries, largest count first.
+
+        """
+        facets = {name: [] for name in FACETS}
+        if not ids:
+            return facets
+
+        pieces = Piece.objects.filter(pk__in=ids)
+        for value, label, count in (
+                pieces.values_list('composer', 'composer__description')
+                .annotate(count=Count('piece_id'))):
+            facets['composer'].append(_facet(value, label, count))
+        for value, count in (pieces.values_list('style')
+                             .annotate(count=Count('piece_id'))):
+            facets['style'].append(_facet(value, value, count))
+        for value, count in (Piece.instruments.through.objects
+                             .filter(piece__in=ids)
+                             .values_list('instrument')
+                             .annotate(count=Count('piece', distinct=True))):
+            facets['instrument'].append(_facet(value, value, count))
+        for major, minor, count in (
+                pieces.exclude(version__major=None)
+                .exclude(version__minor=None)
+                .values_list('version__major', 'version__minor')
+                .annotate(count=Count('piece_id'))):
+            version = '{0}.{1}'.format(major, minor)
+            facets['version'].append(_facet(version, version, count))
+        return sort_facets(facets)
+
+    def explain(self, node):
+        """Return the plan of the query for a search."""
+        raise NotImplementedError
+
+
+def _facet(value, label, count):
+    return {'value': value, 'label': label, 'count': count}
+
+
+def sort_facets(facets):
+    """Sort the values of each facet, largest count first."""
+    for values in facets.values():
+        values.sort(key=lambda f: (-f['count'], f['label']))
+    return facets
+
+
+def highlight(text):
+    """Escape a headline for HTML, marking the matched words."""
+    text = escape(text)
+    text = text.replace(START_SEL, '<mark>').replace(STOP_SEL, '</mark>')
+    return mark_safe(text)
@@ -0,0 +1,371 @@
+"""
+.. module:: search_backends.postgres
+   :platform: Linux
+   :synopsis: Full text search in a Postgres search table
+
+Searches are done against a table of weighted ``tsvector`` documents,
+one per piece, shadowed by :class:`mutopia.search.SearchTerm`. Search
+syntax trees are compiled by :func:`mutopia.query.compile_where` and
+added to a Piece query set so the search, ranking, and any slicing
+are done in one statement.
+
+"""
+
+from contextlib import contextmanager
+from django.db import connection
+from django.db import transaction
+from django.db import OperationalError
+from mutopia.models import Piece
+from mutopia.query import compile_where, rank_tsquery, uses_search_table
+from mutopia.search_backends.base import SearchBackend, FACETS, sort_facets
+from mutopia.search_backends.base import START_SEL, STOP_SEL, QueryTimeout
+
+ST_NAME = 'mutopia_search_view'
+ST_INDEX_NAME = 'mutopia_search_index'
+ST_PIECE_INDEX_NAME = 'mutopia_search_piece_index'
+ST_INSTRUMENTS_INDEX_NAME = 'mutopia_search_instruments_index'
+ST_DROP = 'DROP TABLE IF EXISTS {0}'
+ST_CREATE = """
+CREATE TABLE {0} (
+    id integer PRIMARY KEY,
+    piece_id integer NOT NULL,
+    document tsvector NOT NULL,
+    instruments text[] NOT NULL
+)
+"""
+
+# The select that builds search documents. The WHERE clause is
+# supplied by the caller to limit the set of pieces being indexed.
+#
+# Synonyms are expanded here rather than in queries so that a search
+# stays a single GIN lookup. For the same reason the scope lexemes of
+# mutopia.query (composer=bachjs, style=baroque, instrument=violin)
+# are added as they are, without positions. The composer is also indexed by its key
+# and by its key split into surname and initials ("BachJS", "Bach JS")
+# and each instrument of the piece by its normalized name and every
+# name mapped to it by update.InstrumentMap ("Ukulele", "uke").
+ST_SELECT = """
+SELECT
+    p.piece_id,
+    p.piece_id,
+    (setweight(to_tsvector('pg_catalog.simple',
+        concat_ws(' ', unaccent(p.title),
+            unaccent(c.description),
+            c.composer,
+            regexp_replace(c.composer, '([a-z])([A-Z]+)$', '\\1 \\2'))),
+            'A') ||
+     setweight(to_tsvector('pg_catalog.simple',
+        concat_ws(' ', unaccent(p.opus),
+            p.style_id,
+            unaccent(p.raw_instrument),
+            unaccent(p.lyricist),
+            (SELECT unaccent(string_agg(concat_ws(' ', pi.instrument_id,
+                                                  im.raw_instrument), ' '))
+                 FROM "mutopia_piece_instruments" AS pi
+                 LEFT JOIN "update_instrumentmap" AS im
+                     ON im.instrument_id = pi.instrument_id
+                 WHERE pi.piece_id = p.piece_id))), 'B') ||
+     setweight(to_tsvector('pg_catalog.simple',
+        concat_ws(' ', unaccent(m.name),
+            p.date_composed,
+            v.version)), 'C') ||
+     setweight(to_tsvector('pg_catalog.simple',
+        concat_ws(' ', unaccent(p.source),
+            unaccent(p.moreinfo))), 'D') ||
+     array_to_tsvector(ARRAY(
+        SELECT 'composer=' || lower(p.composer_id)
+        UNION SELECT 'style=' || lower(p.style_id)
+            WHERE p.style_id IS NOT NULL
+        UNION SELECT 'style=' || st.slug
+            FROM "mutopia_style" AS st WHERE st.style = p.style_id
+        UNION SELECT 'instrument=' || lower(pi.instrument_id)
+            FROM "mutopia_piece_instruments" AS pi
+            WHERE pi.piece_id = p.piece_id))
+        ) AS document,
+    ARRAY(SELECT lower(pi.instrument_id)
+              FROM "mutopia_piece_instruments" AS pi
+              WHERE pi.piece_id = p.piece_id
+              ORDER BY 1) AS instruments
+    FROM "mutopia_piece" as p
+    JOIN "mutopia_lpversion" AS v ON v.id = p.version_id
+    JOIN "mutopia_composer" AS c ON c.composer = p.composer_id
+    JOIN "mutopia_contributor" AS m ON m.id = p.maintainer_id
+"""
+ST_INSERT = 'INSERT INTO {0} (id, piece_id, document, instruments) ' + ST_SELECT
+ST_DELETE = """
+DELETE FROM {0} WHERE piece_id IN
+    (SELECT p.piece_id FROM "mutopia_piece" AS p WHERE {1})
+"""
+
+ST_INDEX_CREATE = 'CREATE INDEX {0} ON {1} USING GIN(document)'
+ST_PIECE_INDEX_CREATE = 'CREATE UNIQUE INDEX {0} ON {1} (piece_id)'
+# Lower-cased instrument names of each piece, for all-of (@>) and
+# any-of (&&) instrument searches with the built-in GIN array support.
+ST_INSTRUMENTS_INDEX_CREATE = 'CREATE INDEX {0} ON {1} USING GIN(instruments)'
+
+# A rebuild is done into a table with this suffix and swapped in when
+# it is complete so that searches are never without a table.
+ST_BUILD_SUFFIX = '_build'
+ST_RENAME = 'ALTER TABLE {0} RENAME TO {1}'
+ST_INDEX_RENAME = 'ALTER INDEX {0} RENAME TO {1}'
+
+# FTS is not supported directly in Django so these SQL fragments are
+# added to a Piece query set. Each %s is filled in by a tsquery
+# compiled from the search.
+_PG_TSQUERY = "to_tsquery('pg_catalog.simple', unaccent(%s))"
+_PG_JOIN = ST_NAME + '.piece_id = mutopia_piece.piece_id'
+_PG_MATCH = ST_NAME + '.document @@ ' + _PG_TSQUERY
+_PG_RANK = 'ts_rank_cd(' + ST_NAME + '.document, ' + _PG_TSQUERY + ')'
+
+# Trigram similarity over titles and composer names. Each branch is
+# driven by a GIN trigram index (``<%`` is commuted to the indexable
+# ``%>``) so the catalogue is never scanned.
+_PG_SIMILAR = """
+SELECT piece_id FROM (
+    SELECT p.piece_id, word_similarity(%(words)s, p.title) AS score
+        FROM "mutopia_piece" AS p
+        WHERE %(words)s <%% p.title
+    UNION ALL
+    SELECT p.piece_id, word_similarity(%(words)s, c.description)
+        FROM "mutopia_composer" AS c
+        JOIN "mutopia_piece" AS p ON p.composer_id = c.composer
+        WHERE %(words)s <%% c.description
+) AS matches
+GROUP BY piece_id
+ORDER BY max(score) DESC, piece_id DESC
+LIMIT %(limit)s
+"""
+
+# Facet counts for a set of matching pieces in a single pass. The
+# instrument join repeats pieces so they are counted distinctly. The
+# GROUPING() columns identify the grouping set of each row; rows with
+# all three set are LilyPond versions.
+_PG_FACETS = """
+SELECT c.composer, c.description, p.style_id, pi.instrument_id,
+       v.major, v.minor, count(DISTINCT p.piece_id),
+       GROUPING(c.composer), GROUPING(p.style_id),
+       GROUPING(pi.instrument_id)
+    FROM "mutopia_piece" AS p
+    JOIN "mutopia_composer" AS c ON c.composer = p.composer_id
+    LEFT JOIN "mutopia_lpversion" AS v ON v.id = p.version_id
+    LEFT JOIN "mutopia_piece_instruments" AS pi ON pi.piece_id = p.piece_id
+    WHERE p.piece_id = ANY(%s)
+    GROUP BY GROUPING SETS ((c.composer, c.description), (p.style_id),
+                            (pi.instrument_id), (v.major, v.minor))
+"""
+
+# Postgres reports a cancelled statement with this SQLSTATE.
+_PG_QUERY_CANCELED = '57014'
+_PG_SET_TIMEOUT = "SELECT set_config('statement_timeout', %s, true)"
+
+# Snippets of the title, source and other information of the pieces on
+# a page. Only the given pieces are processed; ts_headline re-parses
+# the text so it is never run over the whole match set. The text is
+# unaccented, as documents are, so accented words are marked.
+_PG_HEADLINES = """
+SELECT p.piece_id,
+       ts_headline('pg_catalog.simple',
+                   unaccent(concat_ws(' ... ', p.title, p.source,
+                                      p.moreinfo)),
+                   to_tsquery('pg_catalog.simple', unaccent(%s)),
+                   %s)
+    FROM "mutopia_piece" AS p
+    WHERE p.piece_id = ANY(%s)
+"""
+_PG_HEADLINE_OPTIONS = ('StartSel="{0}", StopSel="{1}", MaxWords=25,'
+                        ' MinWords=8, MaxFragments=2,'
+                        ' FragmentDelimiter=" ... "').format(START_SEL,
+                                                            STOP_SEL)
+
+# The words of every search document with the number of documents
+# using each. Words of digits (dates, versions) are not worth
+# suggesting, nor are the scope lexemes.
+_PG_VOCABULARY = """
+SELECT word, ndoc FROM ts_stat('SELECT document FROM {0}')
+    WHERE word !~ '[[:digit:]=]'
+""".format(ST_NAME)
+
+
+class PostgresBackend(SearchBackend):
+    """Search with Postgres FTS, ``unaccent`` and ``pg_trgm``."""
+
+    @contextmanager
+    def statement_timeout(self, milliseconds):
+        """Set ``statement_timeout`` for the queries in the context
+        with ``SET LOCAL`` semantics, inside a transaction (or
+        savepoint) so that the previous limit is restored after it.
+
+        """
+
+        if not milliseconds:
+            yield
+            return
+        try:
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute("SELECT current_setting('statement_timeout')")
+                previous = cursor.fetchone()[0]
+                cursor.execute(_PG_SET_TIMEOUT, [str(milliseconds)])
+                yield
+                cursor.execute(_PG_SET_TIMEOUT, [previous])
+        except OperationalError as err:
+            cause = err.__cause__
+            if getattr(cause, 'pgcode', None) != _PG_QUERY_CANCELED:
+                raise
+            raise QueryTimeout(str(cause).strip()) from err
+
+    def rebuild(self):
+        """Re-create the search table and its indexes.
+
+        The new table is built and indexed under a temporary name then
+        swapped in with a rename inside a single transaction. Searches
+        continue against the old table until the swap and only wait
+        for the rename itself.
+
+        """
+
+        build = ST_NAME + ST_BUILD_SUFFIX
+        renames = [
+            (build + '_pkey', ST_NAME + '_pkey'),
+            (ST_INDEX_NAME + ST_BUILD_SUFFIX, ST_INDEX_NAME),
+            (ST_PIECE_INDEX_NAME + ST_BUILD_SUFFIX, ST_PIECE_INDEX_NAME),
+            (ST_INSTRUMENTS_INDEX_NAME + ST_BUILD_SUFFIX,
+             ST_INSTRUMENTS_INDEX_NAME),
+        ]
+        with connection.cursor() as cursor:
+            cursor.execute(ST_DROP.format(build))
+            cursor.execute(ST_CREATE.format(build))
+            cursor.execute(ST_INSERT.format(build))
+            cursor.execute(ST_INDEX_CREATE.format(renames[1][0], build))
+            cursor.execute(ST_PIECE_INDEX_CREATE.format(renames[2][0], build))
+            cursor.execute(ST_INSTRUMENTS_INDEX_CREATE.format(renames[3][0],
+                                                              build))
+            with transaction.atomic():
+                cursor.execute(ST_DROP.format(ST_NAME))
+                cursor.execute(ST_RENAME.format(build, ST_NAME))
+                for old_name, new_name in renames:
+                    cursor.execute(ST_INDEX_RENAME.format(old_name, new_name))
+
+    def reindex(self, pieces=None):
+        """Re-build the search documents of some pieces in a single
+        transaction that only takes row locks, so searches continue to
+        see the previous documents until it commits.
+
+        """
+
+        if pieces is None:
+            where, params = 'TRUE', []
+        else:
+            sql, params = pieces.values('piece_id').query.sql_with_params()
+            where = 'p.piece_id IN (' + sql + ')'
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(ST_DELETE.format(ST_NAME, where), params)
+            cursor.execute(ST_INSERT.format(ST_NAME) + ' WHERE ' + where,
+                           params)
+
+    def search(self, node):
+        """Return a Piece query set for a search, ranked if the search
+        has words to rank, otherwise newest first. Because FTS is not
+        a supported feature of django, it is faked by adding the
+        search table and the compiled search to the query set.
+
+        """
+
+        where, params = compile_where(node, ST_NAME)
+        if not uses_search_table(node):
+            query = Piece.objects.extra(where=[where], params=params)
+            return query.order_by('-piece_id')
+
+        query = Piece.objects.extra(tables=[ST_NAME,],
+                                    where=[_PG_JOIN, where,],
+                                    params=params)
+        terms = rank_tsquery(node)
+        if terms is None:
+            return query.order_by('-piece_id')
+        query = query.extra(select={'rank': _PG_RANK},
+                            select_params=[terms,])
+        return query.order_by('-rank', '-piece_id')
+
+    def titles(self, prefixes, limit):
+        """Find titles with a prefix tsquery (``:*``) restricted to the
+        title and composer weight of the search table.
+
+        """
+
+        terms = ' & '.join(p + ':*A' for p in prefixes)
+        query = Piece.objects.extra(select={'rank': _PG_RANK},
+                                    select_params=[terms,],
+                                    tables=[ST_NAME,],
+                                    where=[_PG_JOIN, _PG_MATCH,],
+                                    params=[terms,])
+        query = query.order_by('-rank', '-piece_id')
+        return list(query.values_list('piece_id', 'title')[:limit])
+
+    def headlines(self, node, ids):
+        terms = rank_tsquery(node)
+        if terms is None or not ids:
+            return {}
+        with connection.cursor() as cursor:
+            cursor.execute(_PG_HEADLINES,
+                           [terms, _PG_HEADLINE_OPTIONS, list(ids)])
+            return {pk: text for pk, text in cursor.fetchall()
+                    if START_SEL in text}
+
+    def vocabulary(self):
+        """Collect the words of the search table with ``ts_stat``."""
+        with connection.cursor() as cursor:
+            cursor.execute(_PG_VOCABULARY)
+            return cursor.fetchall()
+
+    def similar(self, words, limit):
+        """Match titles and composers by trigram word similarity,
+        driven by the trigram indexes on ``Piece.title`` and
+        ``Composer.description``.
+
+        """
+
+        with connection.cursor() as cursor:
+            cursor.execute(_PG_SIMILAR, {'words': words, 'limit': limit})
+            return [row[0] for row in cursor.fetchall()]
+
+    def facets(self, ids):
+        """Count facets with a single ``GROUPING SETS`` query."""
+
+        facets = {name: [] for name in FACETS}
+        if not ids:
+            return facets
+
+        with connection.cursor() as cursor:
+            cursor.execute(_PG_FACETS, [list(ids)])
+            rows = cursor.fetchall()
+
+        for (composer, description, style, instrument, major, minor, count,
+             g_composer, g_style, g_instrument) in rows:
+            if not g_composer:
+                facet = ('composer', composer, description)
+            elif not g_style:
+                facet = ('style', style, style)
+            elif not g_instrument:
+                facet = ('instrument', instrument, instrument)
+            elif major is not None and minor is not None:
+                version = '{0}.{1}'.format(major, minor)
+                facet = ('version', version, version)
+            else:
+                continue
+            name, value, label = facet
+            if value is not None:
+                facets[name].append({'value': value,
+                                     'label': label,
+                                     'count': count})
+        return sort_facets(facets)
+
+    def explain(self, node):
+        """Return the plan reported by ``EXPLAIN (ANALYZE, BUFFERS)``.
+        The query is run to get the actual timings and buffer usage.
+
+        """
+
+        query = self.search(node).values_list('piece_id', flat=True)
+        sql, params = query.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN (ANALYZE, BUFFERS) ' + sql, params)
+            return '\n'.join(row[0] for row in cursor.fetchall())
@@ -0,0 +1,355 @@
+"""
+.. module:: search_backends.sqlite
+   :platform: Linux
+   :synopsis: Full text search in a local SQLite FTS5 index
+
+The index is an FTS5 table in the file named by the
+``SEARCH_SQLITE_PATH`` setting, so a read-only mirror can copy the
+file and search without a database round trip. Documents are built
+from the catalogue with the ORM, weighted as they are for Postgres in
+four columns (title and composer, then opus, style, instruments and
+lyricist, then maintainer, date and version, then source and other
+information). The ``unicode61`` tokenizer folds case and removes
+accents.
+
+Searches are compiled from the same syntax tree as for Postgres; the
+words become an FTS5 ``MATCH`` expression and the qualifiers become
+conditions on unindexed columns of the index.
+
+"""
+
+import logging
+import os
+import re
+import sqlite3
+from django.conf import settings
+from django.db import ProgrammingError
+from django.db.models import Case, When, Value, IntegerField
+from mutopia.models import Piece
+from mutopia.query import Term, Phrase, Qualifier, Not, And, Or, is_text
+from mutopia.search_backends.base import SearchBackend, START_SEL, STOP_SEL
+from update.models import InstrumentMap
+
+logger = logging.getLogger(__name__)
+
+FTS_CREATE = """
+CREATE VIRTUAL TABLE search USING fts5(
+    a, b, c, d,
+    title UNINDEXED, composer UNINDEXED, style UNINDEXED,
+    style_slug UNINDEXED, version UNINDEXED, instruments UNINDEXED,
+    date_published UNINDEXED,
+    tokenize = 'unicode61 remove_diacritics 2'
+)
+"""
+FTS_INSERT = """
+INSERT INTO search (rowid, a, b, c, d, title, composer, style, style_slug,
+                    version, instruments, date_published)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+# Column weights corresponding to the Postgres defaults for A to D.
+# Lower bm25() values are better matches.
+FTS_RANK = 'bm25(search, 1.0, 0.4, 0.2, 0.1)'
+
+# A rebuild is written to a file with this suffix and moved over the
+# index when it is complete.
+FTS_BUILD_SUFFIX = '.build'
+
+# Splits a composer key into surname and initials ("BachJS").
+_KEY_SPLIT = re.compile(r'([a-z])([A-Z]+)$')
+
+_QUALIFIERS = {
+    'composer': 'lower(composer) = lower(?)',
+    'style': '(lower(style) = lower(?) OR style_slug = lower(?))',
+    'version': "(version = ? OR version LIKE ? ESCAPE '\\')",
+    'since': 'date_published >= ?',
+}
+
+
+def _words(text):
+    return ' '.join(w for w in text if w)
+
+
+def _aliases():
+    """Return the names mapped to each instrument by InstrumentMap."""
+    aliases = {}
+    for raw, instrument in InstrumentMap.objects.values_list(
+            'raw_instrument', 'instrument'):
+        aliases.setdefault(instrument, []).append(raw)
+    return aliases
+
+
+def _rows(pieces):
+    """Yield index rows for pieces. As for Postgres, composer and
+    instrument synonyms are added to the documents.
+
+    """
+    aliases = _aliases()
+    pieces = pieces.select_related('composer', 'style', 'version',
+                                   'maintainer')
+    for p in pieces.prefetch_related('instruments'):
+        if p.version is None or p.maintainer is None:
+            # As for Postgres, pieces need both to be indexed.
+            continue
+        instruments = sorted(i.instrument.lower()
+                             for i in p.instruments.all())
+        names = [name for i in p.instruments.all()
+                 for name in [i.instrument] + aliases.get(i.instrument, [])]
+        composer = p.composer_id
+        yield (p.piece_id,
+               _words([p.title, p.composer.description, composer,
+                       _KEY_SPLIT.sub(r'\1 \2', composer)]),
+               _words([p.opus, p.style_id, p.raw_instrument, p.lyricist] +
+                      names),
+               _words([p.maintainer.name, p.date_composed,
+                       p.version.version]),
+               _words([p.source, p.moreinfo]),
+               p.title,
+               p.composer_id,
+               p.style_id,
+               p.style.slug if p.style else '',
+               p.version.version,
+               '|' + '|'.join(instruments) + '|',
+               p.date_published.isoformat())
+
+
+def _quote(word):
+    return '"' + word.replace('"', '""') + '"'
+
+
+def _match(node):
+    """Return an FTS5 expression for a node containing only words, or
+    None if it cannot be expressed (FTS5 has no unary NOT).
+
+    """
+    if isinstance(node, Term):
+        return _quote(node.word)
+    if isinstance(node, Phrase):
+        return _quote(' '.join(node.words))
+    if isinstance(node, Or):
+        parts = [_match(n) for n in node.nodes]
+        if None in parts:
+            return None
+        return '(' + ' OR '.join(parts) + ')'
+    if isinstance(node, And):
+        positive = [_match(n) for n in node.nodes if not isinstance(n, Not)]
+        negative = [_match(n.node) for n in node.nodes if isinstance(n, Not)]
+        if not positive or None in positive + negative:
+            return None
+        expr = '(' + ' AND '.join(positive) + ')'
+        if negative:
+            expr += ' NOT (' + ' OR '.join(negative) + ')'
+        return expr
+    return None
+
+
+def _where(node):
+    """Compile a syntax tree to a condition on the index."""
+    if is_text(node):
+        expr = _match(node)
+        if expr is not None:
+            return ('rowid IN (SELECT rowid FROM search WHERE search MATCH ?)',
+                    [expr])
+    if isinstance(node, Qualifier):
+        if node.name == 'instrument':
+            sql = ' AND '.join(["instruments LIKE ? ESCAPE '\\'"] *
+                               len(node.instruments))
+            params = ['%|' + _like(i) + '|%' for i in node.instruments]
+            return ('(' + sql + ')', params)
+        return (_QUALIFIERS[node.name], node.params())
+    if isinstance(node, Not):
+        sql, params = _where(node.node)
+        return ('NOT (' + sql + ')', params)
+    parts = [_where(n) for n in node.nodes]
+    joiner = ' OR ' if isinstance(node, Or) else ' AND '
+    sql = '(' + joiner.join(p[0] for p in parts) + ')'
+    params = [param for p in parts for param in p[1]]
+    return (sql, params)
+
+
+def _like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _split(node):
+    """Split a search into an FTS5 expression for its words, which
+    must all match, and the rest of the search.
+
+    :return: A tuple of the expression (or None if the words cannot
+        be matched directly) and the list of remaining nodes.
+
+    """
+    nodes = node.nodes if type(node) is And else [node]
+    text = [n for n in nodes if is_text(n)]
+    rest = [n for n in nodes if not is_text(n)]
+    if not text:
+        return (None, rest)
+    return (_match(text[0] if len(text) == 1 else And(text)), rest)
+
+
+def _query(node):
+    """Compile a syntax tree to a query for matching rowids, ranked
+    with bm25() when the words can be matched directly.
+
+    """
+    expr, rest = _split(node)
+    if expr is None:
+        sql, params = _where(node)
+        return ('SELECT rowid FROM search WHERE ' + sql +
+                ' ORDER BY rowid DESC', params)
+
+    sql = 'SELECT rowid FROM search WHERE search MATCH ?'
+    params = [expr]
+    if rest:
+        where, more = _where(rest[0] if len(rest) == 1 else And(rest))
+        sql += ' AND ' + where
+        params += more
+    return (sql + ' ORDER BY ' + FTS_RANK + ', rowid DESC', params)
+
+
+def _in_order(ids):
+    """Return a Piece query set of the given pieces in the same order."""
+    if not ids:
+        return Piece.objects.none()
+    position = Case(*[When(pk=pk, then=Value(i)) for i, pk in enumerate(ids)],
+                    output_field=IntegerField())
+    query = Piece.objects.filter(pk__in=ids).annotate(position=position)
+    return query.order_by('position')
+
+
+class SQLiteBackend(SearchBackend):
+    """Search with SQLite FTS5 in a local file."""
+
+    def _connect(self, path=None):
+        """Open an index file, by default the index searched.
+
+        :raises ProgrammingError: if the index has not been built.
+
+        """
+        path = path or settings.SEARCH_SQLITE_PATH
+        if not os.path.exists(path):
+            raise ProgrammingError('No search index at ' + path)
+        return sqlite3.connect(path)
+
+    def rebuild(self):
+        """Build a new index file and move it over the old one, so
+        searches continue against the old file until it is complete.
+
+        """
+
+        path = settings.SEARCH_SQLITE_PATH
+        build = path + FTS_BUILD_SUFFIX
+        if os.path.exists(build):
+            os.remove(build)
+        db = sqlite3.connect(build)
+        try:
+            with db:
+                db.execute(FTS_CREATE)
+                db.executemany(FTS_INSERT, _rows(Piece.objects.all()))
+        finally:
+            db.close()
+        os.replace(build, path)
+
+    def reindex(self, pieces=None):
+        """Re-build the documents of some pieces, if the index has been
+        built; otherwise :meth:`rebuild` will index them.
+
+        """
+        if not os.path.exists(settings.SEARCH_SQLITE_PATH):
+            logger.info('No search index at %s to update',
+                        settings.SEARCH_SQLITE_PATH)
+            return
+        if pieces is None:
+            pieces = Piece.objects.all()
+        ids = list(pieces.values_list('piece_id', flat=True))
+        db = self._connect()
+        try:
+            with db:
+                db.executemany('DELETE FROM search WHERE rowid = ?',
+                               [(pk,) for pk in ids])
+                db.executemany(FTS_INSERT,
+                               _rows(Piece.objects.filter(pk__in=ids)))
+        finally:
+            db.close()
+
+    def remove(self, ids):
+        if not os.path.exists(settings.SEARCH_SQLITE_PATH):
+            return
+        db = self._connect()
+        try:
+            with db:
+                db.executemany('DELETE FROM search WHERE rowid = ?',
+                               [(pk,) for pk in ids])
+        finally:
+            db.close()
+
+    def ids(self, node, limit=None, **filters):
+        sql, params = _query(node)
+        if limit is not None and not filters:
+            # Filters are applied to the matches, so must see them all.
+            sql += ' LIMIT ?'
+            params = params + [limit]
+        db = self._connect()
+        try:
+            ids = [row[0] for row in db.execute(sql, params)]
+        finally:
+            db.close()
+        if filters and ids:
+            query = Piece.objects.filter(pk__in=ids, **filters)
+            keep = set(query.values_list('piece_id', flat=True))
+            ids = [pk for pk in ids if pk in keep][:limit]
+        return ids
+
+    def search(self, node):
+        return _in_order(self.ids(node))
+
+    def headlines(self, node, ids):
+        """Return FTS5 snippets, taken from whichever column best
+        matches the words of the search.
+
+        """
+        expr = _split(node)[0]
+        if expr is None or not ids:
+            return {}
+        db = self._connect()
+        try:
+            rows = db.execute(
+                "SELECT rowid, snippet(search, -1, ?, ?, ' ... ', 16)"
+                ' FROM search WHERE search MATCH ? AND rowid IN (' +
+                ', '.join('?' * len(ids)) + ')',
+                [START_SEL, STOP_SEL, expr] + list(ids))
+            return {pk: text for pk, text in rows if START_SEL in text}
+        finally:
+            db.close()
+
+    def vocabulary(self):
+        """Collect the words of the index with an ``fts5vocab`` table."""
+        db = self._connect()
+        try:
+            db.execute('CREATE VIRTUAL TABLE temp.vocab'
+                       ' USING fts5vocab(main, search, row)')
+            return list(db.execute('SELECT term, doc FROM temp.vocab'
+                                   " WHERE term NOT GLOB '*[0-9]*'"))
+        finally:
+            db.close()
+
+    def titles(self, prefixes, limit):
+        expr = ' AND '.join('a : ' + _quote(p) + '*' for p in prefixes)
+        db = self._connect()
+        try:
+            return list(db.execute(
+                'SELECT rowid, title FROM search WHERE search MATCH ?'
+                ' ORDER BY ' + FTS_RANK + ', rowid DESC LIMIT ?',
+                [expr, limit]))
+        finally:
+            db.close()
+
+    def explain(self, node):
+        """Return the plan reported by ``EXPLAIN QUERY PLAN``."""
+        sql, params = _query(node)
+        db = self._connect()
+        try:
+            rows = db.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return '\n'.join(row[-1] for row in rows)
+        finally:
+            db.close()
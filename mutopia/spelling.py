@@ -0,0 +1,95 @@
+"""
+.. module:: spelling
+   :platform: Linux
+   :synopsis: Spelling corrections from the words of the search index
+
+A :class:`Vocabulary` holds every word of the search index with the
+number of pieces using it, so misspelled search words can be replaced
+by the nearest indexed words without querying the database. The
+catalogue has a few thousand distinct words; they are kept in
+per-length tuples so only words of a similar length are compared.
+
+"""
+
+# The most edits allowed for a correction, by word length. Short
+# words have too many near neighbours to correct more than once.
+_MAX_EDITS = ((3, 0), (5, 1))
+_DEFAULT_MAX_EDITS = 2
+
+
+def max_edits(word):
+    """Return the most edits allowed to correct a word."""
+    for length, edits in _MAX_EDITS:
+        if len(word) <= length:
+            return edits
+    return _DEFAULT_MAX_EDITS
+
+
+def edit_distance(a, b, limit):
+    """Return the Damerau-Levenshtein (optimal string alignment)
+    distance between two words, or ``limit + 1`` if it is greater than
+    the limit.
+
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = None
+    row = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(row[j] + 1,
+                             current[j - 1] + 1,
+                             row[j - 1] + cost)
+            if (i > 1 and j > 1 and a[i - 1] == b[j - 2]
+                    and a[i - 2] == b[j - 1]):
+                current[j] = min(current[j], previous[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        previous, row = row, current
+    return min(row[-1], limit + 1)
+
+
+class Vocabulary:
+    """The words of the search index and their document counts.
+
+    :param words: An iterable of ``(word, count)`` pairs.
+
+    """
+
+    def __init__(self, words):
+        counts = {}
+        by_length = {}
+        for word, count in words:
+            counts[word] = count
+            by_length.setdefault(len(word), []).append(word)
+        self._counts = counts
+        self._by_length = {length: tuple(words)
+                           for length, words in by_length.items()}
+
+    def __len__(self):
+        return len(self._counts)
+
+    def __contains__(self, word):
+        return word in self._counts
+
+    def correct(self, word):
+        """Return the indexed word nearest to a word, the most common
+        if several are as near, or None if the word is indexed or
+        nothing is near enough.
+
+        """
+        if word in self._counts or not word.isalpha():
+            return None
+        limit = max_edits(word)
+        best = None
+        for length in range(len(word) - limit, len(word) + limit + 1):
+            for candidate in self._by_length.get(length, ()):
+                distance = edit_distance(word, candidate, limit)
+                if distance > limit:
+                    continue
+                key = (distance, -self._counts[candidate], candidate)
+                if best is None or key < best:
+                    best = key
+        return best[2] if best else None
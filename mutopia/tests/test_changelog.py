@@ -0,0 +1,59 @@
+import time
+import requests
+from django.test import TestCase, override_settings
+from unittest import mock
+from mutopia.changelog import change_log, forget_log
+from mutopia.models import AssetMap
+
+
+def _response(text):
+    response = mock.Mock(text=text)
+    response.raise_for_status.return_value = None
+    return response
+
+
+@override_settings(LOG_CACHE_TTL=60, LOG_RETRY=30)
+class ChangeLogTests(TestCase):
+
+    def setUp(self):
+        self.asset = AssetMap.objects.create(folder='JayJ/jimjam',
+                                             name='jimjam')
+
+    @mock.patch('mutopia.changelog.requests.get')
+    def test_cached_log(self, get):
+        get.return_value = _response('first')
+        self.assertEqual(change_log(self.asset), 'first')
+        self.assertTrue(get.call_args[1]['timeout'])
+        get.return_value = _response('second')
+        self.assertEqual(change_log(self.asset), 'first')
+        self.assertEqual(get.call_count, 1)
+
+        # Logs are kept for each asset name.
+        other = AssetMap(folder='JayJ/jimjam', name='jimjam-2')
+        self.assertEqual(change_log(other), 'second')
+
+        # Changed assets are fetched again.
+        get.return_value = _response('third')
+        forget_log(self.asset)
+        self.assertEqual(change_log(self.asset), 'third')
+
+    @mock.patch('mutopia.changelog.threading.Thread')
+    @mock.patch('mutopia.changelog.requests.get')
+    def test_stale_log(self, get, thread):
+        get.return_value = _response('first')
+        change_log(self.asset)
+        later = time.time() + 120
+        with mock.patch('mutopia.changelog.time.time', return_value=later):
+            self.assertEqual(change_log(self.asset), 'first')
+            # One refresh at a time.
+            change_log(self.asset)
+        self.assertEqual(thread.call_count, 1)
+        thread.return_value.start.assert_called_once_with()
+
+    @mock.patch('mutopia.changelog.requests.get')
+    def test_unavailable_log(self, get):
+        get.side_effect = requests.Timeout('too slow')
+        self.assertIsNone(change_log(self.asset))
+        # Not retried until LOG_RETRY seconds have passed.
+        self.assertIsNone(change_log(self.asset))
+        self.assertEqual(get.call_count, 1)
@@ -1,8 +1,19 @@
 # -*- coding: utf-8 -*-
 from django.test import TestCase
-from django.db import ProgrammingError
+from django.db import connection
 from django.core.urlresolvers import reverse
-from mutopia.search import SearchTerm
+from django.core.cache import cache
+from django.test import override_settings
+from unittest import mock
+from mutopia.search import SearchTerm, search_cache_stats, suggest
+from mutopia.search import SearchTimer, log_slow_search, SLOW_EXPLAIN_KEY
+from mutopia.search import did_you_mean, timeout_count
+from mutopia.search_backends import get_backend
+from mutopia.search_backends.base import QueryTimeout
+from mutopia.cache import new_generation
+from mutopia.query import SearchSyntaxError
+from mutopia.models import Style, Instrument
+from update.models import InstrumentMap
 from . import tutils
 
 class FTSTests(TestCase):
@@ -17,6 +28,9 @@ class FTSTests(TestCase):
                                    title='Swingshift Blües') # note diacritical
         tutils.init_fts()
 
+    def search(self, keywords):
+        return [p.pk for p in SearchTerm.search(keywords)]
+
     def test_fts_search(self):
         # Test diacritical- and case- insensitive search.
         expected_blues = [str(self.p3), str(self.p4),]
@@ -40,6 +54,10 @@ class FTSTests(TestCase):
                                  [str(self.p2)],
                                  transform=str )
 
+        # Apostrophes separate words, in searches as in documents.
+        p5 = tutils.make_piece(piece_id=5, title="O'Carolan's Farewell")
+        self.assertEqual(SearchTerm.ranked_ids("o'carolan farewell"), [p5.pk])
+
         # ... so this should return an empty set (but no error)
         p_set = SearchTerm.search('devil swingshift')
         self.assertQuerysetEqual(p_set, [], transform=str )
@@ -49,7 +67,311 @@ class FTSTests(TestCase):
         p_set = SearchTerm.search('blues & !suppertime')
         self.assertQuerysetEqual(p_set, [str(self.p4)], transform=str )
 
-        # On bad input, search raises a programming error. Add others
-        # here as you like.
-        with self.assertRaises(ProgrammingError):
-            p_set = SearchTerm.search('!++&')
+        # Bad input is rejected by the parser before any query is
+        # made. Add others here as you like.
+        for bad in ['!++&', 'blues &', '(blues', '"blues', 'title:blues']:
+            with self.assertNumQueries(0):
+                with self.assertRaises(SearchSyntaxError):
+                    SearchTerm.search(bad)
+
+    def test_fielded_search(self):
+        p_set = SearchTerm.search('"devil mountain" composer:jayj')
+        self.assertQuerysetEqual(p_set, [str(self.p2)], transform=str)
+        p_set = SearchTerm.search('"mountain devil"')
+        self.assertQuerysetEqual(p_set, [], transform=str)
+        p_set = SearchTerm.search('blues instrument:piano style:bop')
+        self.assertEqual(len(p_set), 2)
+        p_set = SearchTerm.search('blues & !version:2.19')
+        self.assertEqual(len(p_set), 0)
+        p_set = SearchTerm.search('blues | composer:nobody')
+        self.assertEqual(len(p_set), 2)
+
+        # Qualifiers alone are matched without the search table.
+        p_set = SearchTerm.search('version:2.19.35 since:2000-01-01')
+        self.assertQuerysetEqual(p_set,
+                                 [str(self.p4), str(self.p3), str(self.p2)],
+                                 transform=str)
+
+    def test_incremental_index(self):
+        # Saving a piece re-indexes it without a refresh.
+        self.p2.title = 'Devil Mountain Stomp'
+        self.p2.save()
+        self.assertQuerysetEqual(SearchTerm.search('stomp'),
+                                 [str(self.p2)],
+                                 transform=str)
+        self.assertQuerysetEqual(SearchTerm.search('rag'), [], transform=str)
+
+        # Changes to a related maintainer reach all of their pieces.
+        maintainer = self.p2.maintainer
+        maintainer.name = 'Jelly Roll Smith'
+        maintainer.save()
+        p_set = SearchTerm.search('jelly')
+        self.assertEqual(len(p_set), 3)
+
+        # A new piece is searchable as soon as it is created.
+        p5 = tutils.make_piece(piece_id=5, title='Potato Head Blues')
+        p_set = SearchTerm.search('potato')
+        self.assertQuerysetEqual(p_set, [str(p5)], transform=str)
+
+    def test_rebuild_swap(self):
+        # A rebuild swaps in a fully indexed table each time it runs.
+        SearchTerm.rebuild_view()
+        SearchTerm.rebuild_view()
+        self.assertEqual(len(SearchTerm.search('blues')), 2)
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT indexname FROM pg_indexes"
+                           " WHERE tablename = 'mutopia_search_view'")
+            indexes = set(row[0] for row in cursor.fetchall())
+        self.assertEqual(indexes, {'mutopia_search_view_pkey',
+                                   'mutopia_search_index',
+                                   'mutopia_search_piece_index',
+                                   'mutopia_search_instruments_index'})
+
+    def test_instruments(self):
+        # Instruments are indexed as they are added to pieces.
+        violin, _ = Instrument.objects.get_or_create(instrument='Violin')
+        cello, _ = Instrument.objects.get_or_create(instrument='Cello')
+        self.p3.instruments.add(violin, cello)
+        self.p4.instruments.add(violin)
+        ids = lambda q: sorted(p.pk for p in SearchTerm.search(q))
+
+        self.assertEqual(ids('instrument:violin'), [self.p3.pk, self.p4.pk])
+        self.assertEqual(ids('instrument:Violin,Cello'), [self.p3.pk])
+        self.assertEqual(ids('instrument:violin instrument:piano'),
+                         [self.p3.pk, self.p4.pk])
+        self.assertEqual(ids('instrument:cello | instrument:banjo'),
+                         [self.p3.pk])
+        self.assertEqual(ids('rag | instrument:cello'),
+                         [self.p2.pk, self.p3.pk])
+
+        # ... and removed, from either side of the relation.
+        cello.piece_set.remove(self.p3)
+        self.assertEqual(ids('instrument:violin,cello'), [])
+        violin.piece_set.clear()
+        self.assertEqual(ids('instrument:violin'), [])
+
+    def test_synonyms(self):
+        # Instruments are indexed with their mapped names ...
+        ukulele, _ = Instrument.objects.get_or_create(instrument='Ukulele')
+        self.p2.instruments.add(ukulele)
+        self.assertEqual(self.search('uke'), [])
+        InstrumentMap.objects.create(raw_instrument='uke',
+                                     instrument=ukulele)
+        self.assertEqual(self.search('uke'), [self.p2.pk])
+        self.assertEqual(self.search('ukulele mountain'), [self.p2.pk])
+        # A name mapped to another instrument moves to its pieces.
+        banjo, _ = Instrument.objects.get_or_create(instrument='Banjo')
+        self.p3.instruments.add(banjo)
+        uke = InstrumentMap.objects.get(raw_instrument='uke')
+        uke.instrument = banjo
+        uke.save()
+        self.assertEqual(self.search('uke'), [self.p3.pk])
+        InstrumentMap.objects.filter(raw_instrument='uke').delete()
+        self.assertEqual(self.search('uke'), [])
+
+        # ... and composers by their key, whole and split.
+        self.assertEqual(len(self.search('jayj')), 3)
+        self.assertEqual(len(self.search('"jay j" blues')), 2)
+
+    def test_scoped_search(self):
+        blues = sorted([self.p3.pk, self.p4.pk])
+        self.assertEqual(sorted(self.search('blues composer:jayj')), blues)
+        self.assertEqual(sorted(self.search('blues style:bop')), blues)
+        self.assertEqual(sorted(self.search('blues instrument:Piano')), blues)
+        self.assertEqual(self.search('blues composer:MouseM'), [])
+        self.assertEqual(self.search('blues instrument:piano,banjo'), [])
+        # The scope is matched in the document, not by a subquery.
+        plan = SearchTerm.explain('blues composer:jayj style:bop')
+        self.assertNotIn('mutopia_composer', plan)
+        self.assertNotIn('mutopia_style', plan)
+
+    def test_scoped_no_style(self):
+        # Pieces without a style are indexed without a style scope.
+        self.p3.style = None
+        self.p3.save()
+        self.assertEqual(self.search('blues style:bop'), [self.p4.pk])
+        self.assertEqual(self.search('suppertime composer:jayj'),
+                         [self.p3.pk])
+
+    def test_fts_rank(self):
+        # Title matches rank above matches in the source.
+        self.p3.source = 'Mountain Music Press'
+        self.p3.save()
+        p_set = SearchTerm.search('mountain')
+        self.assertQuerysetEqual(p_set,
+                                 [str(self.p2), str(self.p3)],
+                                 transform=str)
+        self.assertTrue(p_set[0].rank > p_set[1].rank)
+
+    def test_ranked_ids_cache(self):
+        new_generation()
+        ids = SearchTerm.ranked_ids('blues')
+        self.assertEqual(sorted(ids), [self.p3.pk, self.p4.pk])
+        stats = search_cache_stats()
+        # The same search with the same filters is a cache hit ...
+        self.assertEqual(SearchTerm.ranked_ids('blues'), ids)
+        self.assertEqual(search_cache_stats()['hits'], stats['hits'] + 1)
+        # ... but different filters are not.
+        self.assertEqual(SearchTerm.ranked_ids('blues', pk=self.p4.pk),
+                         [self.p4.pk])
+        self.assertEqual(search_cache_stats()['misses'],
+                         stats['misses'] + 1)
+
+        # A new catalogue generation invalidates cached results.
+        self.p2.title = 'Devil Mountain Blues'
+        self.p2.save()
+        self.assertEqual(SearchTerm.ranked_ids('blues'), ids)
+        new_generation()
+        self.assertEqual(len(SearchTerm.ranked_ids('blues')), 3)
+
+    def test_result_limit(self):
+        new_generation()
+        ids = SearchTerm.ranked_ids('mountain | blues')
+        self.assertEqual(len(ids), 3)
+        new_generation()
+        # The best matches are kept.
+        with mock.patch('mutopia.search.RESULT_LIMIT', 2):
+            self.assertEqual(SearchTerm.ranked_ids('mountain | blues'),
+                             ids[:2])
+            self.assertEqual(SearchTerm.ranked_ids(''),
+                             [self.p4.pk, self.p3.pk])
+
+    def test_facets(self):
+        new_generation()
+        self.p4.style = Style.find_or_create('Swing')
+        self.p4.save()
+        facets = SearchTerm.facets('blues')
+        self.assertEqual(facets['composer'],
+                         [{'value': 'JayJ',
+                           'label': self.p3.composer.description,
+                           'count': 2}])
+        self.assertEqual([(f['value'], f['count']) for f in facets['style']],
+                         [('Bop', 1), ('Swing', 1)])
+        self.assertEqual(facets['instrument'][0]['count'], 2)
+        self.assertEqual(facets['version'][0]['value'], '2.19')
+
+        # Facets are cached with the result.
+        stats = search_cache_stats()
+        self.assertEqual(SearchTerm.facets('blues'), facets)
+        self.assertEqual(search_cache_stats()['hits'], stats['hits'] + 1)
+
+        # Narrowing by a facet is a (qualified) search.
+        self.assertEqual(SearchTerm.ranked_ids('blues style:Swing'),
+                         [self.p4.pk])
+        self.assertEqual(SearchTerm.facets('nothing'),
+                         {'composer': [], 'style': [],
+                          'instrument': [], 'version': []})
+
+    def test_headlines(self):
+        new_generation()
+        ids = [self.p3.pk, self.p2.pk]
+        headlines = SearchTerm.headlines('blues', ids)
+        # Only pieces on the page with a match have a headline.
+        self.assertEqual(list(headlines), [self.p3.pk])
+        self.assertIn('<mark>Blues</mark>', headlines[self.p3.pk])
+
+        # Headlines are cached with the page; only the generation is
+        # looked up.
+        stats = search_cache_stats()
+        with self.assertNumQueries(1):
+            self.assertEqual(SearchTerm.headlines('blues', ids), headlines)
+        self.assertEqual(search_cache_stats()['hits'], stats['hits'] + 1)
+        self.assertEqual(SearchTerm.headlines('style:bop', ids), {})
+        # Accents are ignored in headlines, as they are in searches.
+        headlines = SearchTerm.headlines('blues', [self.p4.pk])
+        self.assertIn('<mark>Blues</mark>', headlines[self.p4.pk])
+
+    def test_did_you_mean(self):
+        new_generation()
+        self.assertEqual(did_you_mean('suppertine bluse'),
+                         '(suppertime & blues)')
+        self.assertEqual(did_you_mean('devil | "mountian rag"'),
+                         '(devil | "mountain rag")')
+        self.assertEqual(did_you_mean('montain composer:JayJ'),
+                         '(mountain & composer:"JayJ")')
+        self.assertIsNone(did_you_mean('Blües'))
+        self.assertIsNone(did_you_mean('zzyzx'))
+        # The vocabulary is kept for the generation.
+        with self.assertNumQueries(1):
+            self.assertEqual(did_you_mean('swingshfit'), 'swingshift')
+
+    def test_statement_timeout(self):
+        backend = get_backend()
+        with connection.cursor() as cursor:
+            cursor.execute('SHOW statement_timeout')
+            previous = cursor.fetchone()[0]
+            with self.assertRaises(QueryTimeout):
+                with backend.statement_timeout(10):
+                    cursor.execute('SELECT pg_sleep(1)')
+            with backend.statement_timeout(1000):
+                cursor.execute('SHOW statement_timeout')
+                self.assertEqual(cursor.fetchone()[0], '1s')
+            # The limit only applies inside the context.
+            cursor.execute('SHOW statement_timeout')
+            self.assertEqual(cursor.fetchone()[0], previous)
+
+    def test_search_timeout(self):
+        new_generation()
+        ids = SearchTerm.ranked_ids('blues')
+        new_generation()
+        count = timeout_count('search')
+        with mock.patch.object(type(get_backend()), 'ids',
+                               side_effect=QueryTimeout('canceled')):
+            with self.assertRaises(QueryTimeout):
+                SearchTerm.ranked_ids('blues')
+        self.assertEqual(timeout_count('search'), count + 1)
+        # The last results are kept for timeouts.
+        self.assertEqual(SearchTerm.stale_ids('blues'), ids)
+        self.assertIsNone(SearchTerm.stale_ids('mountain'))
+
+    @override_settings(SLOW_SEARCH_SECONDS=0)
+    def test_slow_search(self):
+        cache.delete(SLOW_EXPLAIN_KEY)
+        timer = SearchTimer()
+        with timer.phase('search'):
+            SearchTerm.ranked_ids('blues composer:JayJ')
+        # Searches that timed out are not run again to explain them.
+        with mock.patch.object(SearchTerm, 'explain') as explain:
+            with self.assertLogs('mutopia.search', 'WARNING') as logs:
+                log_slow_search('blues', timer, explain=False)
+        self.assertEqual(len(logs.output), 1)
+        explain.assert_not_called()
+
+        with self.assertLogs('mutopia.search', 'WARNING') as logs:
+            self.assertTrue(log_slow_search('blues composer:JayJ', timer))
+        self.assertIn('(blues & composer:"JayJ"): search', logs.output[0])
+        self.assertIn('Execution Time', logs.output[1])
+
+        # Plans are rate limited.
+        with self.assertLogs('mutopia.search', 'WARNING') as logs:
+            log_slow_search('blues', timer)
+        self.assertEqual(len(logs.output), 1)
+
+        with self.settings(SLOW_SEARCH_SECONDS=60):
+            self.assertFalse(log_slow_search('blues', timer))
+
+    def test_suggest(self):
+        new_generation()
+        result = suggest('swing bl')
+        self.assertEqual(result['titles'],
+                         [{'id': self.p4.pk, 'title': self.p4.title}])
+        # Prefixes match composer and instrument names too, ignoring
+        # case and accents.
+        result = suggest('JOÉ')
+        self.assertEqual(result['composers'][0]['composer'], 'JayJ')
+        self.assertEqual(len(result['titles']), 3)
+        self.assertEqual(suggest('pia')['instruments'], ['Piano'])
+        # Source text is not used for suggestions.
+        self.assertEqual(suggest('manuscr')['titles'], [])
+        self.assertEqual(suggest('&!'),
+                         {'titles': [], 'composers': [], 'instruments': []})
+
+    def test_similar(self):
+        # Misspellings find nothing with FTS but are similar to titles.
+        new_generation()
+        self.assertEqual(SearchTerm.ranked_ids('Swingshfit'), [])
+        self.assertEqual(SearchTerm.similar_ids('Swingshfit'), [self.p4.pk])
+        self.assertEqual(SearchTerm.similar_ids('Swingshfit',
+                                                pk=self.p3.pk), [])
+        # FTS operators are not matched.
+        self.assertEqual(SearchTerm.similar_ids('Swingshfit | rag'), [])
@@ -2,7 +2,7 @@ import re
 from django.test import TestCase
 from django.utils.text import slugify
 from mutopia.models import Composer, Contributor, Style, LPVersion, Piece
-from mutopia.models import License, AssetMap
+from mutopia.models import License, AssetMap, PieceDetail
 from mutopia.models import Instrument
 from mutopia.models import Collection
 from . import tutils
@@ -79,6 +79,69 @@ class PieceTests(TestCase):
         self.assertTrue(isinstance(p, Piece))
         self.assertTrue('-' in str(p))
 
+    def test_piece_counts(self):
+        p = tutils.make_piece()
+        tutils.make_piece(piece_id=2)
+        c = p.composer
+        self.assertEqual(Composer.objects.get(pk=c.pk).piece_count, 0)
+        Composer.update_piece_counts([c.pk])
+        self.assertEqual(Composer.objects.get(pk=c.pk).piece_count, 2)
+        for model in (Style, LPVersion, Instrument):
+            model.update_piece_counts()
+        self.assertEqual(Style.objects.get(pk=p.style_id).piece_count, 2)
+        self.assertEqual(LPVersion.objects.get(pk=p.version_id).piece_count, 2)
+        self.assertEqual(Instrument.objects.get(pk='Piano').piece_count, 2)
+        p.delete()
+        Composer.update_piece_counts([])
+        self.assertEqual(Composer.objects.get(pk=c.pk).piece_count, 2)
+        Composer.update_piece_counts([c.pk])
+        self.assertEqual(Composer.objects.get(pk=c.pk).piece_count, 1)
+
+    def test_piece_details(self):
+        p = tutils.make_piece()
+        AssetMap.objects.create(piece=p, folder='JayJ/jimjam',
+                                name='jimjam', uses_svg=False)
+        PieceDetail.update_details([p.pk])
+        with self.assertNumQueries(1):
+            detail = PieceDetail.lookup(p.pk)
+        self.assertEqual(detail['byline'], 'by Joe Jay')
+        self.assertEqual(detail['instruments'], ['Piano'])
+        self.assertTrue(detail['asset']['preview'].endswith(
+            'JayJ/jimjam/jimjam-preview.png'))
+        self.assertIsNone(detail['collection'])
+
+        # Edits drop the details, which are rebuilt when next needed.
+        col = Collection.objects.create(tag='jj', title='Jimjams')
+        col.pieces.add(p)
+        self.assertFalse(PieceDetail.objects.filter(pk=p.pk).exists())
+        self.assertEqual(PieceDetail.lookup(p.pk)['collection'],
+                         {'tag': 'jj', 'title': 'Jimjams'})
+        p.title = 'Jimjam Rag'
+        p.save()
+        self.assertEqual(PieceDetail.lookup(p.pk)['title'], 'Jimjam Rag')
+        self.assertIsNone(PieceDetail.lookup(99))
+
+        # So do edits of the rows shown with a piece.
+        p.composer.description = 'Jimmy Jay'
+        p.composer.save()
+        self.assertEqual(PieceDetail.lookup(p.pk)['byline'], 'by Jimmy Jay')
+        asset = p.assetmap_set.get()
+        asset.uses_svg = True
+        asset.save()
+        self.assertTrue(PieceDetail.lookup(p.pk)['asset']['uses_svg'])
+        asset.delete()
+        self.assertIsNone(PieceDetail.lookup(p.pk)['asset'])
+        p.license.delete()
+        self.assertIsNone(PieceDetail.lookup(p.pk)['license'])
+        violin = Instrument.objects.create(instrument='Violin')
+        violin.piece_set.add(p)
+        self.assertEqual(PieceDetail.lookup(p.pk)['instruments'],
+                         ['Piano', 'Violin'])
+        violin.piece_set.clear()
+        self.assertEqual(PieceDetail.lookup(p.pk)['instruments'], ['Piano'])
+        col.delete()
+        self.assertIsNone(PieceDetail.lookup(p.pk)['collection'])
+
 class LicenseTests(TestCase):
     def test_license(self):
         cc = License.objects.create(name='Public', url='http://public-domain/')
@@ -0,0 +1,84 @@
+from django.test import SimpleTestCase
+from mutopia.query import parse, compile_where, rank_tsquery, split_words
+from mutopia.query import SearchSyntaxError, conjoin
+
+
+class QueryTests(SimpleTestCase):
+
+    def test_parse(self):
+        self.assertIsNone(parse(''))
+        self.assertIsNone(parse(' ,; '))
+        self.assertEqual(str(parse('Bach, violin')), '(bach & violin)')
+        self.assertEqual(str(parse('a | b c')), '(a | (b & c))')
+        self.assertEqual(str(parse('!(a|b) & "Well Tempered"')),
+                         '(!(a | b) & "well tempered")')
+        self.assertEqual(str(parse("composer:BachJS version:'2.18'")),
+                         '(composer:"BachJS" & version:"2.18")')
+        # Apostrophes separate words.
+        self.assertEqual(str(parse("o'carolan")), '(o & carolan)')
+        self.assertEqual(str(parse("jesu, joy of man's desiring")),
+                         '(jesu & joy & of & man & s & desiring)')
+        self.assertEqual(str(parse("don't | 'tis")), '((don & t) | tis)')
+
+        for bad in ['a &', '| a', '(a', 'a)', '"a', 'key:C', 'since:May',
+                    'composer:"Bach', '!']:
+            with self.assertRaises(SearchSyntaxError):
+                parse(bad)
+
+    def test_conjoin(self):
+        self.assertEqual(conjoin('', 'rag'), 'rag')
+        self.assertEqual(conjoin('rag | waltz', 'composer:"JayJ"'),
+                         '((rag | waltz) & composer:"JayJ")')
+        self.assertEqual(conjoin(' ,; '), '')
+        with self.assertRaises(SearchSyntaxError):
+            conjoin('rag) | (waltz', 'composer:"JayJ"')
+
+    def test_compile(self):
+        node = parse('(a | b) !c composer:BachJS')
+        where, params = compile_where(node, 's')
+        # Words are grouped into one tsquery, scoped to the composer.
+        self.assertEqual(params, ['((a | b) & !c)', "'composer=bachjs'"])
+        self.assertTrue(where.startswith("s.document @@ (to_tsquery("))
+        self.assertEqual(rank_tsquery(node), '((a | b))')
+
+        # Other qualifiers follow.
+        where, params = compile_where(
+            parse("a composer:BachJS style:Popular/Dance since:2017-01-31"),
+            's')
+        self.assertEqual(params, ['a',
+                                  "'composer=bachjs' & 'style=popular/dance'",
+                                  '2017-01-31'])
+        self.assertTrue(where.endswith('.date_published >= %s)'))
+        where, params = compile_where(parse('a | composer:BachJS'), 's')
+        self.assertEqual(params, ['a', 'BachJS'])
+
+        where, params = compile_where(parse('a | version:2.1'), 's')
+        self.assertIn(' OR ', where)
+        self.assertEqual(params, ['a', '2.1', '2.1.%'])
+
+        # Instruments are grouped into one array test.
+        where, params = compile_where(
+            parse('instrument:Violin instrument:cello,viola version:2'), 's')
+        self.assertIn('s.instruments @> %s::text[]', where)
+        self.assertEqual(params, ['2', '2.%', ['cello', 'viola', 'violin']])
+        where, params = compile_where(
+            parse('instrument:Violin instrument:cello a'), 's')
+        self.assertEqual(params, ['a', "'instrument=violin' & "
+                                       "'instrument=cello'"])
+        where, params = compile_where(
+            parse('instrument:violin | instrument:cello'), 's')
+        self.assertEqual(where, 's.instruments && %s::text[]')
+        self.assertEqual(params, [['cello', 'violin']])
+        # ... but an instrument list of a disjunction keeps its meaning.
+        where, params = compile_where(
+            parse('instrument:violin,cello | instrument:viola'), 's')
+        self.assertEqual(where, '(s.instruments @> %s::text[] OR '
+                                's.instruments @> %s::text[])')
+        self.assertEqual(params, [['violin', 'cello'], ['viola']])
+
+    def test_split_words(self):
+        self.assertEqual(split_words(parse('a "b c"'))[0], ['a', 'b', 'c'])
+        words, qualifiers = split_words(parse('a style:Jazz'))
+        self.assertEqual(words, ['a'])
+        self.assertEqual(len(qualifiers), 1)
+        self.assertIsNone(split_words(parse('a | b')))
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+from unittest import mock
+from django.conf import settings
+from django.db import ProgrammingError
+from django.test import TestCase, override_settings
+from django.core.urlresolvers import reverse
+from mutopia.search import SearchTerm, suggest, did_you_mean
+from mutopia.cache import new_generation
+from mutopia.search_backends import get_backend
+from mutopia.query import SearchSyntaxError
+from mutopia.models import Instrument
+from update.models import InstrumentMap
+from . import tutils
+
+
+class SQLiteSearchTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.p2 = tutils.make_piece(piece_id=2,
+                                   title='Devil Mountain Rag')
+        cls.p3 = tutils.make_piece(piece_id=3,
+                                   title='Suppertime Blues')
+        cls.p4 = tutils.make_piece(piece_id=4,
+                                   title='Swingshift Blües') # note diacritical
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        backend = override_settings(
+            SEARCH_BACKEND='mutopia.search_backends.sqlite.SQLiteBackend',
+            SEARCH_SQLITE_PATH=os.path.join(tmpdir.name, 'search.sqlite3'))
+        backend.enable()
+        self.addCleanup(backend.disable)
+        SearchTerm.rebuild_view()
+        new_generation()
+
+    def search(self, keywords):
+        return [str(p) for p in SearchTerm.search(keywords)]
+
+    def test_sqlite_search(self):
+        # The same behaviour as test_fts.FTSTests.test_fts_search
+        for term in ['blues', 'Blües', 'BLUES']:
+            self.assertEqual(sorted(self.search(term)),
+                             sorted([str(self.p3), str(self.p4)]))
+        self.assertEqual(sorted(self.search('suppertime|mountain')),
+                         sorted([str(self.p2), str(self.p3)]))
+        self.assertEqual(self.search('devil rag'), [str(self.p2)])
+        self.assertEqual(self.search('devil swingshift'), [])
+        self.assertEqual(self.search('blues & !suppertime'), [str(self.p4)])
+        self.assertEqual(self.search('!suppertime & !mountain'),
+                         [str(self.p4)])
+        self.assertEqual(self.search('"devil mountain"'), [str(self.p2)])
+        self.assertEqual(self.search('"mountain devil"'), [])
+        with self.assertRaises(SearchSyntaxError):
+            SearchTerm.search('!++&')
+
+    def test_sqlite_qualifiers(self):
+        violin, _ = Instrument.objects.get_or_create(instrument='Violin')
+        self.p3.instruments.add(violin)
+        self.assertEqual(self.search('blues instrument:violin,piano'),
+                         [str(self.p3)])
+        self.assertEqual(len(self.search('composer:jayj version:2.19')), 3)
+        self.assertEqual(self.search('rag | style:nothing'), [str(self.p2)])
+        self.assertEqual(SearchTerm.ranked_ids('blues', pk=self.p4.pk),
+                         [self.p4.pk])
+
+        # Facets are counted with the ORM.
+        facets = SearchTerm.facets('blues')
+        self.assertEqual(facets['composer'][0]['count'], 2)
+        self.assertEqual([(f['value'], f['count'])
+                          for f in facets['instrument']],
+                         [('Piano', 2), ('Violin', 1)])
+        self.assertEqual(facets['version'][0]['value'], '2.19')
+
+    @mock.patch('mutopia.search.RESULT_LIMIT', 1)
+    def test_sqlite_result_limit(self):
+        self.assertEqual(len(SearchTerm.ranked_ids('blues')), 1)
+        self.assertEqual(SearchTerm.ranked_ids('blues', pk=self.p3.pk),
+                         [self.p3.pk])
+
+    def test_sqlite_rank_and_suggest(self):
+        # Title matches rank above matches in the source.
+        p5 = tutils.make_piece(piece_id=5, title='Source Material')
+        self.assertEqual(self.search('manuscript | material')[0], str(p5))
+        new_generation()
+        self.assertEqual(suggest('swing bl')['titles'],
+                         [{'id': self.p4.pk, 'title': self.p4.title}])
+        self.assertIn('search', SearchTerm.explain('blues'))
+
+    def test_sqlite_headlines(self):
+        headlines = SearchTerm.headlines('blues composer:jayj',
+                                         [self.p2.pk, self.p3.pk])
+        self.assertEqual(list(headlines), [self.p3.pk])
+        self.assertIn('<mark>Blues</mark>', headlines[self.p3.pk])
+
+    def test_sqlite_did_you_mean(self):
+        self.assertEqual(did_you_mean('devel montain'), '(devil & mountain)')
+
+    def test_sqlite_synonyms(self):
+        ukulele, _ = Instrument.objects.get_or_create(instrument='Ukulele')
+        InstrumentMap.objects.create(raw_instrument='uke',
+                                     instrument=ukulele)
+        self.p2.instruments.add(ukulele)
+        self.assertEqual(self.search('uke'), [str(self.p2)])
+        self.assertEqual(len(self.search('"jay j" blues')), 2)
+
+    def test_sqlite_no_index(self):
+        os.remove(settings.SEARCH_SQLITE_PATH)
+        with self.assertLogs('mutopia.search_backends.sqlite', 'INFO'):
+            get_backend().reindex()
+        self.assertFalse(os.path.exists(settings.SEARCH_SQLITE_PATH))
+        with self.assertRaises(ProgrammingError):
+            SearchTerm.search('blues')
+        response = self.client.get(reverse('key-results'),
+                                   {'keywords': 'blues'})
+        self.assertContains(response, 'Unable to parse keywords')
+
+    def test_sqlite_delete(self):
+        p5 = tutils.make_piece(piece_id=5, title='Devil Mountain Waltz')
+        self.assertEqual(len(self.search('devil')), 2)
+        p5.delete()
+        self.assertEqual(self.search('devil'), [str(self.p2)])
+        self.assertEqual(len(SearchTerm.ranked_ids('composer:jayj')), 3)
+
+    def test_sqlite_no_style(self):
+        self.p2.style = None
+        self.p2.save()
+        self.assertEqual(self.search('devil'), [str(self.p2)])
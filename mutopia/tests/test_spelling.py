@@ -0,0 +1,30 @@
+from django.test import SimpleTestCase
+from mutopia.spelling import Vocabulary, edit_distance, max_edits
+
+
+class SpellingTests(SimpleTestCase):
+
+    def test_edit_distance(self):
+        self.assertEqual(edit_distance('blues', 'blues', 2), 0)
+        self.assertEqual(edit_distance('bleus', 'blues', 2), 1)
+        self.assertEqual(edit_distance('infirmery', 'infirmary', 2), 1)
+        self.assertEqual(edit_distance('sonata', 'sonatina', 2), 2)
+        # Beyond the limit the distance is only known to be greater.
+        self.assertEqual(edit_distance('bach', 'beethoven', 2), 3)
+        self.assertEqual(edit_distance('minuet', 'menuet', 0), 1)
+        self.assertEqual([max_edits(w) for w in ['rag', 'waltz', 'sonata']],
+                         [0, 1, 2])
+
+    def test_correct(self):
+        words = Vocabulary([('sonata', 40), ('sonatina', 12),
+                            ('sonatas', 3), ('rag', 9), ('waltz', 7)])
+        self.assertEqual(len(words), 5)
+        self.assertIn('rag', words)
+        self.assertIsNone(words.correct('sonata'))
+        self.assertEqual(words.correct('sonnata'), 'sonata')
+        self.assertEqual(words.correct('sonatinna'), 'sonatina')
+        self.assertEqual(words.correct('walts'), 'waltz')
+        # Short words and words too far from any others are left.
+        self.assertIsNone(words.correct('rog'))
+        self.assertIsNone(words.correct('partita'))
+        self.assertIsNone(words.correct('1750'))
@@ -0,0 +1,57 @@
+from unittest import mock
+from django.test import TestCase, override_settings
+from django.core.cache import caches
+from django.core.urlresolvers import reverse
+from mutopia.throttle import count_request, throttled_count
+
+
+@override_settings(THROTTLE_RATES={'key_results': (2, 60)})
+class ThrottleTests(TestCase):
+
+    def setUp(self):
+        caches['throttle'].clear()
+        # Requests of a test fall in one window.
+        clock = mock.patch('mutopia.throttle.time')
+        clock.start().time.return_value = 100.5
+        self.addCleanup(clock.stop)
+
+    def test_count_request(self):
+        # Two requests in each two second window.
+        self.assertEqual(count_request('key_results', 'a', now=100.0), 0)
+        self.assertEqual(count_request('key_results', 'a', now=100.0), 0)
+        self.assertEqual(count_request('key_results', 'a', now=100.0), 2)
+        # Clients are counted apart.
+        self.assertEqual(count_request('key_results', 'b', now=100.0), 0)
+        self.assertEqual(count_request('key_results', 'a', now=101.5), 1)
+        self.assertEqual(count_request('key_results', 'a', now=102.0), 0)
+        self.assertEqual(count_request('key_results', 'a', now=103.0), 0)
+        self.assertEqual(count_request('key_results', 'a', now=103.5), 1)
+        self.assertEqual(count_request('key_results', 'a', now=110.0), 0)
+
+    def test_throttled_view(self):
+        url = reverse('key-results')
+        for i in range(2):
+            self.assertEqual(self.client.get(url).status_code, 200)
+        response = self.client.get(url, {'page': 400})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '2')
+        self.assertEqual(throttled_count('key_results'), 1)
+
+        # Views without rates are not throttled.
+        for i in range(3):
+            response = self.client.get(reverse('adv-results'))
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(throttled_count('adv_results'), 0)
+
+    @override_settings(THROTTLE_CLIENT_HEADER='HTTP_X_FORWARDED_FOR')
+    def test_forwarded_clients(self):
+        url = reverse('key-results')
+        for client in ('10.0.0.1', '10.0.0.2'):
+            # Forged addresses before the balancer's are ignored.
+            for forged in ('1.1.1.1', '2.2.2.2'):
+                response = self.client.get(
+                    url, HTTP_X_FORWARDED_FOR=forged + ', ' + client)
+                self.assertEqual(response.status_code, 200)
+        response = self.client.get(url, HTTP_X_FORWARDED_FOR='10.0.0.2')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(throttled_count('key_results'), 1)
@@ -1,5 +1,7 @@
 from django.test import TestCase
+from django.core.cache import cache
 from mutopia.utils import Singleton
+from mutopia.cache import LRUCache, catalogue_generation, new_generation
 
 @Singleton
 class Adder:
@@ -30,3 +32,34 @@ class UtilityTests(TestCase):
 
         with self.assertRaises(TypeError):
             bad = Adder()
+
+
+class LRUCacheTests(TestCase):
+
+    def test_lru(self):
+        lru = LRUCache(maxsize=2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        self.assertEqual(lru.get('a'), 1)
+        # 'b' is now the least recently used and is evicted.
+        lru.set('c', 3)
+        self.assertEqual(len(lru), 2)
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(lru.get('c'), 3)
+        self.assertEqual(lru.stats(), {'hits': 2, 'misses': 1,
+                                       'size': 2, 'maxsize': 2})
+        lru.clear()
+        self.assertEqual(len(lru), 0)
+        self.assertEqual(lru.stats()['hits'], 0)
+
+
+class GenerationTests(TestCase):
+
+    def test_generation(self):
+        generation = new_generation()
+        self.assertEqual(catalogue_generation(), generation)
+        self.assertGreater(new_generation(), generation)
+        # The stamp survives anything done to the shared cache.
+        generation = catalogue_generation()
+        cache.clear()
+        self.assertEqual(catalogue_generation(), generation)
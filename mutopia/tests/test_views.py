@@ -1,9 +1,25 @@
-from django.test import TestCase
+import datetime
+import gzip
+import hashlib
+import html
+import re
+import time
+from django.test import TestCase, override_settings
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.cache import caches
+from django.http import HttpResponse, QueryDict
+from django.middleware.csrf import get_token
 from django.test.client import RequestFactory
 from django.core.urlresolvers import reverse
+from unittest import mock
 from mutopia.forms import KeySearchForm
-from mutopia.views import handler404, key_results
+from mutopia.views import handler404, key_results, _narrowing
+from mutopia.views import _search_params
 from mutopia.models import Composer, Instrument, Style, AssetMap, LPVersion
+from mutopia.search import SearchTerm
+from mutopia.search_backends.base import QueryTimeout
+from mutopia.cache import new_generation, recent_generation
+from mutopia.cache import cached_page, PAGE_KEY
 from . import tutils
 
 
@@ -25,6 +41,10 @@ class ViewTests(TestCase):
                                         has_lys=False)
         asset.save()
 
+    def setUp(self):
+        # Request buckets are kept in memory between tests.
+        caches['throttle'].clear()
+
     def test_404(self):
         factory = RequestFactory()
         request = factory.get('/badurl')
@@ -56,16 +76,151 @@ class ViewTests(TestCase):
         self.assertTemplateUsed(response, 'mutopia/results.html')
 
 
+    def test_adv_results_qualifiers(self):
+        response = self.client.get(reverse('adv-results'),
+                                   {'searchingfor': 'james',
+                                    'lilyv': 'on',
+                                    'lilyversion': '2.19',
+                                    'recent': 'on',
+                                    'timelength': 1,
+                                    'timeunit': 'WEEK'},
+                                   follow=True)
+        self.assertEqual(list(response.context['pieces']), [self.p])
+        response = self.client.get(reverse('adv-results'),
+                                   {'searchingfor': 'james',
+                                    'lilyv': 'on',
+                                    'lilyversion': '2.18'},
+                                   follow=True)
+        self.assertEqual(list(response.context['pieces']), [])
+        # Searches cannot escape the other fields.
+        response = self.client.get(reverse('adv-results'),
+                                   {'searchingfor': 'rag) | (james',
+                                    'lilyv': 'on',
+                                    'lilyversion': '2.18'},
+                                   follow=True)
+        self.assertIn('Unable to parse search', response.context['message'])
+
+
     def test_key_results(self):
         response = self.client.get(reverse('key-results'))
         self.assertEqual(response.status_code, 200)
         self.assertTemplateUsed(response, 'mutopia/results.html')
 
 
+    def test_key_results_stateless(self):
+        for piece_id in range(30, 60):
+            tutils.make_piece(piece_id=piece_id, title='Jimjam Rag')
+        response = self.client.get(reverse('key-results'),
+                                   {'keywords': 'jimjam'})
+        self.assertContains(response, '?page=2&amp;keywords=jimjam')
+        self.assertIn('public', response['Cache-Control'])
+        self.assertNotIn('Vary', response)
+        self.assertFalse(response.cookies)
+
+        # Another client can follow the link without a session.
+        self.client.cookies.clear()
+        response = self.client.get(reverse('key-results') +
+                                   '?page=2&keywords=jimjam')
+        self.assertEqual(len(response.context['pieces']), 5)
+
+    def test_canonical_search(self):
+        url = reverse('adv-results')
+        response = self.client.get(url, {'searchingfor': 'james',
+                                          'composer': '',
+                                          'lilyv': 'on',
+                                          'page': 1})
+        self.assertRedirects(response,
+                             url + '?page=1&lilyv=on&searchingfor=james',
+                             status_code=301)
+        response = self.client.get(reverse('key-results') + '?keywords=')
+        self.assertRedirects(response, reverse('key-results'),
+                             status_code=301)
+
+    def test_search_params(self):
+        query = QueryDict('style=Ska&page=3&composer=&instrument=Uke'
+                          '&instrument=Banjo&searchingfor=rag')
+        self.assertEqual(_search_params(query),
+                         'instrument=Banjo&instrument=Uke'
+                         '&searchingfor=rag&style=Ska')
+
+    def test_key_results_facets(self):
+        response = self.client.get(reverse('key-results'),
+                                   {'keywords': 'james'})
+        # A single piece has nothing to narrow.
+        self.assertEqual(response.context['facets'], [])
+
+        facets = {'composer': [], 'instrument': [], 'version': [],
+                  'style': [{'value': 'Ska', 'label': 'Ska', 'count': 2},
+                            {'value': 'Swing', 'label': 'Swing', 'count': 1}]}
+        narrowing = _narrowing('a | b', facets)
+        self.assertEqual(narrowing[0][0], 'style')
+        self.assertEqual(narrowing[0][1][0]['keywords'],
+                         '(a | b) style:"Ska"')
+
+        # Facet links are canonical searches.
+        rag = tutils.make_piece(piece_id=3, title='St. James Rag')
+        rag.style = Style.objects.exclude(pk=self.p.style_id).first()
+        rag.save()
+        new_generation()
+        response = self.client.get(reverse('key-results'),
+                                   {'keywords': 'james'})
+        name, values = response.context['facets'][0]
+        self.assertContains(response, 'href="{0}"'.format(values[0]['url']))
+        response = self.client.get(values[0]['url'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['pieces']), 1)
+
+
+    def test_key_results_syntax(self):
+        response = self.client.get(reverse('key-results'),
+                                   {'keywords': 'james &'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Unable to parse search', response.context['message'])
+
+
+    def test_key_results_timeout(self):
+        timeout = mock.patch.object(SearchTerm, 'ranked_ids',
+                                    side_effect=QueryTimeout('canceled'))
+        with timeout, mock.patch.object(SearchTerm, 'stale_ids',
+                                        return_value=[self.p.pk]):
+            response = self.client.get(reverse('key-results'),
+                                       {'keywords': 'james'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['degraded'])
+        self.assertEqual(list(response.context['pieces']), [self.p])
+        self.assertEqual(response.context['facets'], [])
+
+
+    def test_key_results_similar(self):
+        response = self.client.get(reverse('key-results'),
+                                   {'keywords': 'Infirmery'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['similar'])
+        self.assertEqual(list(response.context['pieces']), [self.p])
+        self.assertEqual(response.context['did_you_mean'], 'infirmary')
+        response = self.client.get(response.context['did_you_mean_url'])
+        self.assertEqual(response.status_code, 200)
+
+
+    def test_suggest(self):
+        response = self.client.get(reverse('suggest'), {'q': 'st jam'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('public', response['Cache-Control'])
+        self.assertEqual(response.json()['titles'][0]['id'], self.p.pk)
+
+
     def test_piece_info(self):
         response = self.client.get(reverse('piece-info', args=[2]))
         self.assertEqual(response.status_code, 200)
         self.assertTemplateUsed(response, 'mutopia/piece_info.html')
+        self.assertContains(response, 'St. James Infirmary')
+        self.assertContains(response, 'st-james-infirmary-preview.svg')
+        version = self.p.version.version
+        self.assertContains(response, '>{0}</a>'.format(version))
+        self.assertContains(response, 'href="{0}"'.format(
+            reverse('piece-by-version', args=[version])))
+        response = self.client.get(reverse('piece-info', args=[99]))
+        self.assertEqual(response.status_code, 404)
 
 
     def test_piece_by_version(self):
@@ -86,6 +241,94 @@ class ViewTests(TestCase):
         self.assertTemplateUsed(response, 'mutopia/piece_composer.html')
 
 
+    def test_piece_by_composer_search(self):
+        url = reverse('piece-by-composer', args=[self.p.composer.composer])
+        response = self.client.get(url, {'q': 'infirmary'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.context['pager']), [self.p])
+        response = self.client.get(url, {'q': 'rag'})
+        self.assertEqual(list(response.context['pager']), [])
+        response = self.client.get(url, {'q': 'james &'})
+        self.assertIn('Unable to parse search', response.context['message'])
+        self.assertEqual(list(response.context['pager']), [self.p])
+        # Searches cannot escape the listing.
+        response = self.client.get(url, {'q': 'rag) | (infirmary'})
+        self.assertIn('Unable to parse search', response.context['message'])
+
+
+    def test_listing_queries(self):
+        for piece_id in range(30, 34):
+            tutils.make_piece(piece_id=piece_id, title='Jimjam Rag')
+        new_generation()
+        url = reverse('piece-by-composer', args=[self.p.composer_id])
+        # The composer, the page validators and the page, however many
+        # pieces are listed.
+        with self.assertNumQueries(3):
+            response = self.client.get(url)
+        self.assertContains(response, 'Jimjam Rag', count=4)
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('latest_additions'))
+        self.assertContains(response, 'Jimjam Rag', count=4)
+
+    def test_keyset_pages(self):
+        for piece_id in range(30, 60):
+            tutils.make_piece(piece_id=piece_id, title='Jimjam Rag')
+        Composer.update_piece_counts()
+        new_generation()
+        url = reverse('piece-by-composer', args=[self.p.composer_id])
+        first = self.client.get(url).context['pager']
+        self.assertEqual([p.piece_id for p in first], list(range(59, 34, -1)))
+        self.assertFalse(first.has_previous())
+        self.assertEqual(first.next_cursor, 35)
+
+        # A deep page costs the same as the first.
+        with self.assertNumQueries(3):
+            response = self.client.get(url, {'page': 2, 'after': 35})
+        self.assertContains(response, 'Page 2 of 2')
+        self.assertContains(response, '?page=1&amp;before=34"')
+        last = response.context['pager']
+        self.assertEqual([p.piece_id for p in last],
+                         [34, 33, 32, 31, 30, 2])
+        self.assertTrue(last.has_previous())
+        self.assertFalse(last.has_next())
+
+        response = self.client.get(url, {'page': 1, 'before': 34})
+        self.assertEqual(list(response.context['pager']), list(first))
+        self.assertFalse(response.context['pager'].has_previous())
+
+        # Page numbers are only carried in the URL, and are kept
+        # within the listing.
+        response = self.client.get(url, {'page': 500, 'after': 35})
+        self.assertContains(response, 'Page 2 of 2')
+        response = self.client.get(url, {'page': 500, 'after': 58})
+        self.assertContains(response, 'Page 2 of 3')
+
+    def test_keyset_walk_back(self):
+        for piece_id in range(30, 105):
+            tutils.make_piece(piece_id=piece_id, title='Jimjam Rag')
+        # An approximate count, the real listing has four pages.
+        composer = Composer.objects.get(pk=self.p.composer_id)
+        composer.piece_count = 26
+        composer.save()
+        new_generation()
+        url = reverse('piece-by-composer', args=[self.p.composer_id])
+
+        def follow(response, label):
+            link = re.search(r'<a href="(\?[^"]*)">' + label,
+                             response.content.decode())
+            return self.client.get(url + html.unescape(link.group(1)))
+
+        pages = [self.client.get(url)]
+        for i in range(3):
+            pages.append(follow(pages[-1], '&raquo'))
+        self.assertEqual(list(pages[-1].context['pager']), [self.p])
+        response = pages[-1]
+        for page in reversed(pages[:-1]):
+            response = follow(response, '&laquo')
+            self.assertEqual(list(response.context['pager']),
+                             list(page.context['pager']))
+        self.assertFalse(response.context['pager'].has_previous())
+
     def test_piece_by_style(self):
         s = Style.objects.all()[0]
         response = self.client.get(reverse('piece-by-style', args=[s.slug]))
@@ -101,7 +344,128 @@ class ViewTests(TestCase):
         self.assertTemplateUsed(response, 'mutopia/piece_instrument.html')
 
 
-    def test_log_info(self):
+    @mock.patch('mutopia.changelog.requests.get')
+    def test_log_info(self, get):
+        get.return_value.text = 'Fixed a typo'
         response = self.client.get(reverse('piece-log', args=[self.p.pk]))
         self.assertEqual(response.status_code, 200)
         self.assertTemplateUsed(response, 'mutopia/piece_log.html')
+        self.assertContains(response, 'Fixed a typo')
+
+        get.reset_mock()
+        response = self.client.get(reverse('piece-log', args=[self.p.pk]))
+        self.assertContains(response, 'Fixed a typo')
+        get.assert_not_called()
+
+
+@override_settings(PAGE_CACHE_TIMEOUT=60)
+class PageCacheTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        tutils.init_fts()
+        cls.p = tutils.make_piece(piece_id=2, title='St. James Infirmary')
+
+    def setUp(self):
+        caches['pages'].clear()
+        new_generation()
+
+    def test_cached_page(self):
+        url = reverse('piece-by-composer', args=[self.p.composer_id])
+        page = self.client.get(url, {'q': 'james'})
+        self.assertContains(page, 'St. James Infirmary')
+        # Served from the cache without a query, compressed for
+        # clients that accept it.
+        with self.assertNumQueries(0):
+            response = self.client.get(url, {'q': 'james'})
+            self.assertEqual(response.content, page.content)
+            response = self.client.get(url, {'q': 'james'},
+                                       HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.content), page.content)
+
+        # Query strings are part of the key.
+        response = self.client.get(url, {'q': 'rag'})
+        self.assertNotContains(response, 'St. James Infirmary')
+
+        # A new generation invalidates every page.
+        self.p.title = 'St. James Hospital'
+        self.p.save()
+        self.assertContains(self.client.get(url, {'q': 'james'}),
+                            'St. James Infirmary')
+        new_generation()
+        self.assertContains(self.client.get(url, {'q': 'james'}),
+                            'St. James Hospital')
+
+    def test_personal_pages(self):
+        # Pages using the token or session of a visitor are not
+        # cached, although the cookies are only set by middleware.
+        def csrf_view(request):
+            return HttpResponse(get_token(request))
+
+        def session_view(request):
+            return HttpResponse(request.session.get('name', ''))
+
+        key = PAGE_KEY.format(recent_generation(),
+                              hashlib.md5(b'/personal/').hexdigest())
+        factory = RequestFactory()
+        for view in [csrf_view, session_view,]:
+            request = factory.get('/personal/')
+            request.session = SessionStore()
+            cached_page(view)(request)
+            self.assertIsNone(caches['pages'].get(key))
+
+        request = factory.get('/personal/')
+        request.session = SessionStore()
+        cached_page(lambda request: HttpResponse('Hello'))(request)
+        self.assertIsNotNone(caches['pages'].get(key))
+
+    def test_conditional_page(self):
+        self.p.date_published -= datetime.timedelta(days=1)
+        self.p.save()
+        new_generation()
+        url = reverse('piece-by-composer', args=[self.p.composer_id])
+        page = self.client.get(url)
+        etag = page['ETag']
+        modified = page['Last-Modified']
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=modified)
+        self.assertEqual(response.status_code, 304)
+        # Every page of a listing shares its validators.
+        response = self.client.get(url, {'page': 2},
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # Editing a piece changes both, whenever it was published.
+        self.p.title = 'St. James Hospital'
+        self.p.save()
+        later = time.time() + 10
+        with mock.patch('mutopia.cache.time.time', return_value=later):
+            new_generation()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'St. James Hospital')
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=modified)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        # Republishing it changes the validators.
+        self.p.date_published -= datetime.timedelta(days=2)
+        self.p.save()
+        new_generation()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+        # Unknown pieces have no validators.
+        response = self.client.get(reverse('piece-info', args=[99]),
+                                   HTTP_IF_NONE_MATCH='*')
+        self.assertEqual(response.status_code, 404)
+
+    def test_conditional_feed(self):
+        feed = self.client.get(reverse('latest-rss'))
+        self.assertEqual(feed.status_code, 200)
+        response = self.client.get(reverse('latest-rss'),
+                                   HTTP_IF_NONE_MATCH=feed['ETag'])
+        self.assertEqual(response.status_code, 304)
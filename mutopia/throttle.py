@@ -0,0 +1,118 @@
+"""
+.. module:: throttle
+   :platform: Linux
+   :synopsis: Per-client rate limits for expensive views
+
+.. moduleauthor:: Glen Larsen <glenl.glx@gmail.com>
+
+Searches and change logs cost real database (or network) time and
+their ``?page=`` links are followed endlessly by crawlers. Views
+decorated with :func:`throttle` count each client's requests against
+the rates configured for each view by the ``THROTTLE_RATES`` setting:
+a burst of requests is allowed in each window of time in which the
+sustained rate would allow as many. Counts are kept in the shared
+``throttle`` cache and only updated with ``add`` and ``incr`` so every
+process and host counts against the same limit. Clients over the
+limit get a bare 429 response, counted by :func:`throttled_count`.
+
+Behind a load balancer every request comes from the balancer's
+address, so clients are then identified by the header named in
+``THROTTLE_CLIENT_HEADER`` (see :func:`client_id`).
+
+"""
+
+import logging
+import math
+import time
+from functools import wraps
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+
+logger = logging.getLogger(__name__)
+
+WINDOW_KEY = 'mutopia:throttle:{0}:{1}:{2}'
+THROTTLED_KEY = 'mutopia:throttled:{0}'
+
+
+def client_id(request):
+    """Identify the client making a request by its address. If
+    ``THROTTLE_CLIENT_HEADER`` names a header, such as
+    ``HTTP_X_FORWARDED_FOR``, the address is the last one in that
+    header, the one added by our own load balancer. Earlier addresses
+    are supplied by the client and cannot be trusted.
+
+    """
+    header = settings.THROTTLE_CLIENT_HEADER
+    if header and request.META.get(header):
+        return request.META[header].split(',')[-1].strip()
+    return request.META.get('REMOTE_ADDR', '')
+
+
+def _incr(cache, key, timeout):
+    """Add one to a count in the cache, starting it if it is missing."""
+    try:
+        return cache.incr(key)
+    except ValueError:
+        if cache.add(key, 1, timeout):
+            return 1
+        # Started by another request in the meantime.
+        return cache.incr(key)
+
+
+def count_request(name, client, now=None):
+    """Count a request of a client to a throttled view. A client may
+    make a burst of requests in each window of ``burst / rate``
+    seconds, so it is held to the sustained rate over time but may
+    make up to twice the burst across the end of a window.
+
+    :param str name: The name of the view in ``THROTTLE_RATES``.
+    :param str client: The client identifier.
+    :param float now: The current time, for testing.
+    :return: 0 if the request is allowed, otherwise the number of
+        seconds until the next window.
+    :rtype: int
+
+    """
+    burst, per_minute = settings.THROTTLE_RATES[name]
+    period = burst * 60.0 / per_minute
+    if now is None:
+        now = time.time()
+    window = int(now // period)
+    key = WINDOW_KEY.format(name, client, window)
+    # A count is only needed for its own window.
+    if _incr(caches['throttle'], key, math.ceil(period)) <= burst:
+        return 0
+    return math.ceil((window + 1) * period - now)
+
+
+def throttled_count(name):
+    """Return the number of requests to a view that were throttled."""
+    return caches['throttle'].get(THROTTLED_KEY.format(name), 0)
+
+
+def throttle(name):
+    """Decorate a view so each client is limited to the rates in
+    ``THROTTLE_RATES[name]``. Views without rates are not throttled.
+
+    :param str name: The name of the view in ``THROTTLE_RATES``.
+
+    """
+    def decorator(view):
+        @wraps(view)
+        def throttled_view(request, *args, **kwargs):
+            if name not in settings.THROTTLE_RATES:
+                return view(request, *args, **kwargs)
+            client = client_id(request)
+            wait = count_request(name, client)
+            if not wait:
+                return view(request, *args, **kwargs)
+
+            _incr(caches['throttle'], THROTTLED_KEY.format(name), None)
+            logger.info('Throttled %s for %s', name, client)
+            response = HttpResponse('Too many requests, please slow down.\n',
+                                    content_type='text/plain', status=429)
+            response['Retry-After'] = str(wait)
+            return response
+        return throttled_view
+    return decorator
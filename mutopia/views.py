@@ -5,49 +5,60 @@ application.
 
 """
 
-import time
+import re
 import datetime
-from django.shortcuts import render
-from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
+from functools import wraps
+from django.shortcuts import redirect, render
 from django.db.models import Max
 from django.shortcuts import HttpResponse, render
 from django.template import loader
+from django.core.urlresolvers import reverse
+from django.http import JsonResponse, QueryDict
+from django.utils.cache import patch_cache_control
+from django.utils.http import urlencode
+from django.views.decorators.http import require_safe
 from django.db import ProgrammingError
-from django.db.models import Count
+from django.db.models import Sum
 from mutopia.models import Piece, Composer, License, Style
 from mutopia.models import Instrument, Collection
 from mutopia.forms import KeySearchForm, AdvSearchForm, SearchInterval
+from mutopia.forms import InstrumentMode
 from mutopia.forms import composer_choices, instrument_choices, style_choices
-from mutopia.search import SearchTerm
-
+from mutopia.search import SearchTerm, SearchTimer, suggest, FACETS
+from mutopia.search import log_slow_search, did_you_mean
+from mutopia.query import SearchSyntaxError, parse, qualifier, conjoin
+from mutopia.search_backends.base import QueryTimeout
+from mutopia.throttle import throttle
+from mutopia.cache import cached_page
+from mutopia.results import paginate_ids, search_error
+
+# The most values shown for any facet of a search.
+FACET_LIMIT = 10
+
+@cached_page
 def homepage(request):
     """
     The home page for the site.
 
     """
 
-    # The number of pieces referencing an instrument isn't provided in
-    # Instrument so we annotate in an extra column using an aggregate,
-    # then do a reverse sort to get the most frequent instrument at
-    # the top of the list.
+    # The most frequent instruments, composers and styles are read in
+    # order from their (indexed) piece counts, which are kept by
+    # dbupdate, so the piece table is never aggregated here.
     instruments = Instrument.objects.filter(in_mutopia=True)
-    instruments = instruments.annotate(count=Count('piece')).order_by('-count')
-
-    # similar for composers and styles
-    composers = Composer.objects.all()
-    composers = composers.annotate(count=Count('piece')).order_by('-count')
-
-    styles = Style.objects.filter(in_mutopia=True)
-    styles = styles.annotate(count=Count('piece')).order_by('-count')
+    instruments = instruments.order_by('-piece_count')
+    composers = Composer.objects.order_by('-piece_count')
+    styles = Style.objects.filter(in_mutopia=True).order_by('-piece_count')
 
     context = {
         'active' : 'home',
         'keyform': KeySearchForm(auto_id=False),
-        'latest_list' : Piece.objects.order_by('-piece_id')[:10],
+        'latest_list' : Piece.objects.listing().order_by('-piece_id')[:10],
         'instruments' : instruments[:18],
         'composers' : composers[:18],
         'styles' : styles[:18],
-        'pieces' : Piece.objects.count(),
+        'pieces' : Composer.objects.aggregate(
+            pieces=Sum('piece_count'))['pieces'] or 0,
         'collections' : Collection.objects.all()[:14],
     }
     return render(request, 'mutopia/index.html', context)
@@ -65,10 +76,12 @@ def adv_search(request):
         'instruments': instrument_choices(),
         'styles': style_choices(),
         'intervals': SearchInterval.INTERVAL_CHOICES,
+        'instrument_modes': InstrumentMode.MODE_CHOICES,
     }
     return render(request, 'mutopia/advsearch.html', context)
 
 
+@cached_page
 def legal(request):
     """
     The legal/license page is mostly HTML with a search form.
@@ -80,6 +93,7 @@ def legal(request):
     return render(request, 'mutopia/legal.html', context)
 
 
+@cached_page
 def contribute(request):
     """
     The contribute page display tables to help potential contributors
@@ -97,6 +111,7 @@ def contribute(request):
     return render(request, 'mutopia/contribute.html', context)
 
 
+@cached_page
 def browse(request):
     """
     The browse page is a page of links to the following items,
@@ -112,18 +127,20 @@ def browse(request):
     # also requires some fore-knowledge on the part of the template
     # since the presentation width is specified there.
 
+    # Each list is fetched once and split in memory, rather than
+    # counted and then queried for each column.
     # collection
-    col = Collection.objects.all()
-    csplit = round(col.count()/2)
+    col = list(Collection.objects.all())
+    csplit = round(len(col)/2)
     # composers
-    comp = Composer.objects.all()
-    comps = round(comp.count()/3)
+    comp = list(Composer.objects.all())
+    comps = round(len(comp)/3)
     # styles
-    style = Style.objects.all()
-    styles = round(style.count()/3)
+    style = list(Style.objects.all())
+    styles = round(len(style)/3)
 
-    inst = Instrument.objects.filter(in_mutopia=True)
-    insts = round(inst.count()/3)
+    inst = list(Instrument.objects.filter(in_mutopia=True))
+    insts = round(len(inst)/3)
     context = {
         'keyform': KeySearchForm(auto_id=False),
         'active' : 'browse',
@@ -141,6 +158,7 @@ def browse(request):
     return render(request, 'mutopia/browse.html', context)
 
 
+@cached_page
 def contact(request):
     """
     The contact page is HTML with a search form.
@@ -152,142 +170,288 @@ def contact(request):
     return render(request, 'mutopia/contact.html', context)
 
 
+def _narrowing(keywords, facets):
+    """Return the facets of a search for display, each value with the
+    keywords that narrow the search to it. Facets that cannot narrow
+    the search (those with a single value) are left out.
+
+    :param str keywords: The (valid) search.
+    :param dict facets: Facet counts from
+        :meth:`mutopia.search.SearchTerm.facets`.
+    :return: A list of ``(name, values)`` tuples, each value with its
+        ``keywords`` and their search ``url``.
+
+    """
+    node = parse(keywords)
+    search = str(node) + ' ' if node is not None else ''
+    narrowing = []
+    for name in FACETS:
+        if len(facets[name]) < 2:
+            continue
+        values = []
+        for facet in facets[name][:FACET_LIMIT]:
+            narrowed = search + qualifier(name, facet['value'])
+            values.append(dict(facet, keywords=narrowed,
+                               url=_search_url(narrowed)))
+        narrowing.append((name, values))
+    return narrowing
+
+
+def _run_search(keywords, page, fallback):
+    """Run a search, timing each phase, and return the context for
+    the requested page of its results. Slow searches are logged.
+
+    Queries that exceed their statement timeout degrade the response
+    rather than fail it: a search that times out shows the results it
+    last had in this process (or none) and the optional parts of the
+    page (similar pieces, facets and headlines) are left out.
+
+    :param str keywords: The search, may be empty.
+    :param page: The requested page number.
+    :param bool fallback: Look for similar titles and composers if
+        the search finds nothing. A correction of the spelling is
+        suggested either way.
+    :return: Context for ``mutopia/results.html``.
+    :rtype: dict
+    :raises mutopia.query.SearchSyntaxError: If the keywords cannot
+        be parsed.
+
+    """
+    timer = SearchTimer()
+    similar = False
+    degraded = False
+    correction = None
+    try:
+        with timer.phase('search'):
+            ids = SearchTerm.ranked_ids(keywords)
+    except QueryTimeout:
+        # Show the last results for this search, if there are any,
+        # rather than trying again.
+        degraded = True
+        ids = SearchTerm.stale_ids(keywords) or []
+    if not ids and not degraded:
+        with timer.phase('spelling'):
+            correction = did_you_mean(keywords)
+    if fallback and not ids and not degraded:
+        # Probably a misspelling, look for similar titles and
+        # composers instead.
+        try:
+            with timer.phase('similar'):
+                ids = SearchTerm.similar_ids(keywords)
+        except QueryTimeout:
+            degraded = True
+        similar = len(ids) > 0
+    facets = None
+    if ids and not degraded:
+        try:
+            with timer.phase('facets'):
+                facets = SearchTerm.facets(keywords, similar)
+        except QueryTimeout:
+            degraded = True
+    with timer.phase('page'):
+        pager = paginate_ids(ids, page)
+    if not similar and not degraded:
+        # Snippets for the visible page only.
+        try:
+            with timer.phase('headlines'):
+                headlines = SearchTerm.headlines(
+                    keywords, [piece.pk for piece in pager])
+        except QueryTimeout:
+            headlines = {}
+            degraded = True
+        for piece in pager:
+            piece.headline = headlines.get(piece.pk)
+    log_slow_search(keywords, timer, explain=not degraded)
+
+    return {
+        'pager': pager,
+        'pieces': pager,
+        'similar': similar,
+        'degraded': degraded,
+        'did_you_mean': correction,
+        'did_you_mean_url': _search_url(correction) if correction else '',
+        'facets': _narrowing(keywords, facets) if facets else [],
+        'search_time': '%2.4g' % timer.elapsed(),
+    }
+
+def _search_params(query):
+    """Return the search state of a request as a canonical query
+    string: the page number and empty values are dropped and the rest
+    are sorted, so equal searches have equal URLs. Pages of results
+    are linked by appending the page number.
+
+    :param QueryDict query: The request's GET parameters.
+    :rtype: str
+
+    """
+    return urlencode(sorted((name, value)
+                            for name, values in query.lists()
+                            if name != 'page'
+                            for value in values if value))
+
+
+def _search_url(keywords):
+    """Return the canonical URL of a keyword search, so links to it
+    are not redirected by :func:`_canonical_search`.
+
+    """
+    query = QueryDict(mutable=True)
+    query['keywords'] = keywords
+    return reverse('key-results') + '?' + _search_params(query)
+
+
+def _canonical_search(view):
+    """Decorate a search view so that GET requests with a query string
+    other than the canonical one (see :func:`_search_params`, with the
+    page number first as in paging links) are permanently redirected
+    to it, before the request is throttled or searched. Equal searches
+    then share a URL, and a cached copy of their results.
+
+    """
+    @wraps(view)
+    def canonical_view(request, *args, **kwargs):
+        if request.method != 'GET':
+            return view(request, *args, **kwargs)
+        canonical = _search_params(request.GET)
+        page = request.GET.get('page')
+        if page:
+            canonical = '&'.join(filter(None, [urlencode({'page': page}),
+                                               canonical]))
+        if request.META.get('QUERY_STRING', '') != canonical:
+            return redirect(request.path + ('?' + canonical if canonical
+                                            else ''),
+                            permanent=True)
+        return view(request, *args, **kwargs)
+    return canonical_view
+
+
+def _search_response(request, context):
+    """Render a page of search results. The URL holds the whole search
+    so complete results may be cached by browsers and proxies.
+
+    """
+    context['params'] = _search_params(request.GET)
+    response = render(request, 'mutopia/results.html', context)
+    if not context.get('degraded') and not context.get('message'):
+        patch_cache_control(response, public=True, max_age=300)
+    return response
+
+
+@_canonical_search
+@throttle('key_results')
 def key_results(request):
     """
     This responds to keyword search request (typically from the entry
     box on the jumbotron but could be anywhere. If there is more than
-    one page, this routine may be re-entered to process other pages.
+    one page, this routine may be re-entered to process other pages;
+    the keywords are always in the query string.
 
     """
 
     page = request.GET.get('page')
-    if page is None:
-        form = KeySearchForm(request.GET)
-        if form.is_valid():
-            # Uses session cookies to track the query between pages.
-            request.session['keywords'] = form.cleaned_data['keywords']
-
-    # If ther are no keywords here, the user entered nothing or the
+    form = KeySearchForm(request.GET)
+    # If there are no keywords here, the user entered nothing or the
     # form was not valid.
-    keywords = request.session.get('keywords', '')
+    keywords = form.cleaned_data['keywords'] if form.is_valid() else ''
 
     try:
-        query = SearchTerm.search(keywords)
-    except ProgrammingError:
+        if keywords:
+            context = _run_search(keywords, page, True)
+        else:
+            pieces = paginate_ids([], page)
+            context = {'pieces': pieces, 'pager': pieces}
+    except (SearchSyntaxError, ProgrammingError) as err:
         context = {
             'active' : 'None',
-            'message': 'Unable to parse keywords search terms',
+            'message': search_error(err),
             'keyform': KeySearchForm(),
         }
-        return render(request, 'mutopia/results.html', context)
+        return _search_response(request, context)
 
-    paginator = Paginator(query, 25)
-    try:
-        pieces = paginator.page(page)
-    except PageNotAnInteger:
-        # typically the first page of results
-        pieces = paginator.page(1)
-    except EmptyPage:
-        pieces = paginator.page(paginator.num_pages)
-
-    end_time = time.time()
-    context = {
+    context.update({
         'active' : 'None',
-        'pieces': pieces,
         'keyform': KeySearchForm(),
-        'pager': pieces,
         'keywords': keywords,
-    }
-    return render(request, 'mutopia/results.html', context)
+    })
+    return _search_response(request, context)
+
+
+@require_safe
+def suggestions(request):
+    """
+    Respond with JSON suggestions (titles, composers, and instruments)
+    for the text typed so far into a keyword search box. The responses
+    are small and may be cached by the browser.
+
+    """
+
+    response = JsonResponse(suggest(request.GET.get('q', '')))
+    patch_cache_control(response, public=True, max_age=300)
+    return response
 
 
+@_canonical_search
+@throttle('adv_results')
 def adv_results(request):
     """
     Process the form from an advanced search.
     We expect to always get here from the advanced search page and
     always on a get, either from the submit button on the form or the
-    paging navigation buttons.
-
-      * On first search submission, load the request session dictionary
-        from form values.
-
-      * On subsequent paging calls, if any, form values are pulled from
-        the session dictionary.
+    paging navigation buttons. Paging links repeat the form values so
+    every page is built from the query string alone.
 
     """
-    start_time = time.time()
     page = request.GET.get('page')
-    if page is None:
-        # reset session data
-        for item in ['searchingfor', 'composer', 'style', 'instrument', 'lilyversion']:
-            request.session[item] = ''
-        request.session['time_delta'] = 0
-
-        form = AdvSearchForm(request.GET)
-        if form.is_valid():
-            if len(form.cleaned_data['searchingfor']) > 0:
-                request.session['searchingfor'] = form.cleaned_data['searchingfor']
-            if len(form.cleaned_data['composer']) > 0:
-                request.session['composer'] = form.cleaned_data['composer']
-            if len(form.cleaned_data['style']) > 0:
-                request.session['style'] = form.cleaned_data['style']
-            if len(form.cleaned_data['instrument']):
-                request.session['instrument'] = form.cleaned_data['instrument']
-            if form.cleaned_data['lilyv']:
-                # still, the user has to fill something in here
-                if len(form.cleaned_data['lilyversion']) > 0:
-                    request.session['lilyversion'] = form.cleaned_data['lilyversion']
-
-            if form.cleaned_data['recent']:
-                # Store the computed time delta in days, not the value
-                # of recent. Note that 'timelength' and 'timeunit'
-                # values should exist per form constraints.
-                time_delta = form.cleaned_data['timelength']
-                if form.cleaned_data['timeunit'] == SearchInterval.WEEK:
-                    time_delta = 7 * time_delta
-                request.session['time_delta'] = time_delta
-        else:
-            pass                # request session will be cleared
-
-    # Now walk through the session variables to do the query and
-    # filtering.
-    if len(request.session['searchingfor']) > 0:
-        query = SearchTerm.search(request.session['searchingfor'])
-    else:
-        query = Piece.objects.all()
+    form = AdvSearchForm(request.GET)
+    # An invalid form is an empty search.
+    data = form.cleaned_data if form.is_valid() else {}
+
+    # Walk through the form values to build the search. The form
+    # fields become qualifiers so the whole search is compiled into
+    # a single query.
+    searchingfor = data.get('searchingfor', '')
+    if not re.search(r'\w', searchingfor):
+        searchingfor = ''
+    terms = [searchingfor]
 
     # Filter on composer, instrument, style, and LilyPond version
-    if len(request.session['composer']) > 0:
-        query = query.filter(composer=request.session['composer'])
-    if len(request.session['style']) > 0:
-        query = query.filter(style=request.session['style'])
-    if len(request.session['instrument']) > 0:
-        query = query.filter(instruments__pk=request.session['instrument'])
-    if len(request.session['lilyversion']) > 0:
-        query = query.filter(version__version__startswith=request.session['lilyversion'])
-
-    # Finally, filter on delta time in days
-    if request.session['time_delta'] > 0:
-        time_delta = datetime.timedelta(days=request.session['time_delta'])
-        target = datetime.date.today() - time_delta
-        query = query.filter(date_published__gte=target)
-
-    paginator = Paginator(query, 25)
+    if data.get('composer'):
+        terms.append(qualifier('composer', data['composer']))
+    if data.get('style'):
+        terms.append(qualifier('style', data['style']))
+    instruments = [i for i in data.get('instrument', []) if i]
+    if instruments:
+        # Several instruments compile to one indexed array test.
+        instruments = [qualifier('instrument', i) for i in instruments]
+        if data['instrument_mode'] == InstrumentMode.ANY:
+            terms.append('(' + ' | '.join(instruments) + ')')
+        else:
+            terms.extend(instruments)
+    if data.get('lilyv') and data['lilyversion']:
+        # still, the user has to fill something in here
+        terms.append(qualifier('version', data['lilyversion']))
+
+    # Finally, filter on delta time in days. Note that 'timelength'
+    # and 'timeunit' values should exist per form constraints.
+    if data.get('recent') and data['timelength']:
+        time_delta = data['timelength']
+        if data['timeunit'] == SearchInterval.WEEK:
+            time_delta = 7 * time_delta
+        target = datetime.date.today() - datetime.timedelta(days=time_delta)
+        terms.append(qualifier('since', target.isoformat()))
+
     try:
-        pager = paginator.page(page)
-    except PageNotAnInteger:
-        pager = paginator.page(1)
-    except EmptyPage:
-        pager = paginator.page(paginator.num_pages)
+        keywords = conjoin(*terms)
+        context = _run_search(keywords, page, bool(searchingfor))
+    except (SearchSyntaxError, ProgrammingError) as err:
+        context = {
+            'active' : 'None',
+            'message': search_error(err),
+        }
+        return _search_response(request, context)
 
-    end_time = time.time()
-    context = {
-        'active' : 'None',
-        'pager' : pager,
-        'pieces': pager,
-        'search_time': '%2.4g' % (end_time - start_time),
-    }
-    return render(request, 'mutopia/results.html', context)
+    context['active'] = 'None'
+    return _search_response(request, context)
 
 
 
@@ -10,6 +10,7 @@ EOF
 # migrate our django apps
 APPS="mutopia update"
 python manage.py migrate
+python manage.py createcachetable
 for app in $APPS ; do
     echo $app
     python manage.py makemigrations $app
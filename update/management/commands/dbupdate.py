@@ -10,10 +10,10 @@ from django.db import transaction
 from rdflib import Graph, URIRef, Namespace, URIRef
 from rdflib.term import Literal
 from mutopia.models import Composer, Style, Piece, Contributor
-from mutopia.models import LPVersion, AssetMap, License
+from mutopia.models import LPVersion, AssetMap, License, PieceDetail
 from update.models import Instrument, InstrumentMap
-from mutopia.search import SearchTerm
 from mutopia.utils import FTP_URL, parse_mutopia_id
+from mutopia.cache import new_generation
 
 logger = logging.getLogger(__name__)
 
@@ -23,6 +23,36 @@ MP = Namespace('http://www.mutopiaproject.org/piece-data/0.1/')
 class Command(BaseCommand):
     help = """Database load utility for the mutopia application."""
 
+    # The models with piece counts to keep current.
+    counted = (Composer, Style, LPVersion, Instrument)
+
+    def touch(self, piece):
+        """Note the composer, style, version, and instruments of a
+        piece so that their piece counts are updated, and the piece
+        itself so that its details are rebuilt.
+
+        """
+        self.touched[Piece].add(piece.pk)
+        self.touched[Composer].add(piece.composer_id)
+        self.touched[Style].add(piece.style_id)
+        self.touched[LPVersion].add(piece.version_id)
+        self.touched[Instrument].update(
+            piece.instruments.values_list('pk', flat=True))
+
+    def update_piece_counts(self):
+        """Recount the pieces of the rows touched by this update."""
+        for model in self.counted:
+            keys = self.touched[model] - {None}
+            logger.info('Updating %d %s piece counts'
+                        % (len(keys), model.__name__))
+            model.update_piece_counts(keys)
+
+    def update_piece_details(self):
+        """Rebuild the details of the pieces touched by this update."""
+        keys = self.touched[Piece]
+        logger.info('Updating %d piece details' % len(keys))
+        PieceDetail.update_details(keys)
+
     def update_instruments(self):
         """Update the instrument list for any piece that is missing
         instruments.
@@ -44,6 +74,8 @@ class Command(BaseCommand):
 
             for instr in mlist:
                 p.instruments.add(instr)
+                self.touched[Instrument].add(instr.pk)
+                self.touched[Piece].add(p.pk)
                 logger.info('Added %s to %s' % (instr,p.piece_id))
 
 
@@ -104,6 +136,8 @@ class Command(BaseCommand):
             try:
                 piece = Piece.objects.get(piece_id=mutopia_id)
                 logger.info('Found existing piece to update.')
+                # Its previous composer, etc., may lose a piece.
+                self.touch(piece)
                 piece.title = graph.value(mp_subj, MP.title)
                 piece.composer = comp
                 if not graph.value(mp_subj, MP['for']).eq(piece.raw_instrument):
@@ -134,15 +168,20 @@ class Command(BaseCommand):
             piece.opus = graph.value(mp_subj, MP.opus)
 
             piece.save()
+            self.touch(piece)
             image_name = str(graph.value(mp_subj, MP.pngFile))
             self.finalize_mapping(asset, piece, image_name.endswith('.svg'))
             logger.info('* Finished piece {0}'.format(piece))
 
 
     def handle(self, *args, **options):
+        self.touched = {model: set() for model in self.counted + (Piece,)}
         with transaction.atomic():
             logger.info('Processing new or updated RDF files.')
             self.process_pending_pieces()
             self.update_instruments()
-            logger.info('Refreshing materialized view for FTS.')
-            SearchTerm.refresh_view()
+            self.update_piece_counts()
+            self.update_piece_details()
+        # Invalidate anything cached against the previous catalogue.
+        logger.info('Starting a new catalogue generation.')
+        new_generation()
@@ -0,0 +1,23 @@
+"""Django command for rebuilding the piece counts of the catalogue.
+"""
+
+import logging
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from mutopia.models import Composer, Style, LPVersion, Instrument
+from mutopia.cache import new_generation
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = """Recount the pieces of every composer, style, LilyPond
+    version, and instrument. The counts are normally kept by dbupdate
+    so this is only needed after changes that bypass it."""
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            for model in (Composer, Style, LPVersion, Instrument):
+                logger.info('Recounting %s pieces' % model.__name__)
+                model.update_piece_counts()
+        new_generation()
@@ -3,6 +3,7 @@ from django.http import JsonResponse
 from django.views.decorators.http import require_safe
 from django.db.models import Max
 from mutopia.models import Piece, AssetMap
+from mutopia.search import search_cache_stats
 
 @require_safe
 def site_status(request):
@@ -29,5 +30,7 @@ def site_status(request):
     for pending_asset in AssetMap.objects.all().filter(published=False):
         assets.append(pending_asset.folder)
     state_dict['pending'] = assets
+    # Statistics are for the process serving this request.
+    state_dict['search_cache'] = search_cache_stats()
     response = JsonResponse(state_dict)
     return response